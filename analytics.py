@@ -11,18 +11,55 @@ street_data.csv: basic stats for each street segment
 __author__ = "Jack Fox"
 __email__ = "jfox13@nd.edu"
 
-import json
+import os
 import csv
 import sys
+import numpy as np
 import psycopg2
 import datetime
-from utils import db_setup, progress_bar_setup, progress_bar_increment, progress_bar_finish, clean_severity, calc_KSI, calc_total_injured, clean_date, read_crash_csv, feet_to_mile
+from street_index import write_street_index
+from metrics import METRICS
+from crash_store import CrashStore, network_fingerprint
+from offline_locator import NETWORKSNAPSHOT, NetworkSnapshot, OfflineLocator, street_list_mismatches, report_mismatches
+from segment_index import SegmentIndex, SNAP_DISTANCE
+from crash_location import OUTPUTJSON as CRASHLOCATIONJSON
+from utils import QueryCache, SegmentTable, db_setup, db_pool, run_with_pool, progress_bar_setup, progress_bar_increment, progress_bar_finish, clean_severity, calc_KSI, calc_total_injured, clean_date, read_crash_csv, write_json_records, load_json_output, output_path, feet_to_mile
 
 # Files written
 STREETJSON = 'data/street_data.json'
 STREET_CRASH_RELATIONSHIP = 'data/street_to_crash.csv'
 STREETCSV = 'data/street_data.csv'
 
+# Resolve every crash to its street segments with a few set-based queries instead of one query per crash
+BULK_RESOLVE = True
+
+# Number of worker threads (each with its own connection) resolving crash streets in parallel, requires BULK_RESOLVE
+WORKERS = 1
+# Number of crashes handed to each worker at a time
+WORKER_CHUNK_SIZE = 5000
+
+# Also write street data to an indexed sqlite file that connected_road_data.py can read segment by segment
+WRITE_STREET_INDEX = True
+
+# Take segment lengths from a snapshot of streetcenterlines (kept on disk while the network is unchanged) instead of querying them
+USE_SEGMENT_TABLE = True
+
+# Optional file used to persist street lookups between runs, None keeps the cache in memory only
+QUERY_CACHE_FILE = None
+
+# Reuse street lists stored by previous runs for crashes whose location fields have not changed
+INCREMENTAL = True
+# Drop every stored street list when the street network changes
+CHECK_NETWORK_VERSION = True
+
+# Resolve crash streets in-process with offline_locator.py on a cached snapshot of the street network instead of calling getstreetfrominterv2
+OFFLINE = False
+# Number of offline crash street lists compared against the SQL lookups, 0 disables the cross-check
+CROSS_CHECK = 0
+
+# Give crashes located by crash_location.py that have no street by intersection and direction the nearest street segment within SNAP_DISTANCE feet
+SNAP_CRASHES = False
+
 def all_streets_from_inter(intnum: int) -> str:
     ''' return query string to get all streets connected to a given intersection '''
     query ="""
@@ -45,8 +82,10 @@ WHERE intersections.intnum = {};
 """
     return query.format(direction,intnum)
 
-def get_street_length(cursor: psycopg2.extensions.cursor, street_id: int) -> str:
+def get_street_length(cursor: psycopg2.extensions.cursor, street_id: int, cache: QueryCache = None) -> str:
     ''' street length in feet '''
+    if cache is not None:
+        return cache.get_or_query(('length', street_id), lambda: get_street_length(cursor, street_id))
     query ="""
 SELECT
     ST_Length(ST_AsText(ST_LineMerge(geom)))
@@ -60,13 +99,16 @@ WHERE id = {};
     else:
         return None
 
-def street_list_from_crash(crash_data: dict, crash: int, cursor: psycopg2.extensions.cursor) -> list:
+def street_list_from_crash(crash_data: dict, crash: int, cursor: psycopg2.extensions.cursor, cache: QueryCache = None) -> list:
     ''' returns a list of all streets affected by a given crash '''
     street_list = list()
     int_num = crash_data[crash]['intersection_id']
     direction = crash_data[crash]['direction']
     if not int_num or not direction:
         return street_list
+
+    if cache is not None:
+        return cache.get_or_query(('streets', int_num, direction), lambda: street_list_from_crash(crash_data, crash, cursor))
     
     if direction == 'At':
         query = all_streets_from_inter(int_num)
@@ -80,44 +122,149 @@ def street_list_from_crash(crash_data: dict, crash: int, cursor: psycopg2.extens
             street_list.append(int(street[0]))
     return street_list
 
-if __name__ == '__main__':
-    print("analytics.py: Gathering crash data for street segments")
-    cursor, conn = db_setup()
-    crash_data = read_crash_csv()
-    street_crashes = dict()
+def streets_from_inters(cursor: psycopg2.extensions.cursor, intnums: list) -> dict:
+    ''' map each intersection intnum to all streets connected to it with a single query '''
+    streets = dict()
+    if not intnums:
+        return streets
+    query ="""
+SELECT
+    intersections.intnum,
+    streetcenterlines.id
+FROM streetcenterlines, intersections
+WHERE intersections.intnum = ANY(%s)
+    AND (frominteri = intersections.intid
+        OR tointerid = intersections.intid);
+"""
+    cursor.execute(query, (list(intnums),))
+    for intnum, street in cursor.fetchall():
+        streets.setdefault(intnum, list()).append(street)
+    return streets
 
-    i = 0
-    total_crashes = len(crash_data)
-    progress_bar_setup()
+def streets_from_inter_directions(cursor: psycopg2.extensions.cursor, pairs: list) -> dict:
+    ''' map each (intnum, direction) pair to the street in that direction from the intersection with a single query '''
+    streets = dict()
+    if not pairs:
+        return streets
+    query ="""
+SELECT
+    P.intnum,
+    P.direction,
+    getstreetfrominterv2(intersections.id, P.direction)
+FROM unnest(%s::integer[], %s::text[]) AS P(intnum, direction)
+JOIN intersections ON intersections.intnum = P.intnum;
+"""
+    cursor.execute(query, ([i[0] for i in pairs], [i[1] for i in pairs]))
+    for intnum, direction, street in cursor.fetchall():
+        streets.setdefault((intnum, direction), list()).append(street)
+    return streets
 
+def street_lists_from_crashes(crash_data: dict, cursor: psycopg2.extensions.cursor, cache: QueryCache = None) -> dict:
+    ''' returns a dictionary mapping every crash to the list of streets affected by it, equivalent to calling street_list_from_crash on each crash '''
+    crash_keys = dict()
     for crash in crash_data:
-        # prints progress to terminal
-        i += 1
-        progress_bar_increment(i,total_crashes)
+        int_num = crash_data[crash]['intersection_id']
+        direction = crash_data[crash]['direction']
+        if int_num and direction:
+            crash_keys[crash] = ('streets', int_num, direction)
 
-        # discovers all streets affected by a crash
-        streets = street_list_from_crash(crash_data,crash,cursor)
-        # for each street affected by a given crash, create or modify that street's dictionary entry in street_crashes to contain information on that crash
-        for street in streets:
+    resolved = dict()
+    intnums = set()
+    pairs = set()
+    for key in dict.fromkeys(crash_keys.values()):
+        street_list = cache.get(key, QueryCache.MISSING) if cache is not None else QueryCache.MISSING
+        if street_list is not QueryCache.MISSING:
+            resolved[key] = street_list
+        elif key[2] == 'At':
+            intnums.add(key[1])
+        else:
+            pairs.add((key[1], key[2]))
 
-            if street not in street_crashes:
-                street_crashes[street] = dict()
-                street_crashes[street]['injured'] = 0
-                street_crashes[street]['ksi'] = 0
-                street_crashes[street]['total_crashes'] = 0
-                street_crashes[street]['crashes'] = dict()
-                street_crashes[street]['length'] = feet_to_mile(get_street_length(cursor,street))
-
-            street_crashes[street]['total_crashes'] += 1
-            street_crashes[street]['crashes'][crash] = dict()
-            street_crashes[street]['crashes'][crash]['date'] = crash_data[crash]['date']
-            street_crashes[street]['crashes'][crash]['injured'] = crash_data[crash]['injured']
-            street_crashes[street]['crashes'][crash]['ksi'] = crash_data[crash]['ksi']
-            street_crashes[street]['injured'] += crash_data[crash]['injured']
-            street_crashes[street]['ksi'] += crash_data[crash]['ksi']
-    progress_bar_finish()
+    inter_streets = streets_from_inters(cursor, sorted(intnums))
+    direction_streets = streets_from_inter_directions(cursor, sorted(pairs))
 
-    # calculate ksi/mile, injured/mile, etc. for each street in the street_crashes dictionary
+    for int_num in intnums:
+        resolved[('streets', int_num, 'At')] = [ int(street) for street in inter_streets.get(int_num, list()) if street ]
+    for int_num, direction in pairs:
+        resolved[('streets', int_num, direction)] = [ int(street) for street in direction_streets.get((int_num, direction), list()) if street ]
+    if cache is not None:
+        for int_num in intnums:
+            cache.put(('streets', int_num, 'At'), resolved[('streets', int_num, 'At')])
+        for int_num, direction in pairs:
+            cache.put(('streets', int_num, direction), resolved[('streets', int_num, direction)])
+
+    street_lists = dict()
+    for crash in crash_data:
+        street_lists[crash] = list(resolved[crash_keys[crash]]) if crash in crash_keys else list()
+    return street_lists
+
+def get_street_lengths(cursor: psycopg2.extensions.cursor, street_ids: list, cache: QueryCache = None) -> dict:
+    ''' map each street id to its length in feet with a single query '''
+    lengths = dict()
+    if cache is not None:
+        pending = list()
+        for street in street_ids:
+            length = cache.get(('length', street), QueryCache.MISSING)
+            if length is QueryCache.MISSING:
+                pending.append(street)
+            else:
+                lengths[street] = length
+        for street, length in get_street_lengths(cursor, pending).items():
+            lengths[street] = length
+        for street in pending:
+            lengths.setdefault(street, None)
+            cache.put(('length', street), lengths[street])
+        return lengths
+
+    if not street_ids:
+        return lengths
+    query ="""
+SELECT
+    id,
+    ST_Length(ST_AsText(ST_LineMerge(geom)))
+FROM streetcenterlines
+WHERE id = ANY(%s);
+"""
+    cursor.execute(query, (list(street_ids),))
+    for street, length in cursor.fetchall():
+        lengths[int(street)] = float(length) if length else None
+    return lengths
+
+def snap_crashes(crash_data: dict, crash_locations: dict, snapshot: NetworkSnapshot, max_distance: float = SNAP_DISTANCE) -> dict:
+    ''' maps every crash crash_location.py placed to a list holding the nearest street segment within max_distance feet of its location in crash_locations '''
+    locations = dict()
+    for crash in crash_data:
+        location = crash_locations.get(crash)
+        if location and location.get('latitude') is not None and location.get('longitude') is not None:
+            locations[crash] = (location['longitude'], location['latitude'])
+    crashes = list(locations)
+    if not crashes:
+        return dict()
+    points = np.array([ locations[crash] for crash in crashes ], dtype=np.float64)
+    rows, _ = SegmentIndex.from_snapshot(snapshot).nearest(points, 1, max_distance)
+    return { crash: [ int(snapshot.segment_ids[row]) ] for crash, row in zip(crashes, rows[:, 0].tolist()) if row >= 0 }
+
+def add_street_crash(street_crashes: dict, street: int, crash: str, crash_data: dict, street_length) -> None:
+    ''' create or modify a street's entry in street_crashes to contain information on a crash, street_length(street) gives the length in feet of a new street '''
+    if street not in street_crashes:
+        street_crashes[street] = dict()
+        street_crashes[street]['injured'] = 0
+        street_crashes[street]['ksi'] = 0
+        street_crashes[street]['total_crashes'] = 0
+        street_crashes[street]['crashes'] = dict()
+        length = street_length(street)
+        street_crashes[street]['length'] = feet_to_mile(length) if length is not None else None
+
+    street_crashes[street]['total_crashes'] += 1
+    street_crashes[street]['crashes'][crash] = dict()
+    street_crashes[street]['crashes'][crash]['date'] = crash_data[crash]['date']
+    street_crashes[street]['crashes'][crash]['injured'] = crash_data[crash]['injured']
+    street_crashes[street]['crashes'][crash]['ksi'] = crash_data[crash]['ksi']
+    street_crashes[street]['injured'] += crash_data[crash]['injured']
+    street_crashes[street]['ksi'] += crash_data[crash]['ksi']
+
+def add_street_rates(street_crashes: dict) -> None:
+    ''' calculate ksi/mile, injured/mile, etc. for each street in the street_crashes dictionary '''
     for street in street_crashes:
         if street_crashes[street]['length'] is not None:
             length = street_crashes[street]['length']
@@ -133,10 +280,114 @@ if __name__ == '__main__':
             street_crashes[street]['injured/mile'] = None
             street_crashes[street]['crashes/mile'] = None
 
+def main(cursor: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection, crash_data: dict) -> None:
+    ''' finds the street segments of every crash in crash_data and writes the street segment outputs '''
+    print("analytics.py: Gathering crash data for street segments")
+    # without postgres an OFFLINE run works from the network and segment snapshots left on disk by earlier runs
+    if cursor is None and not (OFFLINE and USE_SEGMENT_TABLE and os.path.exists(NETWORKSNAPSHOT) and SegmentTable.snapshot_version() is not None):
+        print("Error: analytics.py needs a database connection unless OFFLINE and USE_SEGMENT_TABLE are set and both network snapshots exist", file=sys.stderr)
+        sys.exit(1)
+    cache = QueryCache(path=QUERY_CACHE_FILE)
+    street_crashes = dict()
+
+    snapshot = NetworkSnapshot.cached(cursor) if OFFLINE or SNAP_CRASHES else None
+
+    # only crashes that are new or changed since the last run are sent to postgres
+    street_lists = dict()
+    if INCREMENTAL:
+        network_version = network_fingerprint(cursor) if cursor is not None else snapshot.network_version
+        store = CrashStore(network_version=network_version if CHECK_NETWORK_VERSION else None)
+        street_lists = store.cached_streets(crash_data)
+        print("analytics.py: Reusing {} stored crash street lists".format(len(street_lists)))
+    stale_crashes = { crash: crash_data[crash] for crash in crash_data if crash not in street_lists }
+
+    segments = SegmentTable.cached(cursor) if USE_SEGMENT_TABLE else None
+    street_lengths = dict()
+
+    def street_length(street: int) -> float:
+        ''' street length in feet from whichever source is configured '''
+        if segments is not None:
+            return segments.length(street)
+        elif street in street_lengths:
+            return street_lengths[street]
+        return get_street_length(cursor,street,cache)
+
+    if OFFLINE:
+        offline_lists = OfflineLocator(snapshot).street_lists(stale_crashes)
+        street_lists.update(offline_lists)
+        if CROSS_CHECK and cursor is not None:
+            sample = { crash: stale_crashes[crash] for crash in list(stale_crashes)[:CROSS_CHECK] }
+            sql_lists = street_lists_from_crashes(sample, cursor)
+            sample_lists = { crash: offline_lists[crash] for crash in sample }
+            report_mismatches('analytics.py', street_list_mismatches(sample_lists, sql_lists), len(sample), sample_lists, sql_lists)
+    elif BULK_RESOLVE and WORKERS > 1:
+        # chunks are resolved in parallel and merged in their original order so output matches a serial run
+        stale = list(stale_crashes)
+        chunks = [ { crash: crash_data[crash] for crash in stale[start:start+WORKER_CHUNK_SIZE] } for start in range(0, len(stale), WORKER_CHUNK_SIZE) ]
+        pool = db_pool(WORKERS)
+        for chunk_lists in run_with_pool(pool, WORKERS, lambda chunk, worker_cursor: street_lists_from_crashes(chunk, worker_cursor, cache), chunks):
+            street_lists.update(chunk_lists)
+        pool.closeall()
+    elif BULK_RESOLVE:
+        street_lists.update(street_lists_from_crashes(stale_crashes,cursor,cache))
+
+    snapped_streets = dict()
+    if SNAP_CRASHES:
+        crash_locations = dict()
+        if os.path.exists(output_path(CRASHLOCATIONJSON)):
+            crash_locations = load_json_output(CRASHLOCATIONJSON)
+        else:
+            print("analytics.py: {} not found, no crashes are snapped, run crash_location.py first".format(output_path(CRASHLOCATIONJSON)), file=sys.stderr)
+        snapped_streets = snap_crashes(crash_data, crash_locations, snapshot)
+    snapped = 0
+
+    # lengths of every street found so far with a single query, streets resolved one crash at a time below query their own
+    if segments is None and (OFFLINE or BULK_RESOLVE):
+        found = set(street for streets in street_lists.values() for street in streets)
+        found.update(street for streets in snapped_streets.values() for street in streets)
+        street_lengths.update(get_street_lengths(cursor,sorted(found),cache))
+
+    i = 0
+    total_crashes = len(crash_data)
+    METRICS.add_rows('analytics', total_crashes)
+    progress_bar_setup()
+
+    for crash in crash_data:
+        # prints progress to terminal
+        i += 1
+        progress_bar_increment(i,total_crashes)
+
+        # discovers all streets affected by a crash
+        if crash in street_lists:
+            streets = street_lists[crash]
+        else:
+            streets = street_list_from_crash(crash_data,crash,cursor,cache)
+            street_lists[crash] = streets
+        # crashes that can not be placed by intersection and direction fall back on their snapped location
+        if not streets and crash in snapped_streets:
+            streets = snapped_streets[crash]
+            snapped += 1
+        # for each street affected by a given crash, create or modify that street's dictionary entry in street_crashes to contain information on that crash
+        for street in streets:
+            add_street_crash(street_crashes, street, crash, crash_data, street_length)
+    progress_bar_finish()
+    cache.close()
+
+    if INCREMENTAL:
+        store.save_streets(crash_data, { crash: street_lists[crash] for crash in stale_crashes })
+        store.close()
+    if SNAP_CRASHES:
+        print("analytics.py: Crashes snapped to their nearest street segment = {}".format(snapped))
+    print("analytics.py:\n\tQuery cache hits = {hits}\n\tQuery cache misses = {misses}\n\tQuery cache hit rate = {hit_rate:.1%}".format(**cache.stats()))
+
+    # calculate ksi/mile, injured/mile, etc. for each street in the street_crashes dictionary
+    add_street_rates(street_crashes)
+
     print("analytics.py: Writing street segment data")
     # Creates CSV and JSON representations of street_crashes
-    with open(STREETJSON, 'w') as f:
-        f.write(json.dumps(street_crashes, default=str, indent=4))
+    write_json_records(STREETJSON, street_crashes.items())
+    if WRITE_STREET_INDEX:
+        write_street_index(street_crashes)
 
     with open(STREETCSV, 'w') as f:
         writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
@@ -154,4 +405,8 @@ if __name__ == '__main__':
             for crash in street_crashes[street]['crashes']:
                 writer.writerow([street,crash])
 
-
+if __name__ == '__main__':
+    cursor, conn = db_setup() or (None, None)
+    with METRICS.stage('analytics'):
+        main(cursor, conn, read_crash_csv())
+    METRICS.write()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+'''
+benchmark.py: times the crash csv parsing, crash to street resolution, serial and sharded road building and output writing stages on synthetic data
+
+Database queries are replaced by in-process stand-ins from synthetic_data.py so runs are comparable between machines,
+load synthetic_data/<scale>x/network.sql into a disposable database to benchmark the SQL stages themselves.
+
+Run as: python3 benchmark.py [scale ...] (defaults to 1 10 100)
+
+Outputs:
+data/benchmark.json: seconds taken by each stage at each scale, with row counts and peak memory
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import os
+import sys
+import json
+import time
+import tempfile
+from utils import read_crash_csv, write_json_records
+from analytics import add_street_crash, add_street_rates
+from connected_road_data import segment_adjacency, connections_from_segments, nonconnections_from_segments, names_from_connections, build_roads, build_roads_sharded
+from road_stats import SegmentCrashes, RoadStats, road_lengths, road_statistics, street_data_records
+from metrics import peak_rss_mb
+from synthetic_data import generate, segment_table, GridResolver
+
+BENCHMARKJSON = 'data/benchmark.json'
+
+SCALES = (1, 10, 100)
+
+# Worker processes of the sharded road building stage, compare its time with construct_roads plus road_stats
+SHARD_WORKERS = max(os.cpu_count() or 1, 2)
+
+def timed(results: dict, name: str, function):
+    ''' runs function, records and prints how long it took, returns its result '''
+    start = time.perf_counter()
+    result = function()
+    results[name] = time.perf_counter() - start
+    print("benchmark.py:\t{:<24} {:>9.3f}s".format(name, results[name]))
+    return result
+
+def resolve_streets(crash_data: dict, resolver: GridResolver, segments) -> dict:
+    ''' builds the street_crashes dictionary of analytics.py from the synthetic resolver '''
+    street_crashes = dict()
+    street_lists = resolver.street_lists(crash_data)
+    for crash in crash_data:
+        for street in street_lists[crash]:
+            add_street_crash(street_crashes, street, crash, crash_data, segments.length)
+    add_street_rates(street_crashes)
+    return street_crashes
+
+def construct_roads(segments) -> list:
+    ''' builds the roads of connected_road_data.py as lists of intids, single segment roads last '''
+    adjacency = segment_adjacency(segments)
+    names = names_from_connections(connections_from_segments(segments, adjacency))
+    name_roads = build_roads(names)
+    roads = [ road for name in names for road in name_roads[name] ]
+    roads += [ {int(street[0])} for street in nonconnections_from_segments(segments, adjacency) ]
+    return roads
+
+def road_stats(roads: list, street_crashes: dict, segments) -> list:
+    ''' vectorized ksi, injured and crash statistics of every road '''
+    segment_crashes = SegmentCrashes.from_street_data(street_crashes)
+    id_map = segments.id_map()
+    stats = RoadStats([ [ id_map[segment] for segment in road ] for road in roads ], segment_crashes)
+    return road_statistics(stats, road_lengths(roads, segments.length_map()))
+
+def sharded_roads(street_crashes: dict, segments) -> list:
+    ''' roads and their statistics built the way connected_road_data.py does with ROAD_WORKERS = SHARD_WORKERS '''
+    adjacency = segment_adjacency(segments)
+    names = names_from_connections(connections_from_segments(segments, adjacency))
+    singles = [ int(street[0]) for street in nonconnections_from_segments(segments, adjacency) ]
+    records = dict()
+    for record in street_data_records(street_crashes):
+        records.setdefault(int(record[0]), list()).append(record)
+    return build_roads_sharded(names, singles, records, segments.length_map(), segments.id_map(), SHARD_WORKERS)[1]
+
+def write_outputs(street_crashes: dict, roads: list, statistics: list) -> None:
+    ''' writes the street and road JSON outputs to a temporary directory '''
+    with tempfile.TemporaryDirectory() as directory:
+        write_json_records(directory + '/street_data.json', street_crashes.items(), 'json')
+        write_json_records(directory + '/roads.json', ((i, { 'segments': road, 'stats': stats }) for i, (road, stats) in enumerate(zip(roads, statistics))), 'json')
+
+def run(scale: float) -> dict:
+    ''' benchmarks every stage at one scale '''
+    print("benchmark.py: Scale {}".format(scale))
+    results = dict()
+    network, crash_csv = timed(results, 'generate', lambda: generate(scale))
+    segments = segment_table(network)
+    resolver = GridResolver(network)
+    crash_data = timed(results, 'read_crash_csv', lambda: read_crash_csv(crash_csv))
+    street_crashes = timed(results, 'resolve_streets', lambda: resolve_streets(crash_data, resolver, segments))
+    roads = timed(results, 'construct_roads', lambda: construct_roads(segments))
+    statistics = timed(results, 'road_stats', lambda: road_stats(roads, street_crashes, segments))
+    timed(results, 'sharded_roads', lambda: sharded_roads(street_crashes, segments))
+    timed(results, 'write_outputs', lambda: write_outputs(street_crashes, roads, statistics))
+    results['crashes'] = len(crash_data)
+    results['segments'] = len(segments)
+    results['roads'] = len(roads)
+    results['shard_workers'] = SHARD_WORKERS
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+def main(scales: list) -> None:
+    ''' benchmarks every scale and writes the results '''
+    results = { str(scale): run(scale) for scale in scales }
+    with open(BENCHMARKJSON, 'w') as f:
+        json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main([ float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:] ] or SCALES)
@@ -10,12 +10,23 @@ roads.csv: for each road will include geometry and stats
 __author__ = "Jack Fox"
 __email__ = "jfox13@nd.edu"
 
-import json
 import csv
 import sys
 import psycopg2
 import datetime
-from utils import db_setup, FEETPERMILE
+import os
+import math
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from road_stats import Incidence, RoadStats, SegmentCrashes, road_lengths, road_statistics, street_data_records
+from crash_trends import SEGMENTTRENDS, ROADTRENDS, TimeIndex, road_time_index, segment_time_index, write_trends
+from metrics import METRICS
+from street_index import StreetIndex, STREETINDEX
+from road_store import RoadStore
+from crash_store import network_fingerprint
+from utils import SegmentTable, db_setup, DBLOCALNAME, load_json_output, output_path, write_json_records, feet_to_mile, FEETPERMILE, NULL_ID
 
 # Files that roads data will be written to
 ROADSJSON = 'data/roads.json'
@@ -24,6 +35,34 @@ ROADSCSV = 'data/roads.csv'
 # Files that will be read containing street segment JSON data
 STREETDATA = 'data/street_data.json'
 
+# Compute every road's statistics in one vectorized pass over sparse road/segment/crash incidence arrays
+VECTORIZED_STATS = True
+
+# Also write per year, per month and rolling window statistics for every segment and road, requires VECTORIZED_STATS
+TIME_TRENDS = True
+
+# Read per segment crash data from the indexed street_data.sqlite written by analytics.py when it exists, instead of loading all of street_data.json
+USE_STREET_INDEX = True
+
+# Take segment endpoints, classes, ids and lengths from a snapshot of streetcenterlines (kept on disk while the network is unchanged)
+USE_SEGMENT_TABLE = True
+
+# Build segment connections from the segment snapshot in Python instead of self-joining streetcenterlines, requires USE_SEGMENT_TABLE
+IN_MEMORY_CONNECTIONS = True
+
+# Build every road geometry in one grouped query on the server instead of merging segment geometries road by road
+SERVER_SIDE_GEOMETRY = True
+
+# Number of worker processes roads are built by, 1 builds everything in this process
+# (name, streetclas) groups are sharded across the processes, which group them into roads and compute road statistics from only their shard's crashes
+# (requires VECTORIZED_STATS and USE_SEGMENT_TABLE), and road geometries are built by the same number of processes, each over its own database connection
+ROAD_WORKERS = 1
+
+# Identify roads by a hash of their segment intids so a road keeps its id between runs, False numbers roads 1, 2, 3, ... in the order they are found
+STABLE_ROAD_IDS = True
+# Reuse geometries stored by earlier runs for roads whose segments have not changed, requires STABLE_ROAD_IDS
+REUSE_GEOMETRY = True
+
 def map_ids_intid(cursor: psycopg2.extensions.cursor, map_dict: dict) -> None:
     ''' creates a dictionary that maps street segment intid to id '''
     query ="""
@@ -62,6 +101,15 @@ def analyze_segment(segments: list, street_data: dict, map_dict: dict) -> tuple:
     crashes = len(crash_dict)
     return ksi, injured, crashes
 
+def analyze_segment_indexed(segments: list, street_index: StreetIndex, map_dict: dict) -> tuple:
+    ''' returns (ksi, injured, crashes) for a list of street segments, reading only those segments from the street index '''
+    return street_index.segment_stats([ map_dict[segment] for segment in segments ])
+
+def stable_road_id(segments) -> int:
+    ''' id of a road derived from its sorted segment intids, a positive 63 bit integer so it fits a postgres bigint '''
+    key = ','.join(str(segment) for segment in sorted(segments))
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big') >> 1
+
 def get_connections(cursor: psycopg2.extensions.cursor) -> list:
     ''' get a list of all connected street segments (physically connected segments that share a name) where each element contains information on a pair of connected segments '''
     query ="""
@@ -148,6 +196,64 @@ WHERE streetcenterlines.intid NOT IN
     cursor.execute(query)
     return cursor.fetchall()
 
+def segment_adjacency(segments: SegmentTable) -> list:
+    ''' for each row of the segment snapshot, the rows of all other segments that share an endpoint, name and street class with it '''
+    # index every (intersection, name, streetclas) to the segments ending there
+    endpoint_index = dict()
+    for row in range(len(segments)):
+        name = segments.names[row]
+        streetclas = segments.classes[row]
+        if name is None or streetclas is None:
+            continue
+        for intersection in set((segments.from_inters[row], segments.to_inters[row])):
+            if intersection != NULL_ID:
+                endpoint_index.setdefault((intersection, name, streetclas), list()).append(row)
+
+    adjacency = [ set() for _ in range(len(segments)) ]
+    for rows in endpoint_index.values():
+        if len(rows) < 2:
+            continue
+        for row in rows:
+            for other in rows:
+                if segments.ids[row] != segments.ids[other]:
+                    adjacency[row].add(other)
+    return adjacency
+
+def connections_from_segments(segments: SegmentTable, adjacency: list) -> list:
+    ''' in-memory equivalent of get_connections, built from the segment snapshot and its adjacency '''
+    connections = list()
+    for row in range(len(segments)):
+        if not segments.in_sj[row]:
+            continue
+        for other in sorted(adjacency[row]):
+            if segments.in_sj[other]:
+                connections.append((
+                    segments.names[row],
+                    segments.ids[row],
+                    segments.intids[row],
+                    segments.ids[other],
+                    segments.intids[other],
+                    segments.from_inters[row],
+                    segments.to_inters[row],
+                    segments.classes[row]
+                ))
+    return connections
+
+def nonconnections_from_segments(segments: SegmentTable, adjacency: list) -> list:
+    ''' in-memory equivalent of get_nonconnections, sj segments with no neighbours in the adjacency '''
+    connected = set( segments.intids[row] for row in range(len(segments)) if adjacency[row] )
+    nonconnections = list()
+    for row in range(len(segments)):
+        if segments.in_sj[row] and segments.intids[row] not in connected:
+            nonconnections.append((
+                segments.intids[row],
+                segments.from_inters[row],
+                segments.to_inters[row],
+                segments.names[row],
+                segments.classes[row]
+            ))
+    return nonconnections
+
 def create_road_geometry(cursor: psycopg2.extensions.cursor, road: list) -> str:
     ''' create a linestring geom for a road from a list of its segments '''
 
@@ -188,6 +294,115 @@ Select ST_Multi( '{}' );
     return geometries[0]
 
 
+def stage_road_segments(cursor: psycopg2.extensions.cursor, roads: list) -> None:
+    ''' stage a temporary road_segments table mapping each road's position in the roads list to its segment intids '''
+    query ="""
+DROP TABLE IF EXISTS road_segments;
+
+CREATE TEMPORARY TABLE road_segments (
+    position integer,
+    intid integer
+);
+"""
+    cursor.execute(query)
+
+    positions = list()
+    intids = list()
+    for position, road in enumerate(roads):
+        for segment in road:
+            positions.append(position)
+            intids.append(segment)
+
+    query ="""
+INSERT INTO road_segments (position, intid)
+SELECT * FROM unnest(%s::integer[], %s::integer[]);
+"""
+    cursor.execute(query, (positions, intids))
+
+def create_road_geometries(cursor: psycopg2.extensions.cursor, roads: list):
+    ''' generator yielding the MultiLineString geom for each road in a list of roads (lists of segments), all geometries are built on the server by one grouped query '''
+    stage_road_segments(cursor, roads)
+
+    query ="""
+SELECT
+    road_segments.position,
+    ST_Multi(ST_LineMerge(ST_Union(ST_LineMerge(streetcenterlines.geom))))
+FROM road_segments
+JOIN streetcenterlines ON streetcenterlines.intid = road_segments.intid
+GROUP BY road_segments.position
+ORDER BY road_segments.position;
+"""
+    # stream the results with a server side cursor so only one road geometry is held at a time
+    geometry_cursor = cursor.connection.cursor(name='road_geometries')
+    geometry_cursor.execute(query)
+
+    # iterating a named cursor fetches itersize rows per round trip
+    records = iter(geometry_cursor)
+    record = next(records, None)
+    for position in range(len(roads)):
+        if record and record[0] == position:
+            yield record[1]
+            record = next(records, None)
+        else:
+            yield None
+    geometry_cursor.close()
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    ''' pool of workers processes, spawned rather than forked since the pipeline runs stages on threads and a forked child could inherit held locks and open database sockets '''
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def sharded(function, items: list, workers: int):
+    ''' generator yielding the results of function(shard) for contiguous shards of items, computed by a pool of workers processes, in the order of items '''
+    size = math.ceil(len(items) / workers)
+    shards = [ items[start:start+size] for start in range(0, len(items), size) ]
+    with process_pool(workers) as executor:
+        for results in executor.map(function, shards):
+            yield from results
+
+def shard_geometries(roads: list) -> list:
+    ''' geometries of a shard of roads, built in a worker process over its own database connection '''
+    connection = db_setup()
+    if connection is None:
+        raise psycopg2.OperationalError("connected_road_data.py: worker process could not connect to {}".format(DBLOCALNAME))
+    cursor, conn = connection
+    try:
+        return list(road_geometries(cursor, roads))
+    finally:
+        conn.close()
+
+def road_geometries(cursor: psycopg2.extensions.cursor, roads: list, workers: int = 1):
+    ''' generator yielding the geom for each road in a list of roads (lists of segments) with whichever method is configured, with workers > 1 contiguous shards of roads are built by a process pool '''
+    if workers > 1 and len(roads) > 1:
+        yield from sharded(shard_geometries, [ list(road) for road in roads ], workers)
+    elif SERVER_SIDE_GEOMETRY:
+        yield from create_road_geometries(cursor, roads)
+    else:
+        for road in roads:
+            yield create_road_geometry(cursor, list(road))
+
+def stored_road_geometries(cursor: psycopg2.extensions.cursor, roads: dict):
+    ''' generator yielding the geom for each road in a {stable road id: road} dictionary, only roads without a stored geometry are built by postgres '''
+    store = RoadStore(network_version=network_fingerprint(cursor))
+    stored = store.road_ids()
+    missing = [ road for road in roads if road not in stored ]
+    print("connected_road_data.py: Reusing {} stored road geometries, building {}".format(len(roads) - len(missing), len(missing)))
+
+    built = road_geometries(cursor, [ roads[road]['segments'] for road in missing ], ROAD_WORKERS)
+    new_geometries = list()
+    try:
+        for road in roads:
+            if road in stored:
+                yield store.geometry(road)
+            else:
+                geometry = next(built)
+                new_geometries.append((road, geometry))
+                yield geometry
+    finally:
+        # also runs when the caller closes the generator after taking the last geometry
+        store.save_geometries(new_geometries)
+        store.retain(roads)
+        store.close()
+
 def get_intersection_map(cursor: psycopg2.extensions.cursor) -> dict:
     ''' get a map of street segment intid to (frominteri, tointeri, streetclas) '''
     intersection_map = dict()
@@ -205,20 +420,161 @@ FROM streetcenterlines;
 
     return intersection_map
 
-def create_road(intida: int, intidb: int, name: dict) -> set:
-    ''' creates a set of connected street segments '''
-    new_road = set((intida, intidb))
-    road_expanded = True
-    while road_expanded:
-        road_expanded = False
-        for a, b in name:
-            if a in new_road and b not in new_road:
-                road_expanded = True
-                new_road.add(b)
-            elif b in new_road and a not in new_road:
-                road_expanded = True
-                new_road.add(a)
-    return new_road 
+class DisjointSet:
+    ''' union-find structure over street segment intids using path halving and union by size '''
+
+    def __init__(self) -> None:
+        self.parent = dict()
+        self.size = dict()
+
+    def find(self, item: int) -> int:
+        ''' returns the representative segment of the set containing item, adding item as its own set if unseen '''
+        parent = self.parent
+        if item not in parent:
+            parent[item] = item
+            self.size[item] = 1
+            return item
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a: int, b: int) -> None:
+        ''' merges the sets containing a and b '''
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+def connected_roads(connections: dict) -> list:
+    ''' groups the segments of a {(intida, intidb): ...} connection dictionary into roads (sets of connected segments), ordered by the first connection seen for each road '''
+    segments = DisjointSet()
+    for intida, intidb in connections:
+        segments.union(intida, intidb)
+
+    roads = dict()
+    for intida, intidb in connections:
+        roads.setdefault(segments.find(intida), set()).update((intida, intidb))
+    return list(roads.values())
+
+def names_from_connections(connections: list) -> dict:
+    ''' parse a connections list into a dictionary mapping each (name, streetclas) to all street segment connections with that street name and class '''
+    names = dict()
+    for name, ida, intida, idb, intidb, intersectiona, intersectionb, streetclas in connections:
+        ida = int(ida)
+        idb = int(idb)
+        intida = int(intida)
+        intidb = int(intidb)
+        intersectiona = int(intersectiona)
+        intersectionb = int(intersectionb)
+        key = (name,streetclas)
+
+        if not key in names:
+            names[key] = dict()
+        names[key][(intida,intidb)] = (intersectiona, intersectionb)
+        names[key][(intidb,intida)] = (intersectiona, intersectionb)
+    return names
+
+def build_roads(names: dict) -> dict:
+    ''' finds all roads for every (name, streetclas) key of a names dictionary, returns a dictionary mapping each key to its list of roads '''
+    return { key: connected_roads(names[key]) for key in names }
+
+def shard_keys(names: dict, shards: int) -> list:
+    ''' splits the keys of a names dictionary into shards holding similar numbers of connections, the same names always give the same shards '''
+    loads = [0] * shards
+    sharded_keys = [ list() for _ in range(shards) ]
+    for key in sorted(names, key=lambda key: -len(names[key])):
+        shard = loads.index(min(loads))
+        sharded_keys[shard].append(key)
+        loads[shard] += len(names[key])
+    return sharded_keys
+
+def road_shard(shard: tuple) -> tuple:
+    ''' groups one shard of (name, streetclas) connections into roads, followed by single segment roads, and computes their statistics from only the shard's data
+    shard is (connection pairs of each group, single segment intids, crash records, segment lengths in feet by intid, street id by intid),
+    returns (roads of each group, statistics of every road, road lengths in miles, road x crash incidence, crash dates, crash ksi, crash injured) '''
+    groups, singles, records, segment_lengths, id_map = shard
+    group_roads = [ connected_roads(pairs) for pairs in groups ]
+    roads = [ road for found in group_roads for road in found ] + [ {segment} for segment in singles ]
+    segment_crashes = SegmentCrashes(records)
+    stats = RoadStats([ [ id_map[segment] for segment in road ] for road in roads ], segment_crashes)
+    lengths = road_lengths(roads, segment_lengths)
+    return group_roads, road_statistics(stats, lengths), lengths, stats.road_crashes, segment_crashes.dates, segment_crashes.ksi, segment_crashes.injured
+
+def build_roads_sharded(names: dict, singles: list, records: dict, segment_lengths: dict, id_map: dict, workers: int) -> tuple:
+    ''' build_roads and the road statistics sharded by (name, streetclas) across a process pool, singles are intids of single segment roads and records maps street ids to their crash records
+    returns (name_roads, statistics, lengths, (road x crash incidence, dates, ksi, injured)) with roads in names order followed by singles, as a serial run orders them '''
+    key_shards = shard_keys(names, workers)
+    size = max(math.ceil(len(singles) / workers), 1)
+    single_shards = [ singles[start * size:(start + 1) * size] for start in range(workers) ]
+
+    shards = list()
+    for keys, shard_singles in zip(key_shards, single_shards):
+        # each worker is sent only the connection pairs, crashes and lengths of its own segments
+        shard_segments = sorted(set(segment for key in keys for pair in names[key] for segment in pair) | set(shard_singles))
+        shards.append((
+            [ list(names[key]) for key in keys ],
+            shard_singles,
+            [ record for segment in shard_segments for record in records.get(id_map[segment], ()) ],
+            { segment: segment_lengths.get(segment) for segment in shard_segments },
+            { segment: id_map[segment] for segment in shard_segments }
+        ))
+    with process_pool(workers) as executor:
+        results = list(executor.map(road_shard, shards))
+
+    # (shard, row) of every road in the order of a serial run
+    name_roads = dict()
+    positions = dict()
+    single_rows = list()
+    for index, (keys, result) in enumerate(zip(key_shards, results)):
+        row = 0
+        for key, roads in zip(keys, result[0]):
+            name_roads[key] = roads
+            positions[key] = (index, row)
+            row += len(roads)
+        single_rows.append(row)
+    order = list()
+    for key in names:
+        index, row = positions[key]
+        order.extend((index, row + offset) for offset in range(len(name_roads[key])))
+    for index, shard_singles in enumerate(single_shards):
+        order.extend((index, single_rows[index] + offset) for offset in range(len(shard_singles)))
+
+    statistics = [ results[index][1][row] for index, row in order ]
+    lengths = np.array([ results[index][2][row] for index, row in order ], dtype=np.float64)
+    row_offsets = np.cumsum([0] + [ len(result[1]) for result in results ])
+    crash_offsets = np.cumsum([0] + [ len(result[5]) for result in results ])
+    incidence = Incidence.stack([ result[3] for result in results ], crash_offsets[:-1]).take([ row_offsets[index] + row for index, row in order ])
+    trend_crashes = (
+        incidence,
+        np.concatenate([ result[4] for result in results ]),
+        np.concatenate([ result[5] for result in results ]),
+        np.concatenate([ result[6] for result in results ])
+    )
+    return { key: name_roads[key] for key in names }, statistics, lengths, trend_crashes
+
+def street_index_current() -> bool:
+    ''' whether street_data.sqlite should be read, an index older than street_data.json was left by an earlier analytics.py run and is ignored '''
+    return USE_STREET_INDEX and os.path.exists(STREETINDEX) and (not os.path.exists(output_path(STREETDATA)) or os.path.getmtime(STREETINDEX) >= os.path.getmtime(output_path(STREETDATA)))
+
+def segment_crash_records() -> dict:
+    ''' map of street segment id to its (street_id, crash_id, ksi, injured, date) crash records, from street_data.sqlite or street_data.json '''
+    if street_index_current():
+        street_index = StreetIndex()
+        try:
+            source = list(street_index.segment_crash_records())
+        finally:
+            street_index.close()
+    else:
+        source = street_data_records(load_json_output(STREETDATA))
+    records = dict()
+    for record in source:
+        records.setdefault(int(record[0]), list()).append(record)
+    return records
 
 def road_length(cursor: psycopg2.extensions.cursor, segments: set) -> float:
     ''' returns length of entire road in miles '''
@@ -244,101 +600,148 @@ WHERE intid = {}
 
     return total_length / FEETPERMILE
 
-if __name__ == '__main__':
+def main(cursor: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection) -> None:
+    ''' builds roads from connected street segments and writes the road outputs '''
     print("connected_road_data.py: Gathering crash data for connected roads")
-    cursor, conn = db_setup()
     roads = dict()
-    names = dict()
+
+    segments = SegmentTable.cached(cursor) if USE_SEGMENT_TABLE else None
 
     # dictionary mapping of each intid to its two intersections
-    intersection_map = get_intersection_map(cursor)
+    if segments is not None:
+        intersection_map = segments.intersection_map()
+    else:
+        intersection_map = get_intersection_map(cursor)
     # get list of all connected segments
-    connections = get_connections(cursor)
+    if segments is not None and IN_MEMORY_CONNECTIONS:
+        adjacency = segment_adjacency(segments)
+        connections = connections_from_segments(segments, adjacency)
+        nonconnections = nonconnections_from_segments(segments, adjacency)
+    else:
+        connections = get_connections(cursor)
+        nonconnections = get_nonconnections(cursor)
 
     # parse connections list, create name dictionary that maps each street names to all street segment connections with that street name
-    for name, ida, intida, idb, intidb, intersectiona, intersectionb, streetclas in connections:
-        ida = int(ida)
-        idb = int(idb)
-        intida = int(intida)
-        intidb = int(intidb)
-        intersectiona = int(intersectiona)
-        intersectionb = int(intersectionb)
-        key = (name,streetclas)
-
-        if not key in names:
-            names[key] = dict()
-        names[key][(intida,intidb)] = (intersectiona, intersectionb)
-        names[key][(intidb,intida)] = (intersectiona, intersectionb)
-
-    # finds all roads (sets of connected street segments of the same name) with a given street name, adds this list of sets to the names dictionary
-    for name in names:
-        name = names[name]
-        connected_segments = list()
-        for intida, intidb in name:
-            if len(connected_segments) == 0:
-                connected_segments.append( create_road(intida,intidb,name) )
-            else:
-                present = False
-                for connected_segment in connected_segments:
-                    if intida in connected_segment or intidb in connected_segment:
-                        present = True
-                        break
-                if not present:
-                    connected_segments.append( create_road(intida,intidb,name) )
-        name['roads'] = connected_segments
+    names = names_from_connections(connections)
+
+    # finds all roads (sets of connected street segments of the same name) for every street name and class
+    sharded_stats = ROAD_WORKERS > 1 and VECTORIZED_STATS and segments is not None
+    if sharded_stats:
+        records = segment_crash_records()
+        name_roads, shard_statistics, lengths, trend_crashes = build_roads_sharded(names, [ int(street[0]) for street in nonconnections ], records, segments.length_map(), segments.id_map(), ROAD_WORKERS)
+    else:
+        name_roads = build_roads(names)
     
     # adds each road to the roads dictionary
-    road_id = 1
+    road_number = 1
     for name in names:
-        streets = names[name]['roads']
+        streets = name_roads[name]
         for street in streets:
+            road_id = stable_road_id(street) if STABLE_ROAD_IDS else road_number
             roads[road_id] = dict()
             roads[road_id]['name'] = name[0]
             roads[road_id]['segments'] = street
             roads[road_id]['intersections']  = set(map(lambda x: intersection_map[x][0], street))
             roads[road_id]['intersections'] |= set(map(lambda x: intersection_map[x][1], street))
-            road_id += 1
+            road_number += 1
 
     # adds all street segments to the roads dictionary as single-segment roads that were not previously 
-    for street in get_nonconnections(cursor):
+    for street in nonconnections:
+        road_id = stable_road_id([int(street[0])]) if STABLE_ROAD_IDS else road_number
         roads[road_id] = dict()
         roads[road_id]['name'] = street[3]
         roads[road_id]['segments'] = set( [int(street[0])] )
         roads[road_id]['intersections'] = set([int(street[1]), int(street[2])])
-        road_id += 1
+        road_number += 1
 
     street_data = {}
     map_dict = {}
-    map_ids_intid(cursor, map_dict)
-
-    with open(STREETDATA, 'r') as f:
-        street_data = json.load(f)
-
-    # calculate ksi, injury, crash statistics for each road
-    for road in roads:
-        roads[road]['ksi'], roads[road]['injured'], roads[road]['crashes'] = analyze_segment(roads[road]['segments'], street_data, map_dict)
-        length = road_length(cursor, roads[road]['segments'])
-        roads[road]['ksi/mile'] = roads[road]['ksi'] / length
-        roads[road]['injured/mile'] = roads[road]['injured'] / length
-        roads[road]['crashes/mile'] = roads[road]['crashes'] / length
-        roads[road]['street_classification'] = set()
-        for segment in roads[road]['segments']:
-            roads[road]['street_classification'].add(intersection_map[segment][2])
-        roads[road]['segments'] = list(roads[road]['segments'])
-        roads[road]['street_classification'] = list(roads[road]['street_classification'])
-        roads[road]['intersections'] = list(roads[road]['intersections'])
+    if segments is not None:
+        map_dict = segments.id_map()
+    else:
+        map_ids_intid(cursor, map_dict)
+
+    street_index = None
+    # sharded statistics already read the crash records for the workers
+    if not sharded_stats:
+        if street_index_current():
+            street_index = StreetIndex()
+        else:
+            street_data = load_json_output(STREETDATA)
+
+    # the street index is only read while road statistics are computed
+    try:
+        if sharded_stats:
+            road_statistics_map = dict(zip(roads, shard_statistics))
+            if TIME_TRENDS:
+                segment_crashes = SegmentCrashes(record for street_records in records.values() for record in street_records)
+        elif VECTORIZED_STATS:
+            if street_index is not None:
+                segment_crashes = SegmentCrashes(street_index.segment_crash_records())
+            else:
+                segment_crashes = SegmentCrashes.from_street_data(street_data)
+            if segments is not None:
+                lengths = road_lengths([ roads[road]['segments'] for road in roads ], segments.length_map())
+            else:
+                lengths = np.array([ road_length(cursor, roads[road]['segments']) for road in roads ])
+            road_stats = RoadStats([ [ map_dict[segment] for segment in roads[road]['segments'] ] for road in roads ], segment_crashes)
+            road_statistics_map = dict(zip(roads, road_statistics(road_stats, lengths)))
+
+        if VECTORIZED_STATS and TIME_TRENDS:
+            print("connected_road_data.py: Writing segment and road trends")
+            segment_ids = list(segment_crashes.segment_index)
+            if segments is not None:
+                segment_lengths = [ feet_to_mile(segments.length(segment)) if segments.length(segment) else None for segment in segment_ids ]
+            elif street_index is not None:
+                index_lengths = street_index.segment_lengths()
+                segment_lengths = [ index_lengths.get(segment) for segment in segment_ids ]
+            else:
+                segment_lengths = [ street_data[str(segment)]['length'] for segment in segment_ids ]
+            write_trends(SEGMENTTRENDS, segment_ids, segment_lengths, segment_time_index(segment_crashes))
+            write_trends(ROADTRENDS, list(roads), lengths, TimeIndex(*trend_crashes) if sharded_stats else road_time_index(road_stats))
+
+        # calculate ksi, injury, crash statistics for each road
+        for road in roads:
+            if VECTORIZED_STATS:
+                roads[road]['ksi'], roads[road]['injured'], roads[road]['crashes'], roads[road]['ksi/mile'], roads[road]['injured/mile'], roads[road]['crashes/mile'] = road_statistics_map[road]
+            else:
+                if street_index is not None:
+                    roads[road]['ksi'], roads[road]['injured'], roads[road]['crashes'] = analyze_segment_indexed(roads[road]['segments'], street_index, map_dict)
+                else:
+                    roads[road]['ksi'], roads[road]['injured'], roads[road]['crashes'] = analyze_segment(roads[road]['segments'], street_data, map_dict)
+                if segments is not None:
+                    length = segments.road_length(roads[road]['segments'])
+                else:
+                    length = road_length(cursor, roads[road]['segments'])
+                roads[road]['ksi/mile'] = roads[road]['ksi'] / length
+                roads[road]['injured/mile'] = roads[road]['injured'] / length
+                roads[road]['crashes/mile'] = roads[road]['crashes'] / length
+            roads[road]['street_classification'] = set()
+            for segment in roads[road]['segments']:
+                roads[road]['street_classification'].add(intersection_map[segment][2])
+            roads[road]['segments'] = list(roads[road]['segments'])
+            roads[road]['street_classification'] = list(roads[road]['street_classification'])
+            roads[road]['intersections'] = list(roads[road]['intersections'])
+    finally:
+        if street_index is not None:
+            street_index.close()
 
     print("connected_road_data.py: Writing connected road data")
+    METRICS.add_rows('connected_road_data', len(roads))
 
     # write roads dictionary to JSON file
-    with open(ROADSJSON, 'w') as f:
-        f.write(json.dumps(roads, default=str, indent=4))
+    write_json_records(ROADSJSON, roads.items())
+
+    if STABLE_ROAD_IDS and REUSE_GEOMETRY:
+        geometries = stored_road_geometries(cursor, roads)
+    else:
+        geometries = road_geometries(cursor, [ roads[road]['segments'] for road in roads ], ROAD_WORKERS)
 
     # write roads to csv
     with open(ROADSCSV, 'w') as f:
         writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         writer.writerow(['roadid','geom','name', 'street_classification', 'relevant_road', 'ksi','injured','crashes','ksi/mile','injured/mile','crashes/mile'])
-        for road in roads:
+        for road, geometry in zip(roads, geometries):
             classes = roads[road]['street_classification']
             if 'CO' in classes or 'MA' in classes or 'MI' in classes or 'EX' in classes:
                 relevant_road = 'true'
@@ -351,7 +754,7 @@ if __name__ == '__main__':
                 road_class = classes[0]
             writer.writerow(
                 [road, 
-                create_road_geometry(cursor, list(roads[road]['segments'])),
+                geometry,
                 roads[road]['name'],
                 road_class,
                 relevant_road,
@@ -362,4 +765,11 @@ if __name__ == '__main__':
                 roads[road]['injured/mile'],
                 roads[road]['crashes/mile']
                 ])
-    conn.commit()
\ No newline at end of file
+    geometries.close()
+    conn.commit()
+
+if __name__ == '__main__':
+    cursor, conn = db_setup()
+    with METRICS.stage('connected_road_data'):
+        main(cursor, conn)
+    METRICS.write()
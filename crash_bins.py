@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+'''
+crash_bins.py: aggregates geocoded crashes into square and hexagonal grid cells at several resolutions so map layers can draw a few thousand cells instead of every crash
+
+Run directly to rebuild the bins from crash_locations.json.
+
+Outputs:
+crash_bins.csv: crashes, ksi and injured in every occupied cell of every grid, with the longitude and latitude of the cell's center
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import csv
+import numpy as np
+from segment_index import local_feet, local_lonlat
+from utils import load_json_output
+
+# Files written
+CRASHBINS = 'data/crash_bins.csv'
+CRASHLOCATIONJSON = 'data/crash_locations.json'
+
+# Grid shapes and cell sizes in feet (side of a square, distance between neighbouring hexagon centers)
+BIN_SHAPES = ('square', 'hex')
+BIN_SIZES = (250, 500, 1000, 2640)
+
+# Longitude/latitude every grid is anchored to so cells stay put between runs (downtown San Jose)
+BIN_ORIGIN = np.array([-121.8863, 37.3382])
+
+SQRT3 = np.sqrt(3.0)
+
+def square_cells(xy: np.ndarray, size: float) -> np.ndarray:
+    ''' (column, row) of the square cell holding each point '''
+    return np.floor(xy / size).astype(np.int64)
+
+def square_centers(cells: np.ndarray, size: float) -> np.ndarray:
+    ''' center in feet of each square cell '''
+    return (cells + 0.5) * size
+
+def hex_cells(xy: np.ndarray, size: float) -> np.ndarray:
+    ''' axial (q, r) coordinates of the pointy-top hexagon holding each point '''
+    radius = size / SQRT3
+    q = (SQRT3 / 3.0 * xy[:, 0] - xy[:, 1] / 3.0) / radius
+    r = (2.0 / 3.0 * xy[:, 1]) / radius
+    # round the cube coordinates (q, r, -q-r), then fix whichever moved furthest so they still sum to 0
+    s = -q - r
+    rounded_q = np.round(q)
+    rounded_r = np.round(r)
+    rounded_s = np.round(s)
+    q_error = np.abs(rounded_q - q)
+    r_error = np.abs(rounded_r - r)
+    s_error = np.abs(rounded_s - s)
+    fix_q = (q_error > r_error) & (q_error > s_error)
+    fix_r = ~fix_q & (r_error > s_error)
+    rounded_q = np.where(fix_q, -rounded_r - rounded_s, rounded_q)
+    rounded_r = np.where(fix_r, -rounded_q - rounded_s, rounded_r)
+    return np.column_stack((rounded_q, rounded_r)).astype(np.int64)
+
+def hex_centers(cells: np.ndarray, size: float) -> np.ndarray:
+    ''' center in feet of each hexagon '''
+    radius = size / SQRT3
+    return np.column_stack((radius * SQRT3 * (cells[:, 0] + cells[:, 1] / 2.0), radius * 1.5 * cells[:, 1]))
+
+CELLS = {
+    'square': (square_cells, square_centers),
+    'hex': (hex_cells, hex_centers)
+}
+
+def bin_crashes(xy: np.ndarray, ksi: np.ndarray, injured: np.ndarray, shape: str, size: float) -> tuple:
+    ''' (cells, centers in feet, crashes, ksi, injured) for every occupied cell of a grid '''
+    cell_function, center_function = CELLS[shape]
+    # cells are packed into one integer each because np.unique over rows is much slower than over a flat array
+    keys, inverse = np.unique(cell_function(xy, size) @ np.array([1 << 32, 1], dtype=np.int64) + (1 << 31), return_inverse=True)
+    cells = np.column_stack((keys >> 32, (keys & 0xffffffff) - (1 << 31)))
+    inverse = inverse.reshape(-1)
+    return (
+        cells,
+        center_function(cells, size),
+        np.bincount(inverse, minlength=len(cells)),
+        np.bincount(inverse, weights=ksi, minlength=len(cells)).astype(np.int64),
+        np.bincount(inverse, weights=injured, minlength=len(cells)).astype(np.int64)
+    )
+
+def located_crashes(crash_data: dict) -> tuple:
+    ''' (longitude/latitude, ksi, injured) arrays of every crash with a location '''
+    located = [ crash for crash in crash_data.values() if crash.get('latitude') is not None and crash.get('longitude') is not None ]
+    return (
+        np.array([ (crash['longitude'], crash['latitude']) for crash in located ], dtype=np.float64).reshape(-1, 2),
+        np.array([ crash['ksi'] for crash in located ], dtype=np.int64),
+        np.array([ crash['injured'] for crash in located ], dtype=np.int64)
+    )
+
+def write_crash_bins(path: str, crash_data: dict, shapes: tuple = BIN_SHAPES, sizes: tuple = BIN_SIZES) -> None:
+    ''' writes the occupied cells of every grid shape and size for the located crashes of crash_data '''
+    lonlat, ksi, injured = located_crashes(crash_data)
+    xy = local_feet(lonlat, BIN_ORIGIN)
+    with open(path, 'w') as f:
+        writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['shape','size','cell_x','cell_y','latitude','longitude','crashes','ksi','injured'])
+        for shape in shapes:
+            for size in sizes:
+                cells, centers, cell_crashes, cell_ksi, cell_injured = bin_crashes(xy, ksi, injured, shape, size)
+                center_lonlat = local_lonlat(centers, BIN_ORIGIN)
+                writer.writerows(zip(
+                    [shape] * len(cells),
+                    [size] * len(cells),
+                    cells[:, 0].tolist(),
+                    cells[:, 1].tolist(),
+                    center_lonlat[:, 1].tolist(),
+                    center_lonlat[:, 0].tolist(),
+                    cell_crashes.tolist(),
+                    cell_ksi.tolist(),
+                    cell_injured.tolist()
+                ))
+
+if __name__ == '__main__':
+    print("crash_bins.py: Binning crash locations")
+    write_crash_bins(CRASHBINS, load_json_output(CRASHLOCATIONJSON))
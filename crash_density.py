@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+'''
+crash_density.py: kernel density rasters of ksi and injury weighted crash locations in the project CRS (EPSG 2227, California zone 3 in US survey feet)
+
+Located crashes from crash_locations.json are projected with a NumPy Lambert conformal conic projection, binned onto a grid,
+and smoothed with a Gaussian kernel applied in the frequency domain.
+
+Outputs:
+crash_density.npy: float32 array of shape (layers, rows, columns), row 0 is the northern edge, values are weight per square mile
+crash_density.json: layer names, CRS, grid origin, cell size and bandwidth needed to place the raster
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import sys
+import json
+import numpy as np
+from metrics import METRICS
+from utils import load_json_output, FEETPERMILE
+
+# Files read and written
+CRASHLOCATIONJSON = 'data/crash_locations.json'
+CRASHDENSITY = 'data/crash_density.npy'
+CRASHDENSITYMETA = 'data/crash_density.json'
+
+# Side of a raster cell and standard deviation of the Gaussian kernel, in feet
+CELL_SIZE = 100.0
+BANDWIDTH = 500.0
+
+# Crash fields a density layer is computed for, 'crashes' weighs every crash equally
+DENSITY_LAYERS = ('ksi', 'injured', 'crashes')
+
+# The grid extends this many bandwidths past the outermost crashes so the kernel is not cut off or wrapped around
+PADDING_BANDWIDTHS = 4.0
+
+# Most rows or columns the grid may have, about 75 miles at the default cell size, a crash located far outside the city would otherwise exhaust memory
+MAX_GRID_CELLS = 4000
+
+US_SURVEY_FOOT = 1200.0 / 3937.0
+
+# NAD83 / California zone 3 (ftUS), the GRS80 ellipsoid's difference from WGS84 is far below a cell
+EPSG_2227 = {
+    'semi_major_axis': 6378137.0,
+    'inverse_flattening': 298.257222101,
+    'standard_parallels': (38.43333333333333, 37.06666666666667),
+    'latitude_of_origin': 36.5,
+    'central_meridian': -120.5,
+    'false_easting': 2000000.0 / US_SURVEY_FOOT,
+    'false_northing': 500000.0 / US_SURVEY_FOOT,
+    'unit': US_SURVEY_FOOT
+}
+
+def lambert_conformal_conic(lon: np.ndarray, lat: np.ndarray, projection: dict = EPSG_2227) -> tuple:
+    ''' (x, y) in projection units of longitude/latitude arrays, the ellipsoidal two standard parallel Lambert conformal conic of EPSG guidance note 7-2 '''
+    a = projection['semi_major_axis']
+    flattening = 1.0 / projection['inverse_flattening']
+    e = np.sqrt(2.0 * flattening - flattening ** 2)
+
+    def m(phi):
+        return np.cos(phi) / np.sqrt(1.0 - (e * np.sin(phi)) ** 2)
+
+    def t(phi):
+        return np.tan(np.pi / 4.0 - phi / 2.0) / ((1.0 - e * np.sin(phi)) / (1.0 + e * np.sin(phi))) ** (e / 2.0)
+
+    phi_1, phi_2 = np.radians(projection['standard_parallels'])
+    phi_0 = np.radians(projection['latitude_of_origin'])
+    n = (np.log(m(phi_1)) - np.log(m(phi_2))) / (np.log(t(phi_1)) - np.log(t(phi_2)))
+    F = m(phi_1) / (n * t(phi_1) ** n)
+    rho_0 = a * F * t(phi_0) ** n
+
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    theta = n * (np.radians(np.asarray(lon, dtype=np.float64)) - np.radians(projection['central_meridian']))
+    rho = a * F * t(phi) ** n
+    x = rho * np.sin(theta) / projection['unit'] + projection['false_easting']
+    y = (rho_0 - rho * np.cos(theta)) / projection['unit'] + projection['false_northing']
+    return x, y
+
+def crash_points(crash_data: dict, layers: tuple = DENSITY_LAYERS) -> tuple:
+    ''' (x, y, weights) of every located crash in EPSG 2227, weights has one row per layer '''
+    located = [ crash for crash in crash_data.values() if crash.get('latitude') is not None and crash.get('longitude') is not None ]
+    x, y = lambert_conformal_conic(
+        np.array([ crash['longitude'] for crash in located ], dtype=np.float64),
+        np.array([ crash['latitude'] for crash in located ], dtype=np.float64)
+    )
+    weights = np.array([ [ 1 if layer == 'crashes' else crash[layer] for crash in located ] for layer in layers ], dtype=np.float64).reshape(len(layers), len(located))
+    return x, y, weights
+
+def density_grid(x: np.ndarray, y: np.ndarray, weights: np.ndarray, cell_size: float = CELL_SIZE, bandwidth: float = BANDWIDTH, max_cells: int = MAX_GRID_CELLS) -> tuple:
+    ''' (density, west edge, north edge) where density is a (layers, rows, columns) array of kernel density in weight per square mile, raises ValueError if either side of the grid exceeds max_cells '''
+    padding = PADDING_BANDWIDTHS * bandwidth
+    west = np.floor((x.min() - padding) / cell_size) * cell_size if len(x) else 0.0
+    south = np.floor((y.min() - padding) / cell_size) * cell_size if len(y) else 0.0
+    columns = int(np.ceil(((x.max() if len(x) else 0.0) + padding - west) / cell_size)) + 1
+    rows = int(np.ceil(((y.max() if len(y) else 0.0) + padding - south) / cell_size)) + 1
+    north = south + rows * cell_size
+    if rows > max_cells or columns > max_cells:
+        raise ValueError("a {} x {} cell grid is needed to cover crashes from x {:.0f} to {:.0f} and y {:.0f} to {:.0f} feet, more than MAX_GRID_CELLS = {} per side, check crash_locations.json for misplaced crashes or raise CELL_SIZE".format(
+            rows, columns, x.min(), x.max(), y.min(), y.max(), max_cells))
+
+    # row 0 is the northern edge of the grid, as in a GeoTIFF
+    cells = (rows - 1 - np.floor((y - south) / cell_size).astype(np.int64)) * columns + np.floor((x - west) / cell_size).astype(np.int64)
+
+    # Fourier transform of a Gaussian with standard deviation bandwidth, a separable product over the two axes
+    frequency_rows = np.fft.fftfreq(rows, d=cell_size)
+    frequency_columns = np.fft.rfftfreq(columns, d=cell_size)
+    kernel = np.exp(-2.0 * (np.pi * bandwidth) ** 2 * frequency_rows ** 2)[:, None] * np.exp(-2.0 * (np.pi * bandwidth) ** 2 * frequency_columns ** 2)[None, :]
+
+    cell_area_miles = (cell_size / FEETPERMILE) ** 2
+    density = np.empty((len(weights), rows, columns), dtype=np.float32)
+    for layer in range(len(weights)):
+        counts = np.bincount(cells, weights=weights[layer], minlength=rows * columns).reshape(rows, columns)
+        smoothed = np.fft.irfft2(np.fft.rfft2(counts) * kernel, s=(rows, columns))
+        # the transform leaves rounding noise around zero far from any crash
+        density[layer] = np.maximum(smoothed, 0.0) / cell_area_miles
+    return density, west, north
+
+def write_density(crash_data: dict, path: str = CRASHDENSITY, meta_path: str = CRASHDENSITYMETA, layers: tuple = DENSITY_LAYERS, cell_size: float = CELL_SIZE, bandwidth: float = BANDWIDTH) -> None:
+    ''' writes the density raster of every layer and the metadata needed to place it '''
+    x, y, weights = crash_points(crash_data, layers)
+    density, west, north = density_grid(x, y, weights, cell_size, bandwidth)
+    np.save(path, density)
+    with open(meta_path, 'w') as f:
+        json.dump({
+            'layers': list(layers),
+            'crs': 'EPSG:2227',
+            'units': 'weight per square mile',
+            'shape': list(density.shape),
+            'cell_size': cell_size,
+            'bandwidth': bandwidth,
+            # GDAL style geotransform: west edge, column width, row rotation, north edge, column rotation, row height
+            'geotransform': [west, cell_size, 0.0, north, 0.0, -cell_size],
+            'crashes': len(x)
+        }, f, indent=4)
+
+def main() -> None:
+    ''' computes the crash density rasters from crash_locations.json '''
+    print("crash_density.py: Computing crash density rasters")
+    crash_data = load_json_output(CRASHLOCATIONJSON)
+    METRICS.add_rows('crash_density', len(crash_data))
+    try:
+        write_density(crash_data)
+    except ValueError as e:
+        print("Error: crash_density.py: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    with METRICS.stage('crash_density'):
+        main()
+    METRICS.write()
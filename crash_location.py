@@ -8,41 +8,105 @@ crash_locations.json: for each crash will include actual coordinates, intersecti
 crash_locations.csv: the longitude and lattitude for each crash
 injured.csv: the longitude and lattitude of each injury
 ksi.csv: the longitude and lattitude of each injury
+crash_points.csv: the longitude and lattitude of each located crash weighted by its ksi and injured
+crash_bins.csv: crashes, ksi and injured aggregated into square and hexagonal grids (see crash_bins.py)
 '''
 __author__ = "Jack Fox"
 __email__ = "jfox13@nd.edu"
 
-import json
+import os
+import sys
 import csv
 import psycopg2
-from utils import db_setup, progress_bar_setup, progress_bar_increment, progress_bar_finish, clean_severity, read_crash_csv, calc_KSI, calc_total_injured
+from metrics import METRICS
+from crash_store import CrashStore, network_fingerprint
+from crash_bins import CRASHBINS, write_crash_bins
+from offline_locator import NETWORKSNAPSHOT, NetworkSnapshot, OfflineLocator, location_mismatches, report_mismatches
+from utils import QueryCache, db_setup, db_pool, run_with_pool, progress_bar_setup, progress_bar_increment, progress_bar_finish, clean_severity, read_crash_csv, write_json_records, calc_KSI, calc_total_injured
 
 # Files written
 OUTPUTJSON = "data/crash_locations.json"
 OUTPUTCSV = "data/crash_locations.csv"
 OUTPUTINJURED = "data/injured.csv"
 OUTPUTKSI = "data/ksi.csv"  
-    
-def add_gps(crash_data: dict, crash: str, cursor: psycopg2.extensions.cursor) -> None:
-    ''' Adds the lattitude and longitude of each crash to the crash_data dictionary for a specified crash '''
+OUTPUTPOINTS = "data/crash_points.csv"
+
+# Also write ksi.csv and injured.csv, which repeat a crash's location once per person, for map layers that can not use weights
+WRITE_PERSON_POINTS = True
+
+# Aggregate located crashes into the grids of crash_bins.py
+BIN_CRASHES = True
+
+# Number of crashes geocoded per query, a value of 1 runs one query per crash
+BATCH_SIZE = 1000
+
+# Optional file used to persist findcrashlocation results between runs, None keeps the cache in memory only
+QUERY_CACHE_FILE = None
+
+# Number of worker threads (each with its own connection) geocoding chunks in parallel, 1 geocodes serially
+WORKERS = 1
+
+# Reuse locations stored by previous runs for crashes whose location fields have not changed
+INCREMENTAL = True
+# Drop every stored location when the street network changes
+CHECK_NETWORK_VERSION = True
+
+# Locate crashes in-process with offline_locator.py on a cached snapshot of the street network instead of calling findcrashlocation
+OFFLINE = False
+# Number of offline crash locations compared against findcrashlocation, 0 disables the cross-check
+CROSS_CHECK = 0
+
+def clear_gps(crash_data: dict, crash: str) -> None:
+    ''' marks a crash as having no known location '''
+    crash_data[crash]['int_id'] = None
+    crash_data[crash]['longitude'] = None
+    crash_data[crash]['latitude'] = None
+
+def gps_query_inputs(crash_data: dict, crash: str) -> tuple:
+    ''' returns the (direction, distance) findcrashlocation should be called with for a crash, or None if the crash can not be located '''
     if not crash_data[crash]['distance'] or not crash_data[crash]['direction']:
-        crash_data[crash]['int_id'] = None
-        crash_data[crash]['longitude'] = None
-        crash_data[crash]['latitude'] = None
-        return
+        return None
 
     try:
         distance = int(crash_data[crash]['distance'])
     except:
-        crash_data[crash]['int_id'] = None
-        crash_data[crash]['longitude'] = None
-        crash_data[crash]['latitude'] = None
-        return
+        return None
 
     direction = crash_data[crash]['direction']
     if direction == 'At':
         direction = 'South'
-    
+    return direction, distance
+
+def set_gps(crash_data: dict, crash: str, record: tuple) -> None:
+    ''' fills in int_id, latitude and longitude for a crash from an (id, y, x) record '''
+    if not record or not record[0] or not record[1] or not record[2]:
+        clear_gps(crash_data, crash)
+        return
+
+    crash_data[crash]['int_id'] = record[0]
+    crash_data[crash]['latitude'] = record[1]
+    crash_data[crash]['longitude'] = record[2]
+
+def gps_cache_key(crash_data: dict, crash: str, inputs: tuple) -> tuple:
+    ''' key identifying the findcrashlocation lookup for a crash '''
+    return ('findcrashlocation', crash_data[crash]['intersection_id'], inputs[0], inputs[1])
+
+def add_gps(crash_data: dict, crash: str, cursor: psycopg2.extensions.cursor, cache: QueryCache = None) -> None:
+    ''' Adds the lattitude and longitude of each crash to the crash_data dictionary for a specified crash '''
+    inputs = gps_query_inputs(crash_data, crash)
+    if not inputs:
+        clear_gps(crash_data, crash)
+        return
+
+    if cache is not None:
+        key = gps_cache_key(crash_data, crash, inputs)
+        set_gps(crash_data, crash, cache.get_or_query(key, lambda: query_gps(crash_data, crash, inputs, cursor)))
+    else:
+        set_gps(crash_data, crash, query_gps(crash_data, crash, inputs, cursor))
+
+def query_gps(crash_data: dict, crash: str, inputs: tuple, cursor: psycopg2.extensions.cursor) -> tuple:
+    ''' runs findcrashlocation for a single crash, returns the first (id, y, x) record or None '''
+    direction, distance = inputs
     query ="""
     SELECT
     Q.id,
@@ -60,29 +124,154 @@ def add_gps(crash_data: dict, crash: str, cursor: psycopg2.extensions.cursor) ->
     cursor.execute(query)
     record = cursor.fetchall()
 
-    if not record or not record[0] or not record[0][0] or not record[0][1] or not record[0][2]:
-        crash_data[crash]['int_id'] = None
-        crash_data[crash]['longitude'] = None
-        crash_data[crash]['latitude'] = None
-        return
+    return record[0] if record else None
 
-    crash_data[crash]['int_id'] = record[0][0]
-    crash_data[crash]['latitude'] = record[0][1]
-    crash_data[crash]['longitude'] = record[0][2]
+def locate_crashes(crash_inputs: list, cursor: psycopg2.extensions.cursor) -> dict:
+    ''' runs findcrashlocation for a list of (crash, intnum, direction, distance) tuples in a single query, returns a dictionary mapping each crash to its first (id, y, x) record '''
+    if not crash_inputs:
+        return dict()
 
-if __name__ == '__main__':
+    query ="""
+    SELECT
+    Q.crash_id,
+    Q.id,
+    pointy(Q.g) AS y,
+    pointx(Q.g) AS x
+    FROM (SELECT
+        C.crash_id,
+        intersections.id,
+        findcrashlocation(intersections.id, C.direction, C.distance) AS g
+    FROM unnest(%s::text[], %s::integer[], %s::text[], %s::integer[]) AS C(crash_id, intnum, direction, distance)
+    JOIN intersections ON intersections.intnum = C.intnum
+    ) AS Q;
+    """
+    cursor.execute(query, (
+        [str(i[0]) for i in crash_inputs],
+        [i[1] for i in crash_inputs],
+        [i[2] for i in crash_inputs],
+        [i[3] for i in crash_inputs]
+    ))
+
+    records = dict()
+    for crash_id, int_id, y, x in cursor.fetchall():
+        # the per crash query only ever looks at the first intersection returned
+        if crash_id not in records:
+            records[crash_id] = (int_id, y, x)
+    return records
+
+def gps_records(crash_data: dict, crashes: list, cursor: psycopg2.extensions.cursor, cache: QueryCache = None) -> dict:
+    ''' maps each crash of a chunk that can be located to its (id, y, x) record (or None) using one query for the whole chunk, crashes sharing the same lookup are only queried once '''
+    crash_keys = dict()
+    for crash in crashes:
+        inputs = gps_query_inputs(crash_data, crash)
+        if inputs:
+            crash_keys[crash] = gps_cache_key(crash_data, crash, inputs)
+
+    resolved = dict()
+    pending = list()
+    for key in dict.fromkeys(crash_keys.values()):
+        record = cache.get(key, QueryCache.MISSING) if cache is not None else QueryCache.MISSING
+        if record is QueryCache.MISSING:
+            pending.append(key)
+        else:
+            resolved[key] = record
+
+    # each distinct lookup is sent once, using its position in pending as the crash id
+    records = locate_crashes([ (index, key[1], key[2], key[3]) for index, key in enumerate(pending) ], cursor)
+    for index, key in enumerate(pending):
+        resolved[key] = records.get(str(index))
+        if cache is not None:
+            cache.put(key, resolved[key])
+
+    return { crash: resolved[crash_keys[crash]] for crash in crash_keys }
+
+def offline_gps_records(crash_data: dict, crashes: list, locator: OfflineLocator) -> dict:
+    ''' maps each crash of a chunk that can be located to its (id, y, x) record (or None) without querying postgres, equivalent to gps_records '''
+    records = dict()
+    for crash in crashes:
+        inputs = gps_query_inputs(crash_data, crash)
+        if inputs:
+            records[crash] = locator.locate(crash_data[crash]['intersection_id'], inputs[0], inputs[1])
+    return records
+
+def apply_gps_records(crash_data: dict, crashes: list, records: dict) -> None:
+    ''' Adds the lattitude and longitude found by gps_records to the crash_data dictionary for a chunk of crashes '''
+    for crash in crashes:
+        if crash in records:
+            set_gps(crash_data, crash, records[crash])
+        else:
+            clear_gps(crash_data, crash)
+
+def add_gps_batch(crash_data: dict, crashes: list, cursor: psycopg2.extensions.cursor, cache: QueryCache = None) -> None:
+    ''' Adds the lattitude and longitude of a chunk of crashes to the crash_data dictionary using one query for the whole chunk '''
+    apply_gps_records(crash_data, crashes, gps_records(crash_data, crashes, cursor, cache))
+
+def main(cursor: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection, crash_data: dict) -> None:
+    ''' geocodes every crash in crash_data and writes the crash location outputs '''
     print("crash_location.py: Producing crash locations point outputs")
-    cursor, conn = db_setup()
-    crash_data = read_crash_csv()
+    # without postgres an OFFLINE run works from the network snapshot left on disk by an earlier run
+    if cursor is None and not (OFFLINE and os.path.exists(NETWORKSNAPSHOT)):
+        print("Error: crash_location.py needs a database connection unless OFFLINE is set and {} exists".format(NETWORKSNAPSHOT), file=sys.stderr)
+        sys.exit(1)
+    cache = QueryCache(path=QUERY_CACHE_FILE)
+    snapshot = NetworkSnapshot.cached(cursor) if OFFLINE else None
 
-    total_crashes = len(crash_data)
+    # only crashes that are new or changed since the last run are sent to postgres
+    crashes = list(crash_data)
+    if INCREMENTAL:
+        network_version = network_fingerprint(cursor) if cursor is not None else snapshot.network_version
+        store = CrashStore(network_version=network_version if CHECK_NETWORK_VERSION else None)
+        cached_locations = store.cached_locations(crash_data)
+        for crash in crashes:
+            if crash in cached_locations:
+                set_gps(crash_data, crash, cached_locations[crash])
+        crashes = [ crash for crash in crashes if crash not in cached_locations ]
+        print("crash_location.py: Reusing {} stored crash locations".format(len(cached_locations)))
+
+    total_crashes = len(crashes)
+    METRICS.add_rows('crash_location', len(crash_data))
     i = 0
     progress_bar_setup()
-    for crash in crash_data:
-        i += 1
+    if OFFLINE:
+        locator = OfflineLocator(snapshot)
+        records = offline_gps_records(crash_data, crashes, locator)
+        apply_gps_records(crash_data, crashes, records)
+        i = total_crashes
         progress_bar_increment(i,total_crashes)
-        add_gps(crash_data,crash,cursor)
+        if CROSS_CHECK and cursor is not None:
+            sample = crashes[:CROSS_CHECK]
+            sql_records = gps_records(crash_data, sample, cursor)
+            sample_records = { crash: records[crash] for crash in sample if crash in records }
+            report_mismatches('crash_location.py', location_mismatches(sample_records, sql_records), len(sample), sample_records, sql_records)
+    elif WORKERS > 1:
+        # chunks are geocoded in parallel but applied in their original order so output matches a serial run
+        chunks = [ crashes[start:start+BATCH_SIZE] for start in range(0, total_crashes, max(BATCH_SIZE, 1)) ]
+        pool = db_pool(WORKERS)
+        results = run_with_pool(pool, WORKERS, lambda chunk, worker_cursor: gps_records(crash_data, chunk, worker_cursor, cache), chunks)
+        pool.closeall()
+        for chunk, records in zip(chunks, results):
+            apply_gps_records(crash_data, chunk, records)
+            for _ in chunk:
+                i += 1
+                progress_bar_increment(i,total_crashes)
+    elif BATCH_SIZE > 1:
+        for start in range(0, total_crashes, BATCH_SIZE):
+            chunk = crashes[start:start+BATCH_SIZE]
+            add_gps_batch(crash_data,chunk,cursor,cache)
+            for _ in chunk:
+                i += 1
+                progress_bar_increment(i,total_crashes)
+    else:
+        for crash in crashes:
+            i += 1
+            progress_bar_increment(i,total_crashes)
+            add_gps(crash_data,crash,cursor,cache)
     progress_bar_finish()
+    cache.close()
+
+    if INCREMENTAL:
+        store.save_locations(crash_data, crashes)
+        store.close()
 
     location_found = 0
     location_not_found = 0
@@ -92,11 +281,11 @@ if __name__ == '__main__':
         else:
             location_not_found += 1
     print("crash_location.py:\n\tCrash locations found = {}\n\t Crash locations not found = {}".format(location_found,location_not_found))
+    print("crash_location.py:\n\tQuery cache hits = {hits}\n\tQuery cache misses = {misses}\n\tQuery cache hit rate = {hit_rate:.1%}".format(**cache.stats()))
 
     print("crash_location.py: Writing crash locations point outputs")
 
-    with open(OUTPUTJSON, 'w') as f:
-        f.write(json.dumps(crash_data, default=str, indent=4))
+    write_json_records(OUTPUTJSON, crash_data.items())
     
     with open(OUTPUTCSV,'w') as f:
         writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
@@ -114,6 +303,28 @@ if __name__ == '__main__':
                 str(crash_data[crash]['date'])
             ])
 
+    with open(OUTPUTPOINTS, 'w') as f:
+        writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        writer.writerow(['crash_id','latitude','longitude','ksi','injured'])
+        for crash in crash_data:
+            # crashes without a location can not be drawn on a map
+            if crash_data[crash]['latitude'] is None or crash_data[crash]['longitude'] is None:
+                continue
+            writer.writerow([
+                crash,
+                crash_data[crash]['latitude'],
+                crash_data[crash]['longitude'],
+                crash_data[crash]['ksi'],
+                crash_data[crash]['injured']
+            ])
+
+    if BIN_CRASHES:
+        write_crash_bins(CRASHBINS, crash_data)
+
+    if not WRITE_PERSON_POINTS:
+        return
+
     with open(OUTPUTKSI, 'w') as f_ksi, open(OUTPUTINJURED, 'w') as f_injured :
         writer_ksi = csv.writer(f_ksi,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         writer_injured = csv.writer(f_injured,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
@@ -138,3 +349,9 @@ if __name__ == '__main__':
                     crash_data[crash]['longitude']
                 ])
                 injured_id += 1
+
+if __name__ == '__main__':
+    cursor, conn = db_setup() or (None, None)
+    with METRICS.stage('crash_location'):
+        main(cursor, conn, read_crash_csv())
+    METRICS.write()
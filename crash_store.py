@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+'''
+crash_store.py: local persistent store of crash geocoding and street results so unchanged crashes are not sent to postgres on every run
+
+Run directly to clear the store.
+
+Outputs:
+crash_store.sqlite: cached crash locations and crash streets keyed by crash id and a fingerprint of the crash's location fields
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import json
+import sqlite3
+import hashlib
+import threading
+import psycopg2
+
+# File the store is kept in
+CRASHSTORE = 'data/crash_store.sqlite'
+
+# Fingerprint the street network by hashing every segment and intersection with its geometry, a full scan of both tables on every run,
+# instead of from the tables' modification counters, which can miss edits made in the second before a run, before postgres reports them
+DEEP_NETWORK_CHECK = False
+
+# Street network fingerprints already computed by this process, keyed on the database they were read from and whether they are deep
+network_versions = dict()
+network_versions_lock = threading.Lock()
+
+def crash_fingerprint(crash: dict) -> str:
+    ''' fingerprint of the fields of a crash that determine its location (IntersectionId, Vehicle_Dir, Distance) '''
+    key = '{}|{}|{}'.format(crash['intersection_id'], crash['direction'], crash['distance'])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def network_fingerprint(cursor: psycopg2.extensions.cursor, refresh: bool = False, deep: bool = None) -> str:
+    ''' fingerprint of the street network (streetcenterlines and intersections), changes whenever a segment or intersection changes, read once per process and database unless refresh is set
+    by default it is built from the inserted, updated and deleted row counters postgres keeps for both tables, their storage files (which TRUNCATE replaces) and their largest ids,
+    deep (DEEP_NETWORK_CHECK unless given) hashes every row and geometry instead '''
+    if deep is None:
+        deep = DEEP_NETWORK_CHECK
+    if deep:
+        query ="""
+SELECT
+    md5(
+        (SELECT string_agg(concat_ws(',', id, intid, frominteri, tointerid, fullname, streetclas, munileft, muniright, md5(ST_AsBinary(geom))), ';' ORDER BY id) FROM streetcenterlines)
+        || '|' ||
+        (SELECT string_agg(concat_ws(',', id, intnum, intid, md5(ST_AsBinary(geom))), ';' ORDER BY id) FROM intersections)
+    );
+"""
+    else:
+        query ="""
+SELECT
+    md5(
+        (SELECT string_agg(concat_ws(',', relname, relid, pg_relation_filenode(relid), n_tup_ins, n_tup_upd, n_tup_del), ';' ORDER BY relname) FROM pg_stat_user_tables WHERE relid IN ('streetcenterlines'::regclass, 'intersections'::regclass))
+        || '|' ||
+        concat_ws(',', (SELECT max(id) FROM streetcenterlines), (SELECT max(id) FROM intersections))
+    );
+"""
+    database = (cursor.connection.dsn, deep)
+    with network_versions_lock:
+        if refresh or database not in network_versions:
+            cursor.execute(query)
+            network_versions[database] = cursor.fetchall()[0][0]
+        return network_versions[database]
+
+class CrashStore:
+    ''' sqlite backed store of per crash results, if network_version is given and differs from the version the store was built against every cached result is dropped '''
+
+    def __init__(self, path: str = CRASHSTORE, network_version: str = None) -> None:
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript("""
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS locations (
+    crash_id TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    int_id INTEGER,
+    latitude REAL,
+    longitude REAL
+);
+
+CREATE TABLE IF NOT EXISTS streets (
+    crash_id TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    streets TEXT
+);
+""")
+        if network_version is not None and network_version != self.network_version():
+            self.invalidate()
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('network_version', ?);", (network_version,))
+            self.connection.commit()
+
+    def network_version(self) -> str:
+        ''' version of the street network the stored results were built against '''
+        record = self.connection.execute("SELECT value FROM meta WHERE key = 'network_version';").fetchone()
+        return record[0] if record else None
+
+    def invalidate(self) -> None:
+        ''' drop every cached result '''
+        self.connection.execute("DELETE FROM locations;")
+        self.connection.execute("DELETE FROM streets;")
+        self.connection.execute("DELETE FROM meta;")
+        self.connection.commit()
+
+    def cached_locations(self, crash_data: dict) -> dict:
+        ''' map each crash whose location fields are unchanged to its stored (id, y, x) record, or None if it could not be located '''
+        locations = dict()
+        for crash_id, fingerprint, int_id, latitude, longitude in self.connection.execute("SELECT crash_id, fingerprint, int_id, latitude, longitude FROM locations;"):
+            if crash_id in crash_data and crash_fingerprint(crash_data[crash_id]) == fingerprint:
+                locations[crash_id] = (int_id, latitude, longitude) if int_id is not None else None
+        return locations
+
+    def save_locations(self, crash_data: dict, crashes: list) -> None:
+        ''' store the int_id, latitude and longitude found for a list of crashes '''
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO locations (crash_id, fingerprint, int_id, latitude, longitude) VALUES (?, ?, ?, ?, ?);",
+            ( (crash, crash_fingerprint(crash_data[crash]), crash_data[crash]['int_id'], crash_data[crash]['latitude'], crash_data[crash]['longitude']) for crash in crashes )
+        )
+        self.connection.commit()
+
+    def cached_streets(self, crash_data: dict) -> dict:
+        ''' map each crash whose location fields are unchanged to its stored list of streets '''
+        streets = dict()
+        for crash_id, fingerprint, street_list in self.connection.execute("SELECT crash_id, fingerprint, streets FROM streets;"):
+            if crash_id in crash_data and crash_fingerprint(crash_data[crash_id]) == fingerprint:
+                streets[crash_id] = json.loads(street_list)
+        return streets
+
+    def save_streets(self, crash_data: dict, street_lists: dict) -> None:
+        ''' store the streets found for each crash in a {crash: [street, ...]} dictionary '''
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO streets (crash_id, fingerprint, streets) VALUES (?, ?, ?);",
+            ( (crash, crash_fingerprint(crash_data[crash]), json.dumps(street_lists[crash])) for crash in street_lists )
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        ''' close the underlying sqlite connection '''
+        self.connection.close()
+
+if __name__ == '__main__':
+    print("crash_store.py: Clearing {}".format(CRASHSTORE))
+    store = CrashStore()
+    store.invalidate()
+    store.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''
+crash_trends.py: per period crash statistics for street segments and roads from a time sorted crash index
+
+Outputs:
+segment_trends.csv: crashes, ksi, injured and per mile rates for each street segment per year, per month and per rolling window of years
+road_trends.csv: the same statistics for each road
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import csv
+import numpy as np
+from road_stats import Incidence, SegmentCrashes, RoadStats
+
+# Files written
+SEGMENTTRENDS = 'data/segment_trends.csv'
+ROADTRENDS = 'data/road_trends.csv'
+
+# Lengths in years of the rolling windows reported
+ROLLING_YEARS = (3, 5)
+
+class TimeIndex:
+    ''' for every row (segment or road), the crashes on it sorted by date, stored as one (row, time) sorted key array with prefix sums of ksi and injured '''
+
+    def __init__(self, incidence: Incidence, dates: np.ndarray, ksi: np.ndarray, injured: np.ndarray) -> None:
+        rows = incidence.row_of_entries()
+        crashes = incidence.indices
+        dated = ~np.isnat(dates[crashes])
+        rows = rows[dated]
+        crashes = crashes[dated]
+        times = dates[crashes].astype(np.int64)
+
+        order = np.lexsort((times, rows))
+        self.rows = len(incidence)
+        self.times = times[order]
+        self.row_of_times = rows[order]
+        self.start = int(self.times.min()) if len(self.times) else 0
+        # every key of a row is smaller than every key of the next row
+        self.span = (int(self.times.max()) - self.start + 1) if len(self.times) else 1
+        self.keys = self.row_of_times * self.span + (self.times - self.start)
+        self.crash_years = dates[crashes][order].astype('datetime64[Y]').astype(np.int64) + 1970
+        self.crash_months = dates[crashes][order].astype('datetime64[M]').astype(np.int64) % 12 + 1
+        self.ksi_prefix = np.concatenate(([0], np.cumsum(ksi[crashes][order])))
+        self.injured_prefix = np.concatenate(([0], np.cumsum(injured[crashes][order])))
+
+    def years(self) -> list:
+        ''' every year with at least one crash '''
+        return sorted(set(self.crash_years.tolist()))
+
+    def window(self, start: np.datetime64, end: np.datetime64) -> tuple:
+        ''' (crashes, ksi, injured) arrays over every row for crashes dated in [start, end) '''
+        start = min(max(int(start.astype('datetime64[s]').astype(np.int64)) - self.start, 0), self.span)
+        end = min(max(int(end.astype('datetime64[s]').astype(np.int64)) - self.start, 0), self.span)
+        row_keys = np.arange(self.rows, dtype=np.int64) * self.span
+        first = np.searchsorted(self.keys, row_keys + start)
+        last = np.searchsorted(self.keys, row_keys + end)
+        return last - first, self.ksi_prefix[last] - self.ksi_prefix[first], self.injured_prefix[last] - self.injured_prefix[first]
+
+    def period_counts(self, period: str) -> tuple:
+        ''' (periods, crashes, ksi, injured) where the arrays are rows x periods, period is 'year' or 'month' '''
+        if period == 'year':
+            labels = self.crash_years.astype(str)
+        else:
+            labels = np.char.add(np.char.add(self.crash_years.astype(str), '-'), np.char.zfill(self.crash_months.astype(str), 2))
+        periods, period_index = np.unique(labels, return_inverse=True)
+        cells = self.row_of_times * len(periods) + period_index
+        size = self.rows * len(periods)
+        shape = (self.rows, len(periods))
+        ksi = np.diff(self.ksi_prefix)
+        injured = np.diff(self.injured_prefix)
+        return (
+            periods.tolist(),
+            np.bincount(cells, minlength=size).reshape(shape),
+            np.bincount(cells, weights=ksi, minlength=size).astype(np.int64).reshape(shape),
+            np.bincount(cells, weights=injured, minlength=size).astype(np.int64).reshape(shape)
+        )
+
+    def rolling(self, years: int) -> tuple:
+        ''' (periods, crashes, ksi, injured) rows x periods for the window of years ending in each year, periods are labeled "first-last" '''
+        periods = list()
+        crashes = list()
+        ksi = list()
+        injured = list()
+        for year in self.years():
+            window = self.window(np.datetime64('{}-01-01'.format(year - years + 1)), np.datetime64('{}-01-01'.format(year + 1)))
+            periods.append('{}-{}'.format(year - years + 1, year))
+            crashes.append(window[0])
+            ksi.append(window[1])
+            injured.append(window[2])
+        if not periods:
+            empty = np.zeros((self.rows, 0), dtype=np.int64)
+            return periods, empty, empty, empty
+        return periods, np.stack(crashes, axis=1), np.stack(ksi, axis=1), np.stack(injured, axis=1)
+
+def write_trends(path: str, ids: list, lengths: np.ndarray, index: TimeIndex) -> None:
+    ''' writes every non empty (id, period) cell of the yearly, monthly and rolling statistics of a time index to csv, lengths in miles '''
+    tables = [ ('year',) + index.period_counts('year'), ('month',) + index.period_counts('month') ]
+    for years in ROLLING_YEARS:
+        tables.append(('rolling_{}_year'.format(years),) + index.rolling(years))
+
+    with open(path, 'w') as f:
+        writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['id','period_type','period','crashes','ksi','injured','crashes/mile','ksi/mile','injured/mile'])
+        for period_type, periods, crashes, ksi, injured in tables:
+            rows, columns = np.nonzero(crashes)
+            for row, column in zip(rows.tolist(), columns.tolist()):
+                length = lengths[row]
+                writer.writerow([
+                    ids[row],
+                    period_type,
+                    periods[column],
+                    crashes[row, column],
+                    ksi[row, column],
+                    injured[row, column],
+                    crashes[row, column] / length if length else None,
+                    ksi[row, column] / length if length else None,
+                    injured[row, column] / length if length else None
+                ])
+
+def segment_time_index(segment_crashes: SegmentCrashes) -> TimeIndex:
+    ''' time index over street segments, rows follow segment_crashes.segment_index '''
+    return TimeIndex(segment_crashes.matrix, segment_crashes.dates, segment_crashes.ksi, segment_crashes.injured)
+
+def road_time_index(road_stats: RoadStats) -> TimeIndex:
+    ''' time index over roads, rows follow the roads road_stats was built from '''
+    segment_crashes = road_stats.segment_crashes
+    return TimeIndex(road_stats.road_crashes, segment_crashes.dates, segment_crashes.ksi, segment_crashes.injured)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+'''
+metrics.py: runtime instrumentation shared by every stage
+
+Records wall time, rows and rows/sec per stage, executions and round trip latency histograms per SQL query template, and peak RSS.
+
+Outputs:
+metrics.json: the metrics of the last run
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import re
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+# File metrics are written to
+METRICSJSON = 'data/metrics.json'
+
+# Upper bounds in milliseconds of the query latency histogram buckets, the last bucket holds everything slower
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Seconds between progress reporter updates
+PROGRESS_INTERVAL = 0.5
+PROGRESS_BAR_WIDTH = 40
+
+def query_template(query: str) -> str:
+    ''' normalizes a formatted query into a template by replacing literals with ? and collapsing whitespace and repeated OR conditions '''
+    template = query.decode() if isinstance(query, bytes) else str(query)
+    template = re.sub(r"'(?:[^']|'')*'", '?', template)
+    template = re.sub(r'\b\d+(?:\.\d+)?\b', '?', template)
+    template = re.sub(r'\s+', ' ', template).strip()
+    template = re.sub(r'(\bOR [\w.]+ = \?)(?: \1)+', r'\1 ...', template)
+    return template
+
+def peak_rss_mb() -> float:
+    ''' peak resident set size of this process in megabytes '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+class Metrics:
+    ''' thread safe collector of stage and query metrics '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = dict()
+        self.queries = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        ''' times a stage '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, {'wall_time': 0.0, 'rows': 0})
+                stage['wall_time'] += wall_time
+                stage['rows_per_second'] = stage['rows'] / stage['wall_time'] if stage['wall_time'] else None
+                stage['peak_rss_mb'] = peak_rss_mb()
+
+    def add_rows(self, name: str, rows: int) -> None:
+        ''' counts rows processed by a stage '''
+        with self.lock:
+            self.stages.setdefault(name, {'wall_time': 0.0, 'rows': 0})['rows'] += rows
+
+    def record_query(self, query: str, seconds: float) -> None:
+        ''' records one execution of a query and its round trip latency '''
+        template = query_template(query)
+        bucket = len(LATENCY_BUCKETS_MS)
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if seconds * 1000.0 <= bound:
+                bucket = index
+                break
+        with self.lock:
+            stats = self.queries.get(template)
+            if stats is None:
+                stats = self.queries[template] = {'executions': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats['executions'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['histogram'][bucket] += 1
+
+    def as_dict(self) -> dict:
+        ''' every metric in a JSON serializable dictionary '''
+        with self.lock:
+            return {
+                'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'wall_time': time.time() - self.started,
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': self.stages,
+                'latency_buckets_ms': list(LATENCY_BUCKETS_MS) + ['inf'],
+                'queries': [ dict(template=template, **stats) for template, stats in sorted(self.queries.items(), key=lambda i: -i[1]['total_seconds']) ]
+            }
+
+    def write(self, path: str = METRICSJSON) -> None:
+        ''' writes the metrics JSON '''
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.as_dict(), indent=4))
+
+METRICS = Metrics()
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    ''' cursor that records every execution in METRICS, used as the cursor_factory of every connection '''
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            METRICS.record_query(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            METRICS.record_query(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            METRICS.record_query(sql, time.perf_counter() - start)
+
+class ProgressReporter:
+    ''' live progress line with a bar, throughput and estimated time remaining '''
+
+    def __init__(self, stream=sys.stdout) -> None:
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.last = 0.0
+
+    def update(self, done: int, total: int, force: bool = False) -> None:
+        ''' redraws the progress line at most every PROGRESS_INTERVAL seconds '''
+        now = time.perf_counter()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = (total - done) / rate if rate > 0 else 0.0
+        filled = int(PROGRESS_BAR_WIDTH * done / total) if total else PROGRESS_BAR_WIDTH
+        self.stream.write("\r[{}{}] {}/{} {:.0f} rows/s ETA {:.0f}s ".format('-' * filled, ' ' * (PROGRESS_BAR_WIDTH - filled), done, total, rate, remaining))
+        self.stream.flush()
+
+    def finish(self, done: int = None, total: int = None) -> None:
+        ''' draws the final progress line and ends it '''
+        if done is not None:
+            self.update(done, total, force=True)
+        self.stream.write("\n")
+        self.stream.flush()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+'''
+offline_locator.py: in-process replacement for the findcrashlocation and getstreetfrominterv2 SQL functions of San-Jose-DOT-Crash-Locator
+
+Street segment and intersection geometries are read from postgres once and cached locally, after which crashes are located without the database.
+crash_location.py and analytics.py use this when OFFLINE is set and can cross-check a sample of crashes against the SQL functions with CROSS_CHECK.
+
+Run directly to refresh the network snapshot.
+
+Outputs:
+network_snapshot.npz: segment and intersection geometries in EPSG 2227 feet and longitude/latitude, tagged with the network fingerprint and snapshot format
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import os
+import re
+import sys
+import numpy as np
+import psycopg2
+from crash_store import network_fingerprint
+from utils import db_setup
+
+# File the network snapshot is cached in
+NETWORKSNAPSHOT = 'data/network_snapshot.npz'
+
+# Version of the snapshot layout, snapshots written with another version are rebuilt
+SNAPSHOT_FORMAT = 2
+
+# Compass direction of each crash direction, in degrees counterclockwise from east
+DIRECTION_ANGLES = {
+    'East': 0.0,
+    'North': 90.0,
+    'West': 180.0,
+    'South': 270.0
+}
+
+# A street is only picked for a direction if it leaves the intersection within this many degrees of that direction
+MAX_DIRECTION_ANGLE = 45.0
+
+# Feet along a street used to measure the direction it leaves an intersection in
+HEADING_DISTANCE = 50.0
+
+# Locations further apart than this many degrees are reported as cross-check mismatches (about 3.6 feet of latitude)
+CROSS_CHECK_TOLERANCE = 1e-5
+
+NUMBER = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+WKT_PART = re.compile(r'\(([^()]*)\)')
+
+def wkt_parts(wkt: str) -> list:
+    ''' vertices of each part of a LINESTRING or MULTILINESTRING, one (n, 2) array per part '''
+    if not wkt:
+        return list()
+    return [ np.array([ float(value) for value in NUMBER.findall(part) ]).reshape(-1, 2) for part in WKT_PART.findall(wkt) ]
+
+def wkt_points(wkt: str) -> np.ndarray:
+    ''' vertices of a LINESTRING or MULTILINESTRING as an (n, 2) array, parts of a multilinestring are separated by a row of NaN so no straight piece joins them '''
+    parts = wkt_parts(wkt)
+    if not parts:
+        return np.empty((0, 2))
+    separator = np.full((1, 2), np.nan)
+    return np.concatenate([ array for part in parts for array in (separator, part) ][1:])
+
+def polyline_parts(xy: np.ndarray) -> list:
+    ''' (start, end) vertex ranges of the parts of a polyline whose parts are separated by rows of NaN '''
+    breaks = np.flatnonzero(np.isnan(xy[:, 0])).tolist()
+    return [ (start, end) for start, end in zip([0] + [ i + 1 for i in breaks ], breaks + [len(xy)]) if end > start ]
+
+class NetworkSnapshot:
+    ''' segment and intersection geometries held in flat arrays, the vertices of segment row i are vertices[offsets[i]:offsets[i+1]] '''
+
+    def __init__(self, intersection_ids, intnums, intersection_intids, intersection_xy, intersection_lonlat, segment_ids, from_inters, to_inters, offsets, vertices_xy, vertices_lonlat, network_version: str = None, snapshot_format: int = SNAPSHOT_FORMAT) -> None:
+        self.intersection_ids = intersection_ids
+        self.intnums = intnums
+        self.intersection_intids = intersection_intids
+        self.intersection_xy = intersection_xy
+        self.intersection_lonlat = intersection_lonlat
+        self.segment_ids = segment_ids
+        self.from_inters = from_inters
+        self.to_inters = to_inters
+        self.offsets = offsets
+        self.vertices_xy = vertices_xy
+        self.vertices_lonlat = vertices_lonlat
+        self.network_version = network_version
+        self.snapshot_format = snapshot_format
+        self.segment_rows_by_intid = None
+        self.rows_by_intnum = dict()
+        for row, intnum in enumerate(intnums.tolist()):
+            self.rows_by_intnum.setdefault(intnum, list()).append(row)
+        self.rows_by_id = { intersection: row for row, intersection in enumerate(intersection_ids.tolist()) }
+
+    @classmethod
+    def load(cls, cursor: psycopg2.extensions.cursor, network_version: str = None) -> 'NetworkSnapshot':
+        ''' snapshot every intersection and street segment with one query each, both are transformed to EPSG 2227 so distances and headings compare feet with feet '''
+        cursor.execute("""
+SELECT
+    id,
+    intnum,
+    intid,
+    ST_X(ST_Transform(geom, 2227)),
+    ST_Y(ST_Transform(geom, 2227)),
+    ST_X(ST_Transform(geom, 4326)),
+    ST_Y(ST_Transform(geom, 4326))
+FROM intersections
+ORDER BY id;
+""")
+        intersections = cursor.fetchall()
+
+        cursor.execute("""
+SELECT
+    id,
+    frominteri,
+    tointerid,
+    ST_AsText(ST_Transform(ST_LineMerge(geom), 2227)),
+    ST_AsText(ST_Transform(ST_LineMerge(geom), 4326))
+FROM streetcenterlines
+ORDER BY id;
+""")
+        offsets = [0]
+        segment_ids = list()
+        from_inters = list()
+        to_inters = list()
+        vertices_xy = list()
+        vertices_lonlat = list()
+        for street_id, from_inter, to_inter, wkt, wkt_lonlat in cursor:
+            xy = wkt_points(wkt)
+            lonlat = wkt_points(wkt_lonlat)
+            if len(xy) != len(lonlat):
+                lonlat = np.full(xy.shape, np.nan)
+            segment_ids.append(street_id)
+            from_inters.append(from_inter if from_inter is not None else -1)
+            to_inters.append(to_inter if to_inter is not None else -1)
+            vertices_xy.append(xy)
+            vertices_lonlat.append(lonlat)
+            offsets.append(offsets[-1] + len(xy))
+
+        return cls(
+            np.array([ row[0] for row in intersections ], dtype=np.int64),
+            np.array([ row[1] if row[1] is not None else -1 for row in intersections ], dtype=np.int64),
+            np.array([ row[2] if row[2] is not None else -1 for row in intersections ], dtype=np.int64),
+            np.array([ (row[3], row[4]) for row in intersections ], dtype=np.float64).reshape(-1, 2),
+            np.array([ (row[5], row[6]) for row in intersections ], dtype=np.float64).reshape(-1, 2),
+            np.array(segment_ids, dtype=np.int64),
+            np.array(from_inters, dtype=np.int64),
+            np.array(to_inters, dtype=np.int64),
+            np.array(offsets, dtype=np.int64),
+            np.concatenate(vertices_xy) if vertices_xy else np.empty((0, 2)),
+            np.concatenate(vertices_lonlat) if vertices_lonlat else np.empty((0, 2)),
+            network_version
+        )
+
+    @classmethod
+    def read(cls, path: str = NETWORKSNAPSHOT) -> 'NetworkSnapshot':
+        ''' reads a snapshot written by write '''
+        with np.load(path) as f:
+            return cls(
+                f['intersection_ids'], f['intnums'], f['intersection_intids'], f['intersection_xy'], f['intersection_lonlat'],
+                f['segment_ids'], f['from_inters'], f['to_inters'], f['offsets'], f['vertices_xy'], f['vertices_lonlat'],
+                str(f['network_version']) or None,
+                int(f['snapshot_format']) if 'snapshot_format' in f else 1
+            )
+
+    def write(self, path: str = NETWORKSNAPSHOT) -> None:
+        ''' writes the snapshot, replacing any previous snapshot only once it is complete '''
+        temp_path = path + '.tmp.npz'
+        np.savez(
+            temp_path,
+            intersection_ids=self.intersection_ids,
+            intnums=self.intnums,
+            intersection_intids=self.intersection_intids,
+            intersection_xy=self.intersection_xy,
+            intersection_lonlat=self.intersection_lonlat,
+            segment_ids=self.segment_ids,
+            from_inters=self.from_inters,
+            to_inters=self.to_inters,
+            offsets=self.offsets,
+            vertices_xy=self.vertices_xy,
+            vertices_lonlat=self.vertices_lonlat,
+            network_version=np.array(self.network_version or ''),
+            snapshot_format=np.array(self.snapshot_format)
+        )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def cached(cls, cursor: psycopg2.extensions.cursor = None, path: str = NETWORKSNAPSHOT) -> 'NetworkSnapshot':
+        ''' the cached snapshot if it matches the current network, otherwise a fresh snapshot which is cached, without a cursor the cached snapshot is used as is '''
+        if cursor is None:
+            return cls.read(path)
+        network_version = network_fingerprint(cursor)
+        if os.path.exists(path):
+            snapshot = cls.read(path)
+            if snapshot.network_version == network_version and snapshot.snapshot_format == SNAPSHOT_FORMAT:
+                return snapshot
+        snapshot = cls.load(cursor, network_version)
+        snapshot.write(path)
+        return snapshot
+
+    def __len__(self) -> int:
+        return len(self.segment_ids)
+
+    def segment_xy(self, row: int) -> np.ndarray:
+        ''' vertices of a segment row in EPSG 2227 feet '''
+        return self.vertices_xy[self.offsets[row]:self.offsets[row + 1]]
+
+    def segment_lonlat(self, row: int) -> np.ndarray:
+        ''' vertices of a segment row in longitude/latitude '''
+        return self.vertices_lonlat[self.offsets[row]:self.offsets[row + 1]]
+
+    def leaving_part(self, row: int, origin: np.ndarray) -> tuple:
+        ''' (xy, lonlat) of the part of a segment row with an end closest to origin, ordered to start at that end '''
+        xy = self.segment_xy(row)
+        lonlat = self.segment_lonlat(row)
+        parts = polyline_parts(xy)
+        if not parts:
+            return xy, lonlat
+        start, end = min(parts, key=lambda part: min(np.hypot(*(xy[part[0]] - origin)), np.hypot(*(xy[part[1] - 1] - origin))))
+        xy = xy[start:end]
+        lonlat = lonlat[start:end]
+        if not starts_at(xy, origin):
+            return xy[::-1], lonlat[::-1]
+        return xy, lonlat
+
+    def segments_at(self, intersection_row: int) -> list:
+        ''' segment rows whose frominteri or tointerid is the intid of an intersection row '''
+        if self.segment_rows_by_intid is None:
+            self.segment_rows_by_intid = dict()
+            for row, (from_inter, to_inter) in enumerate(zip(self.from_inters.tolist(), self.to_inters.tolist())):
+                self.segment_rows_by_intid.setdefault(from_inter, list()).append(row)
+                if to_inter != from_inter:
+                    self.segment_rows_by_intid.setdefault(to_inter, list()).append(row)
+        return self.segment_rows_by_intid.get(int(self.intersection_intids[intersection_row]), list())
+
+def cumulative_lengths(xy: np.ndarray) -> np.ndarray:
+    ''' distance along a polyline at each of its vertices '''
+    return np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1])))))
+
+def starts_at(xy: np.ndarray, origin: np.ndarray) -> bool:
+    ''' whether a polyline's first vertex is at least as close to origin as its last '''
+    return np.hypot(*(xy[0] - origin)) <= np.hypot(*(xy[-1] - origin))
+
+class OfflineLocator:
+    ''' answers findcrashlocation and getstreetfrominterv2 style lookups from a NetworkSnapshot '''
+
+    def __init__(self, snapshot: NetworkSnapshot) -> None:
+        self.snapshot = snapshot
+        self.street_rows = dict()
+
+    def street_row(self, intersection_row: int, direction: str):
+        ''' segment row of the street leaving an intersection row closest to a compass direction, or None (getstreetfrominterv2) '''
+        key = (intersection_row, direction)
+        if key in self.street_rows:
+            return self.street_rows[key]
+
+        best = None
+        target = DIRECTION_ANGLES.get(direction)
+        if target is not None:
+            origin = self.snapshot.intersection_xy[intersection_row]
+            best_deviation = MAX_DIRECTION_ANGLE
+            for row in self.snapshot.segments_at(intersection_row):
+                xy, _ = self.snapshot.leaving_part(row, origin)
+                if len(xy) < 2:
+                    continue
+                lengths = cumulative_lengths(xy)
+                distance = min(HEADING_DISTANCE, lengths[-1])
+                x = np.interp(distance, lengths, xy[:, 0])
+                y = np.interp(distance, lengths, xy[:, 1])
+                heading = np.degrees(np.arctan2(y - origin[1], x - origin[0]))
+                deviation = abs((heading - target + 180.0) % 360.0 - 180.0)
+                # rows are ordered by id so ties go to the lowest street id
+                if deviation < best_deviation:
+                    best = row
+                    best_deviation = deviation
+
+        self.street_rows[key] = best
+        return best
+
+    def street_from_inter(self, intersection_id: int, direction: str):
+        ''' id of the street leaving an intersection in a direction, or None '''
+        intersection_row = self.snapshot.rows_by_id.get(intersection_id)
+        if intersection_row is None:
+            return None
+        row = self.street_row(intersection_row, direction)
+        return int(self.snapshot.segment_ids[row]) if row is not None else None
+
+    def crash_location(self, intersection_row: int, direction: str, distance: float) -> tuple:
+        ''' (latitude, longitude) distance feet along the street leaving an intersection row in a direction, or None (findcrashlocation) '''
+        row = self.street_row(intersection_row, direction)
+        if row is None:
+            return None
+        xy, lonlat = self.snapshot.leaving_part(row, self.snapshot.intersection_xy[intersection_row])
+        # points past the end of the street are placed at its far end
+        lengths = cumulative_lengths(xy)
+        distance = min(max(float(distance), 0.0), lengths[-1])
+        latitude = float(np.interp(distance, lengths, lonlat[:, 1]))
+        longitude = float(np.interp(distance, lengths, lonlat[:, 0]))
+        if np.isnan(latitude) or np.isnan(longitude):
+            return None
+        return latitude, longitude
+
+    def locate(self, intnum: int, direction: str, distance: float) -> tuple:
+        ''' (id, y, x) record for a crash in the form returned by crash_location.query_gps, or None if no intersection has the intnum '''
+        rows = self.snapshot.rows_by_intnum.get(intnum)
+        if not rows:
+            return None
+        location = self.crash_location(rows[0], direction, distance)
+        intersection_id = int(self.snapshot.intersection_ids[rows[0]])
+        return (intersection_id,) + location if location else (intersection_id, None, None)
+
+    def street_list(self, intnum: int, direction: str) -> list:
+        ''' streets affected by a crash at an intersection intnum and direction, as analytics.street_list_from_crash would return '''
+        streets = list()
+        if not intnum or not direction:
+            return streets
+        for intersection_row in self.snapshot.rows_by_intnum.get(intnum, list()):
+            if direction == 'At':
+                streets.extend(int(self.snapshot.segment_ids[row]) for row in self.snapshot.segments_at(intersection_row))
+            else:
+                row = self.street_row(intersection_row, direction)
+                if row is not None:
+                    streets.append(int(self.snapshot.segment_ids[row]))
+        return streets
+
+    def street_lists(self, crash_data: dict) -> dict:
+        ''' maps every crash to the list of streets affected by it, as analytics.street_lists_from_crashes would '''
+        return { crash: self.street_list(crash_data[crash]['intersection_id'], crash_data[crash]['direction']) for crash in crash_data }
+
+def location_mismatches(offline: dict, sql: dict, tolerance: float = CROSS_CHECK_TOLERANCE) -> list:
+    ''' keys whose (id, y, x) records differ between two dictionaries of crash locations '''
+    mismatches = list()
+    for key in sql.keys() | offline.keys():
+        a = offline.get(key)
+        b = sql.get(key)
+        if not a or a[1] is None:
+            a = None
+        if not b or b[1] is None:
+            b = None
+        if a is None and b is None:
+            continue
+        if a is None or b is None or a[0] != b[0] or abs(a[1] - b[1]) > tolerance or abs(a[2] - b[2]) > tolerance:
+            mismatches.append(key)
+    return mismatches
+
+def street_list_mismatches(offline: dict, sql: dict) -> list:
+    ''' keys whose street lists differ between two dictionaries of crash streets '''
+    return [ key for key in sql.keys() | offline.keys() if sorted(offline.get(key, list())) != sorted(sql.get(key, list())) ]
+
+def report_mismatches(script: str, mismatches: list, total: int, offline: dict, sql: dict, examples: int = 5) -> None:
+    ''' prints how many offline results disagreed with the SQL functions, with a few examples '''
+    print("{}: Offline results differ from SQL for {} of {} cross-checked crashes".format(script, len(mismatches), total))
+    for key in sorted(mismatches, key=str)[:examples]:
+        print("{}:\tcrash {}: offline {} sql {}".format(script, key, offline.get(key), sql.get(key)), file=sys.stderr)
+
+if __name__ == '__main__':
+    cursor, conn = db_setup()
+    if os.path.exists(NETWORKSNAPSHOT):
+        os.remove(NETWORKSNAPSHOT)
+    snapshot = NetworkSnapshot.cached(cursor)
+    print("offline_locator.py:\n\tIntersections = {}\n\tStreet segments = {}".format(len(snapshot.intersection_ids), len(snapshot)))
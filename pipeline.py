@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+'''
+pipeline.py: runs every stage (crash_location.py, crash_density.py, analytics.py, connected_road_data.py, upload_roads.py) in one process
+
+Stages form a DAG and share one parse of the raw crash csv, each stage runs on its own pooled database connection.
+Independent stages run concurrently, and a stage is skipped when the fingerprint of its inputs
+(raw crash csv, street network version, upstream outputs, stage code) matches the last successful run.
+
+Outputs:
+pipeline_state.json: input fingerprint of each stage's last successful run
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import os
+import ast
+import sys
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import utils
+import crash_location
+import crash_bins
+import crash_density
+import analytics
+import connected_road_data
+import upload_roads
+from metrics import METRICS
+from crash_store import network_fingerprint
+from street_index import STREETINDEX
+from utils import db_setup, db_pool, read_crash_csv, output_path
+
+# File the fingerprint of each stage's last successful run is kept in
+PIPELINESTATE = 'data/pipeline_state.json'
+
+# Run every stage even if its inputs have not changed
+FORCE = False
+
+class Stage:
+    ''' a pipeline stage: function(pipeline, cursor, conn) runs it on the stage's own connection, inputs/outputs are file paths and depends names upstream stages '''
+
+    def __init__(self, name: str, function, inputs: list, outputs: list, depends: list, code: list, network: bool) -> None:
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.outputs = outputs
+        self.depends = depends
+        self.code = code
+        self.network = network
+
+def local_imports(script: str) -> list:
+    ''' a script and every script of this repository it imports, directly or through other scripts '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    found = set()
+    pending = [script]
+    while pending:
+        script = pending.pop()
+        if script in found:
+            continue
+        found.add(script)
+        with open(os.path.join(directory, script), 'r') as f:
+            tree = ast.parse(f.read(), script)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [ alias.name for alias in node.names ]
+            elif isinstance(node, ast.ImportFrom) and not node.level:
+                modules = [node.module]
+            else:
+                continue
+            pending.extend('{}.py'.format(module) for module in modules if os.path.exists(os.path.join(directory, '{}.py'.format(module))))
+    return sorted(found)
+
+def file_fingerprint(path: str) -> str:
+    ''' sha256 of a file's contents, None if it does not exist '''
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Pipeline:
+    ''' shared state (connections, crash data, network version) for the stages of one run '''
+
+    def __init__(self, cursor, conn, pool) -> None:
+        self.cursor = cursor
+        self.conn = conn
+        # concurrently running stages commit and roll back independently, so each takes its own connection from here
+        self.pool = pool
+        self.lock = threading.Lock()
+        self._crash_data = None
+
+    def crash_data(self) -> dict:
+        ''' the raw crash csv, parsed once per run, each caller gets its own copy of the per crash dictionaries '''
+        with self.lock:
+            if self._crash_data is None:
+                self._crash_data = read_crash_csv()
+        return { crash: dict(values) for crash, values in self._crash_data.items() }
+
+    def network_version(self) -> str:
+        ''' version of the street network, computed once per run and shared with the stages '''
+        return network_fingerprint(self.cursor)
+
+    def fingerprint(self, stage: Stage) -> str:
+        ''' fingerprint of everything a stage reads '''
+        digest = hashlib.sha256()
+        for path in stage.inputs + stage.code:
+            digest.update('{}={}\n'.format(path, file_fingerprint(path)).encode())
+        if stage.network:
+            digest.update('network={}\n'.format(self.network_version()).encode())
+        return digest.hexdigest()
+
+STAGES = [
+    Stage('crash_location',
+        lambda pipeline, cursor, conn: crash_location.main(cursor, conn, pipeline.crash_data()),
+        [ utils.RAWCRASHCSV ],
+        [ output_path(crash_location.OUTPUTJSON), crash_location.OUTPUTCSV, crash_location.OUTPUTPOINTS ]
+            + ([ crash_location.OUTPUTKSI, crash_location.OUTPUTINJURED ] if crash_location.WRITE_PERSON_POINTS else [])
+            + ([ crash_bins.CRASHBINS ] if crash_location.BIN_CRASHES else []),
+        [],
+        local_imports('crash_location.py'),
+        True),
+    Stage('crash_density',
+        lambda pipeline, cursor, conn: crash_density.main(),
+        [ output_path(crash_location.OUTPUTJSON) ],
+        [ crash_density.CRASHDENSITY, crash_density.CRASHDENSITYMETA ],
+        [ 'crash_location' ],
+        local_imports('crash_density.py'),
+        False),
+    Stage('analytics',
+        lambda pipeline, cursor, conn: analytics.main(cursor, conn, pipeline.crash_data()),
+        [ utils.RAWCRASHCSV ] + ([ output_path(crash_location.OUTPUTJSON) ] if analytics.SNAP_CRASHES else []),
+        [ output_path(analytics.STREETJSON), analytics.STREETCSV, analytics.STREET_CRASH_RELATIONSHIP ],
+        [ 'crash_location' ] if analytics.SNAP_CRASHES else [],
+        local_imports('analytics.py'),
+        True),
+    Stage('connected_road_data',
+        lambda pipeline, cursor, conn: connected_road_data.main(cursor, conn),
+        [ output_path(analytics.STREETJSON), STREETINDEX ],
+        [ output_path(connected_road_data.ROADSJSON), connected_road_data.ROADSCSV ],
+        [ 'analytics' ],
+        local_imports('connected_road_data.py'),
+        True),
+    Stage('upload_roads',
+        lambda pipeline, cursor, conn: upload_roads.main(cursor, conn),
+        [ connected_road_data.ROADSCSV ],
+        [],
+        [ 'connected_road_data' ],
+        local_imports('upload_roads.py'),
+        False)
+]
+
+def load_state() -> dict:
+    ''' fingerprints of the last successful run of each stage '''
+    if not os.path.exists(PIPELINESTATE):
+        return dict()
+    with open(PIPELINESTATE, 'r') as f:
+        return json.load(f)
+
+def save_state(state: dict) -> None:
+    ''' record the fingerprints of successful stages '''
+    with open(PIPELINESTATE, 'w') as f:
+        f.write(json.dumps(state, indent=4))
+
+def run_stage(pipeline: Pipeline, stage: Stage, state: dict) -> bool:
+    ''' runs a stage unless its inputs are unchanged, returns True if it ran '''
+    fingerprint = pipeline.fingerprint(stage)
+    if not FORCE and state.get(stage.name) == fingerprint and all(os.path.exists(path) for path in stage.outputs):
+        print("pipeline.py: Skipping {}, inputs unchanged".format(stage.name))
+        return False
+    print("pipeline.py: Running {}".format(stage.name))
+    connection = pipeline.pool.getconn()
+    try:
+        with METRICS.stage(stage.name):
+            stage.function(pipeline, connection.cursor(), connection)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        pipeline.pool.putconn(connection)
+    state[stage.name] = fingerprint
+    return True
+
+def run(pipeline: Pipeline, stages: list = STAGES) -> None:
+    ''' runs every stage once all stages it depends on have finished, independent stages run concurrently '''
+    state = load_state()
+    pending = { stage.name: stage for stage in stages }
+    done = set()
+    running = dict()
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while pending or running:
+            for name in [ name for name in pending if all(depend in done for depend in pending[name].depends) ]:
+                running[executor.submit(run_stage, pipeline, pending.pop(name), state)] = name
+            if not running:
+                raise ValueError("pipeline.py: stages {} depend on stages that are not in the pipeline".format(list(pending)))
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except BaseException:
+                    # keep the fingerprints of the stages that did succeed
+                    save_state(state)
+                    METRICS.write()
+                    print("pipeline.py: {} failed".format(name), file=sys.stderr)
+                    raise
+                done.add(name)
+    save_state(state)
+    METRICS.write()
+
+if __name__ == '__main__':
+    cursor, conn = db_setup()
+    pool = db_pool(len(STAGES))
+    try:
+        run(Pipeline(cursor, conn, pool))
+    finally:
+        pool.closeall()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+'''
+road_stats.py: vectorized road statistics built on sparse (CSR style) road x segment and segment x crash incidence arrays
+
+All roads are aggregated in one batched pass, crashes that touch several segments of the same road are only counted once.
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import numpy as np
+from utils import FEETPERMILE
+
+class Incidence:
+    ''' sparse 0/1 matrix in CSR form, the columns of row i are indices[indptr[i]:indptr[i+1]] '''
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray) -> None:
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_lists(cls, rows: list) -> 'Incidence':
+        ''' builds an incidence from a list of column index lists, one per row '''
+        counts = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.fromiter((column for row in rows for column in row), dtype=np.int64, count=int(indptr[-1]))
+        return cls(indptr, indices)
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def row_of_entries(self) -> np.ndarray:
+        ''' the row each stored entry belongs to '''
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    def take(self, rows: np.ndarray) -> 'Incidence':
+        ''' incidence holding the given rows in the given order '''
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        offsets = np.arange(int(indptr[-1]), dtype=np.int64) - np.repeat(indptr[:-1], counts)
+        return Incidence(indptr, self.indices[np.repeat(starts, counts) + offsets])
+
+    @classmethod
+    def stack(cls, incidences: list, column_offsets: list) -> 'Incidence':
+        ''' the rows of several incidences one after another, the columns of each shifted by its offset '''
+        indptr = [ np.zeros(1, dtype=np.int64) ]
+        indices = [ np.zeros(0, dtype=np.int64) ]
+        entries = 0
+        for incidence, offset in zip(incidences, column_offsets):
+            indptr.append(incidence.indptr[1:] + entries)
+            indices.append(incidence.indices + offset)
+            entries += int(incidence.indptr[-1])
+        return cls(np.concatenate(indptr), np.concatenate(indices))
+
+class SegmentCrashes:
+    ''' segment x crash incidence with per crash ksi, injured and date values '''
+
+    def __init__(self, records) -> None:
+        ''' records is an iterable of (street_id, crash_id, ksi, injured) or (street_id, crash_id, ksi, injured, date) '''
+        self.segment_index = dict()
+        self.crash_index = dict()
+        rows = list()
+        ksi = list()
+        injured = list()
+        dates = list()
+        for record in records:
+            street, crash, crash_ksi, crash_injured = record[:4]
+            street = int(street)
+            if street not in self.segment_index:
+                self.segment_index[street] = len(rows)
+                rows.append(list())
+            if crash not in self.crash_index:
+                self.crash_index[crash] = len(ksi)
+                ksi.append(crash_ksi)
+                injured.append(crash_injured)
+                dates.append(record[4] if len(record) > 4 else None)
+            rows[self.segment_index[street]].append(self.crash_index[crash])
+        self.matrix = Incidence.from_lists(rows)
+        self.ksi = np.array(ksi, dtype=np.int64)
+        self.injured = np.array(injured, dtype=np.int64)
+        # missing dates become NaT
+        self.dates = np.array(dates, dtype='datetime64[s]')
+
+    @classmethod
+    def from_street_data(cls, street_data: dict) -> 'SegmentCrashes':
+        ''' builds the incidence from a street_data.json dictionary '''
+        return cls(street_data_records(street_data))
+
+def street_data_records(street_data: dict):
+    ''' generator yielding (street_id, crash_id, ksi, injured, date) for every crash on every segment of a street_data.json dictionary '''
+    for street in street_data:
+        if 'crashes' in street_data[street]:
+            for crash, values in street_data[street]['crashes'].items():
+                yield street, crash, values.get('ksi', 0), values.get('injured', 0), values.get('date')
+
+class RoadStats:
+    ''' deduplicated road x crash incidence for a list of roads, from which any per crash weighting can be rolled up per road '''
+
+    def __init__(self, roads: list, segment_crashes: SegmentCrashes) -> None:
+        ''' roads is a list of lists of street segment ids '''
+        self.segment_crashes = segment_crashes
+        self.road_segments = Incidence.from_lists([ [ segment_crashes.segment_index.get(int(segment), -1) for segment in road ] for road in roads ])
+        self.road_crashes = self._road_crashes()
+
+    def _road_crashes(self) -> Incidence:
+        ''' expand roads -> segments -> crashes and drop repeated (road, crash) pairs '''
+        crash_matrix = self.segment_crashes.matrix
+        roads = self.road_segments.row_of_entries()
+        segments = self.road_segments.indices
+        known = segments >= 0
+        roads = roads[known]
+        segments = segments[known]
+
+        starts = crash_matrix.indptr[segments]
+        counts = crash_matrix.indptr[segments + 1] - starts
+        total = int(counts.sum())
+        pair_roads = np.repeat(roads, counts)
+        offsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_crashes = crash_matrix.indices[np.repeat(starts, counts) + offsets]
+
+        crash_count = max(len(self.segment_crashes.ksi), 1)
+        pairs = np.unique(pair_roads * crash_count + pair_crashes)
+        pair_roads = pairs // crash_count
+        indptr = np.zeros(len(self.road_segments) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_roads, minlength=len(self.road_segments)), out=indptr[1:])
+        return Incidence(indptr, pairs % crash_count)
+
+    def rollup(self, weights: np.ndarray) -> np.ndarray:
+        ''' sum of a per crash weight array over the unique crashes of every road '''
+        return np.bincount(self.road_crashes.row_of_entries(), weights=weights[self.road_crashes.indices], minlength=len(self.road_crashes))
+
+    def crashes(self) -> np.ndarray:
+        ''' number of unique crashes on every road '''
+        return np.diff(self.road_crashes.indptr)
+
+    def ksi(self, weight: float = 1.0) -> np.ndarray:
+        ''' ksi on every road, optionally scaled by weight '''
+        return self.rollup(self.segment_crashes.ksi * weight)
+
+    def injured(self, weight: float = 1.0) -> np.ndarray:
+        ''' injured on every road, optionally scaled by weight '''
+        return self.rollup(self.segment_crashes.injured * weight)
+
+def road_lengths(roads: list, segment_lengths: dict) -> np.ndarray:
+    ''' length in miles of every road given a map of segment to length in feet, unknown lengths count as 0 '''
+    road_segments = Incidence.from_lists([ list(road) for road in roads ])
+    lengths = np.fromiter((segment_lengths.get(segment) or 0.0 for segment in road_segments.indices.tolist()), dtype=np.float64, count=len(road_segments.indices))
+    lengths[np.isnan(lengths)] = 0.0
+    return np.bincount(road_segments.row_of_entries(), weights=lengths, minlength=len(road_segments)) / FEETPERMILE
+
+def per_mile(values: np.ndarray, lengths: np.ndarray) -> list:
+    ''' values / lengths for every road, None where the road has no length '''
+    rates = np.divide(values, lengths, out=np.zeros(len(values), dtype=np.float64), where=lengths > 0)
+    return [ rate if length > 0 else None for rate, length in zip(rates.tolist(), lengths.tolist()) ]
+
+def road_statistics(stats: RoadStats, lengths: np.ndarray) -> list:
+    ''' (ksi, injured, crashes, ksi/mile, injured/mile, crashes/mile) for every road of a RoadStats, lengths in miles '''
+    ksi = stats.ksi().astype(np.int64)
+    injured = stats.injured().astype(np.int64)
+    crashes = stats.crashes()
+    return list(zip(
+        ksi.tolist(),
+        injured.tolist(),
+        crashes.tolist(),
+        per_mile(ksi, lengths),
+        per_mile(injured, lengths),
+        per_mile(crashes, lengths)
+    ))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+'''
+road_store.py: local persistent store of road geometries so roads whose segments have not changed are not rebuilt by postgres on every run
+
+Run directly to clear the store.
+
+Outputs:
+road_store.sqlite: road geometries keyed by stable road id, dropped whenever the street network changes
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import json
+import sqlite3
+
+# File the store is kept in
+ROADSTORE = 'data/road_store.sqlite'
+
+class RoadStore:
+    ''' sqlite backed store of road geometries, if network_version is given and differs from the version the store was built against every geometry is dropped '''
+
+    def __init__(self, path: str = ROADSTORE, network_version: str = None) -> None:
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript("""
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS geometries (
+    roadid INTEGER PRIMARY KEY,
+    geom TEXT
+);
+""")
+        if network_version is not None and network_version != self.network_version():
+            self.invalidate()
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('network_version', ?);", (network_version,))
+            self.connection.commit()
+
+    def network_version(self) -> str:
+        ''' version of the street network the stored geometries were built against '''
+        record = self.connection.execute("SELECT value FROM meta WHERE key = 'network_version';").fetchone()
+        return record[0] if record else None
+
+    def invalidate(self) -> None:
+        ''' drop every stored geometry '''
+        self.connection.execute("DELETE FROM geometries;")
+        self.connection.execute("DELETE FROM meta;")
+        self.connection.commit()
+
+    def road_ids(self) -> set:
+        ''' ids of every road with a stored geometry '''
+        return { record[0] for record in self.connection.execute("SELECT roadid FROM geometries;") }
+
+    def geometry(self, road_id: int) -> str:
+        ''' stored geometry of a road, or None '''
+        record = self.connection.execute("SELECT geom FROM geometries WHERE roadid = ?;", (road_id,)).fetchone()
+        return record[0] if record else None
+
+    def save_geometries(self, geometries) -> None:
+        ''' store an iterable of (road id, geometry) pairs '''
+        self.connection.executemany("INSERT OR REPLACE INTO geometries (roadid, geom) VALUES (?, ?);", geometries)
+        self.connection.commit()
+
+    def retain(self, road_ids: list) -> None:
+        ''' drop the geometries of every road not in road_ids '''
+        self.connection.execute("DELETE FROM geometries WHERE roadid NOT IN (SELECT value FROM json_each(?));", (json.dumps(list(road_ids)),))
+        self.connection.commit()
+
+    def close(self) -> None:
+        ''' close the underlying sqlite connection '''
+        self.connection.close()
+
+if __name__ == '__main__':
+    print("road_store.py: Clearing {}".format(ROADSTORE))
+    store = RoadStore()
+    store.invalidate()
+    store.close()
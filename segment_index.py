@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+'''
+segment_index.py: in-memory uniform grid index over street segment geometries for snapping crash points to their nearest segments
+
+Every straight piece of every segment is registered in each grid cell its bounding box covers, so any piece within one cell
+of a point is found by looking at the point's cell and its eight neighbours. Queries are vectorized over arrays of points.
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import numpy as np
+from offline_locator import NetworkSnapshot
+
+# Side of a grid cell in feet, also the furthest a point can be snapped
+SNAP_DISTANCE = 100.0
+
+# Points handled per vectorized query, bounds the memory used by candidate pairs
+QUERY_CHUNK = 100000
+
+# Approximate feet per degree of latitude, used to place longitude/latitude points on a local flat grid
+FEET_PER_DEGREE = 364000.0
+
+NEIGHBOURS = [ (dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) ]
+
+def local_feet(lonlat: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    ''' places longitude/latitude points on a flat grid in feet around a reference longitude/latitude, accurate to a fraction of a percent across a city '''
+    scale = np.array([ FEET_PER_DEGREE * np.cos(np.radians(reference[1])), FEET_PER_DEGREE ])
+    return (np.asarray(lonlat, dtype=np.float64).reshape(-1, 2) - reference) * scale
+
+def local_lonlat(xy: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    ''' inverse of local_feet '''
+    scale = np.array([ FEET_PER_DEGREE * np.cos(np.radians(reference[1])), FEET_PER_DEGREE ])
+    return np.asarray(xy, dtype=np.float64).reshape(-1, 2) / scale + reference
+
+def concatenated_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    ''' concatenation of range(start, start + count) for each start and count '''
+    total = int(counts.sum())
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + (np.arange(total) - offsets)
+
+def point_segment_distances(points: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    ''' distance from each point to the straight piece between the matching start and end '''
+    direction = ends - starts
+    squared_length = np.einsum('ij,ij->i', direction, direction)
+    along = np.einsum('ij,ij->i', points - starts, direction)
+    fraction = np.clip(np.divide(along, squared_length, out=np.zeros_like(along), where=squared_length > 0), 0.0, 1.0)
+    closest = starts + direction * fraction[:, None]
+    return np.hypot(points[:, 0] - closest[:, 0], points[:, 1] - closest[:, 1])
+
+class SegmentIndex:
+    ''' grid index over polylines, the vertices of polyline row i are vertices[offsets[i]:offsets[i+1]] '''
+
+    def __init__(self, vertices: np.ndarray, offsets: np.ndarray, cell_size: float = SNAP_DISTANCE, geographic: bool = False) -> None:
+        ''' geographic vertices and query points are longitude/latitude, otherwise they are in feet '''
+        self.cell_size = cell_size
+        self.reference = None
+        if geographic:
+            valid = ~np.isnan(vertices).any(axis=1)
+            self.reference = vertices[valid].mean(axis=0) if valid.any() else np.zeros(2)
+        vertices = self.project(vertices)
+        counts = np.diff(offsets)
+        row_of_vertex = np.repeat(np.arange(len(counts)), counts)
+        # a piece joins each vertex to the next vertex of the same polyline
+        pieces = np.flatnonzero(row_of_vertex[:-1] == row_of_vertex[1:])
+        pieces = pieces[np.isfinite(vertices[pieces]).all(axis=1) & np.isfinite(vertices[pieces + 1]).all(axis=1)]
+        self.piece_rows = row_of_vertex[pieces]
+        self.starts = vertices[pieces]
+        self.ends = vertices[pieces + 1]
+
+        low = np.floor(np.minimum(self.starts, self.ends) / cell_size).astype(np.int64)
+        high = np.floor(np.maximum(self.starts, self.ends) / cell_size).astype(np.int64)
+        self.origin = low.min(axis=0) - 1 if len(low) else np.zeros(2, dtype=np.int64)
+        self.width = int((high.max(axis=0) - self.origin).max()) + 3 if len(high) else 1
+        widths = high[:, 0] - low[:, 0] + 1
+        heights = high[:, 1] - low[:, 1] + 1
+        covered = widths * heights
+        piece_of_entry = np.repeat(np.arange(len(pieces)), covered)
+        position = np.arange(int(covered.sum())) - np.repeat(np.cumsum(covered) - covered, covered)
+        cell_x = low[piece_of_entry, 0] + position % widths[piece_of_entry]
+        cell_y = low[piece_of_entry, 1] + position // widths[piece_of_entry]
+        keys = self.cell_keys(cell_x, cell_y)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.entries = piece_of_entry[order]
+
+    @classmethod
+    def from_snapshot(cls, snapshot: NetworkSnapshot, cell_size: float = SNAP_DISTANCE) -> 'SegmentIndex':
+        ''' index over the longitude/latitude geometry of a network snapshot, rows are snapshot segment rows '''
+        return cls(snapshot.vertices_lonlat, snapshot.offsets, cell_size, geographic=True)
+
+    def project(self, points: np.ndarray) -> np.ndarray:
+        ''' points in feet, longitude/latitude is placed on a flat grid around the index's reference point '''
+        if self.reference is None:
+            return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return local_feet(points, self.reference)
+
+    def cell_keys(self, cell_x: np.ndarray, cell_y: np.ndarray) -> np.ndarray:
+        ''' single integer key of each grid cell, cells outside the indexed area may share keys but hold nothing within reach '''
+        return (cell_x - self.origin[0]) * self.width + (cell_y - self.origin[1])
+
+    def nearest(self, points: np.ndarray, k: int = 1, max_distance: float = None) -> tuple:
+        ''' (rows, distances) arrays of shape (n, k) giving the k nearest polylines within max_distance (at most the cell size) of each point, missing neighbours are -1 and inf '''
+        points = self.project(points)
+        max_distance = self.cell_size if max_distance is None else min(max_distance, self.cell_size)
+        rows = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+        for start in range(0, len(points), QUERY_CHUNK):
+            chunk_rows, chunk_distances = self._nearest(points[start:start + QUERY_CHUNK], k, max_distance)
+            rows[start:start + QUERY_CHUNK] = chunk_rows
+            distances[start:start + QUERY_CHUNK] = chunk_distances
+        return rows, distances
+
+    def _nearest(self, points: np.ndarray, k: int, max_distance: float) -> tuple:
+        rows = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+        valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+        if not len(valid) or not len(self.keys):
+            return rows, distances
+        cells = np.floor(points[valid] / self.cell_size).astype(np.int64)
+
+        pair_points = list()
+        pair_pieces = list()
+        for dx, dy in NEIGHBOURS:
+            keys = self.cell_keys(cells[:, 0] + dx, cells[:, 1] + dy)
+            left = np.searchsorted(self.keys, keys, 'left')
+            counts = np.searchsorted(self.keys, keys, 'right') - left
+            pair_points.append(np.repeat(valid, counts))
+            pair_pieces.append(self.entries[concatenated_ranges(left, counts)])
+        pair_points = np.concatenate(pair_points)
+        pair_pieces = np.concatenate(pair_pieces)
+
+        pair_distances = point_segment_distances(points[pair_points], self.starts[pair_pieces], self.ends[pair_pieces])
+        near = pair_distances <= max_distance
+        pair_points = pair_points[near]
+        pair_rows = self.piece_rows[pair_pieces[near]]
+        pair_distances = pair_distances[near]
+
+        # keep the closest piece of each polyline for each point
+        order = np.lexsort((pair_distances, pair_rows, pair_points))
+        pair_points, pair_rows, pair_distances = pair_points[order], pair_rows[order], pair_distances[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (pair_points[1:] != pair_points[:-1]) | (pair_rows[1:] != pair_rows[:-1])
+        pair_points, pair_rows, pair_distances = pair_points[first], pair_rows[first], pair_distances[first]
+
+        # rank polylines by distance for each point, ties go to the lowest row
+        order = np.lexsort((pair_rows, pair_distances, pair_points))
+        pair_points, pair_rows, pair_distances = pair_points[order], pair_rows[order], pair_distances[order]
+        group_start = np.flatnonzero(np.concatenate(([True], pair_points[1:] != pair_points[:-1])))
+        rank = np.arange(len(pair_points)) - np.repeat(group_start, np.diff(np.append(group_start, len(pair_points))))
+        kept = rank < k
+        rows[pair_points[kept], rank[kept]] = pair_rows[kept]
+        distances[pair_points[kept], rank[kept]] = pair_distances[kept]
+        return rows, distances
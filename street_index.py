@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+'''
+street_index.py: indexed sqlite copy of the street segment crash data so later stages can read single segments without loading street_data.json
+
+Outputs:
+street_data.sqlite: per street segment stats and crashes, indexed by street segment id
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import os
+import json
+import sqlite3
+
+# File the index is written to
+STREETINDEX = 'data/street_data.sqlite'
+
+def write_street_index(street_crashes: dict, path: str = STREETINDEX) -> None:
+    ''' writes the street_crashes dictionary built by analytics.py to an indexed sqlite file, replacing any previous index '''
+    temp_path = '{}.tmp'.format(path)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.executescript("""
+CREATE TABLE segments (
+    street_id INTEGER PRIMARY KEY,
+    length REAL,
+    total_crashes INTEGER,
+    injured INTEGER,
+    ksi INTEGER
+);
+
+CREATE TABLE segment_crashes (
+    street_id INTEGER,
+    crash_id TEXT,
+    date TEXT,
+    injured INTEGER,
+    ksi INTEGER
+);
+""")
+        connection.executemany(
+            "INSERT INTO segments (street_id, length, total_crashes, injured, ksi) VALUES (?, ?, ?, ?, ?);",
+            ( (street, street_crashes[street]['length'], street_crashes[street]['total_crashes'], street_crashes[street]['injured'], street_crashes[street]['ksi']) for street in street_crashes )
+        )
+        connection.executemany(
+            "INSERT INTO segment_crashes (street_id, crash_id, date, injured, ksi) VALUES (?, ?, ?, ?, ?);",
+            ( (street, crash, str(values['date']) if values['date'] is not None else None, values['injured'], values['ksi'])
+                for street in street_crashes for crash, values in street_crashes[street]['crashes'].items() )
+        )
+        connection.execute("CREATE INDEX segment_crashes_street_id ON segment_crashes (street_id);")
+        connection.commit()
+    finally:
+        connection.close()
+
+    # swap the finished index in so readers never see a partial file
+    os.replace(temp_path, path)
+
+class StreetIndex:
+    ''' read only view of a street index written by write_street_index '''
+
+    def __init__(self, path: str = STREETINDEX) -> None:
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+    def segment_stats(self, street_ids: list) -> tuple:
+        ''' returns (ksi, injured, crashes) over the unique crashes of a list of street segment ids '''
+        query = """
+SELECT
+    COALESCE(SUM(ksi), 0),
+    COALESCE(SUM(injured), 0),
+    COUNT(*)
+FROM
+    (SELECT
+        crash_id,
+        MAX(ksi) AS ksi,
+        MAX(injured) AS injured
+    FROM segment_crashes
+    WHERE street_id IN (SELECT value FROM json_each(?))
+    GROUP BY crash_id
+    );
+"""
+        return tuple(self.connection.execute(query, (json.dumps(list(street_ids)),)).fetchone())
+
+    def crashes(self, street_id: int) -> dict:
+        ''' the crashes dictionary of a single street segment, as in street_data.json '''
+        crashes = dict()
+        for crash, date, injured, ksi in self.connection.execute("SELECT crash_id, date, injured, ksi FROM segment_crashes WHERE street_id = ?;", (street_id,)):
+            crashes[crash] = {'date': date, 'injured': injured, 'ksi': ksi}
+        return crashes
+
+    def segment_crash_records(self):
+        ''' generator yielding (street_id, crash_id, ksi, injured, date) for every crash on every segment '''
+        yield from self.connection.execute("SELECT street_id, crash_id, ksi, injured, date FROM segment_crashes ORDER BY street_id;")
+
+    def segment_lengths(self) -> dict:
+        ''' map of street segment id to length in miles '''
+        return dict(self.connection.execute("SELECT street_id, length FROM segments;"))
+
+    def close(self) -> None:
+        ''' close the underlying sqlite connection '''
+        self.connection.close()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''
+synthetic_data.py: generates a synthetic street network and raw crash csv for testing and benchmarking without the San Jose DOT data
+
+The network is a jittered grid of intersections joined by street segments, with a few segments removed so streets break into several roads.
+Scale 1 is roughly the size of San Jose, scale 10 and 100 multiply the number of segments and crashes.
+
+Run as: python3 synthetic_data.py [scale]
+
+Outputs (in data/synthetic/<scale>x/):
+raw_crash.csv: crashes in the raw crash csv format described in README.md
+network.sql: streetcenterlines and intersections tables for a disposable Postgres/PostGIS database
+    (the findcrashlocation and getstreetfrominterv2 functions from San-Jose-DOT-Crash-Locator must be installed separately)
+'''
+__author__ = "Jack Fox"
+__email__ = "jfox13@nd.edu"
+
+import os
+import sys
+import csv
+import math
+import random
+import datetime
+from array import array
+from utils import SegmentTable
+
+# Directory synthetic data is written to
+SYNTHETICDIR = 'data/synthetic'
+
+# Intersections along each side of the grid and number of crashes at scale 1
+BASE_GRID = 120
+BASE_CRASHES = 50000
+
+# Feet between neighbouring intersections, origin of the grid in EPSG 2227 feet
+SPACING = 600.0
+ORIGIN = (6150000.0, 1950000.0)
+
+# Fraction of segments removed from the grid
+REMOVED_SEGMENTS = 0.05
+
+DIRECTIONS = ('At', 'North Of', 'South Of', 'East Of', 'West Of')
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+FIRST_DATE = datetime.datetime(2015, 1, 1)
+DATE_RANGE_MINUTES = 6 * 365 * 24 * 60
+
+class SyntheticNetwork:
+    ''' intersections are (id, intnum, intid, x, y), segments are (id, intid, frominteri, tointerid, fullname, streetclas, munileft, muniright, coordinates) '''
+
+    def __init__(self, intersections: list, segments: list) -> None:
+        self.intersections = intersections
+        self.segments = segments
+
+def street_class(index: int) -> str:
+    ''' street classification of the index-th street of the grid '''
+    if index % 10 == 0:
+        return 'MA'
+    if index % 5 == 0:
+        return 'CO'
+    if index % 3 == 0:
+        return 'MI'
+    return 'LO'
+
+def generate_network(scale: float = 1, seed: int = 0) -> SyntheticNetwork:
+    ''' generates a grid network with about scale times BASE_GRID^2 intersections '''
+    rng = random.Random(seed)
+    side = max(2, int(round(BASE_GRID * math.sqrt(scale))))
+
+    intersections = list()
+    positions = dict()
+    for row in range(side):
+        for column in range(side):
+            index = row * side + column
+            x = ORIGIN[0] + column * SPACING + rng.uniform(-SPACING / 10, SPACING / 10)
+            y = ORIGIN[1] + row * SPACING + rng.uniform(-SPACING / 10, SPACING / 10)
+            intersections.append((index + 1, 500000 + index, 100000 + index, x, y))
+            positions[(row, column)] = intersections[-1]
+
+    segments = list()
+    for row in range(side):
+        for column in range(side):
+            for neighbour, name, streetclas, column_of_street in (
+                ((row, column + 1), 'E {} ST'.format(row + 1), street_class(row), column),
+                ((row + 1, column), 'N {} AVE'.format(column + 1), street_class(column), column)
+            ):
+                if neighbour not in positions or rng.random() < REMOVED_SEGMENTS:
+                    continue
+                a = positions[(row, column)]
+                b = positions[neighbour]
+                # the outermost columns of the grid belong to a neighbouring city
+                muni = 'CU' if column_of_street < side // 20 else 'SJ'
+                middle = ((a[3] + b[3]) / 2 + rng.uniform(-10, 10), (a[4] + b[4]) / 2 + rng.uniform(-10, 10))
+                segments.append((len(segments) + 1, 200000 + len(segments), a[2], b[2], name, streetclas, muni, muni, [(a[3], a[4]), middle, (b[3], b[4])]))
+
+    return SyntheticNetwork(intersections, segments)
+
+def polyline_length(coordinates: list) -> float:
+    ''' length of a polyline in its own units '''
+    return sum(math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(coordinates, coordinates[1:]))
+
+def segment_table(network: SyntheticNetwork) -> SegmentTable:
+    ''' in-process stand-in for SegmentTable.load on a synthetic network '''
+    return SegmentTable(
+        array('q', (segment[0] for segment in network.segments)),
+        array('q', (segment[1] for segment in network.segments)),
+        array('q', (segment[2] for segment in network.segments)),
+        array('q', (segment[3] for segment in network.segments)),
+        [ sys.intern(segment[5]) for segment in network.segments ],
+        [ sys.intern(segment[4]) for segment in network.segments ],
+        array('b', (1 if segment[6].lower() == 'sj' or segment[7].lower() == 'sj' else 0 for segment in network.segments)),
+        array('d', (polyline_length(segment[8]) for segment in network.segments))
+    )
+
+class GridResolver:
+    ''' in-process stand-in for the crash to street queries of analytics.py on a synthetic network '''
+
+    def __init__(self, network: SyntheticNetwork) -> None:
+        positions = { intersection[2]: (intersection[3], intersection[4]) for intersection in network.intersections }
+        self.intnum_to_intid = { intersection[1]: intersection[2] for intersection in network.intersections }
+        self.touching = dict()
+        self.directions = dict()
+        for segment in network.segments:
+            for here, there in ((segment[2], segment[3]), (segment[3], segment[2])):
+                self.touching.setdefault(here, list()).append(segment[0])
+                dx = positions[there][0] - positions[here][0]
+                dy = positions[there][1] - positions[here][1]
+                if abs(dx) > abs(dy):
+                    direction = 'East' if dx > 0 else 'West'
+                else:
+                    direction = 'North' if dy > 0 else 'South'
+                self.directions[(here, direction)] = segment[0]
+
+    def street_list(self, intnum: int, direction: str) -> list:
+        ''' streets affected by a crash at an intersection and direction '''
+        intid = self.intnum_to_intid.get(intnum)
+        if intid is None or not direction:
+            return list()
+        if direction == 'At':
+            return list(self.touching.get(intid, list()))
+        street = self.directions.get((intid, direction))
+        return [street] if street is not None else list()
+
+    def street_lists(self, crash_data: dict) -> dict:
+        ''' streets affected by every crash '''
+        return { crash: self.street_list(crash_data[crash]['intersection_id'], crash_data[crash]['direction']) for crash in crash_data }
+
+def write_crash_csv(network: SyntheticNetwork, crashes: int, path: str, seed: int = 0) -> None:
+    ''' writes crashes random crashes near the network's intersections in the raw crash csv format '''
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        writer = csv.writer(f,delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['AccidentId','IntersectionId','Vehicle_Dir','Distance','FatalInjuries','MajorInjuries','ModerateInjuries','MinorInjuries','AccidentDateTime'])
+        for crash in range(crashes):
+            direction = rng.choice(DIRECTIONS)
+            distance = 0 if direction == 'At' else rng.randint(1, int(SPACING / 2))
+            date = FIRST_DATE + datetime.timedelta(minutes=rng.randrange(DATE_RANGE_MINUTES))
+            writer.writerow([
+                1000000 + crash,
+                rng.choice(network.intersections)[1],
+                direction,
+                distance,
+                1 if rng.random() < 0.005 else '',
+                1 if rng.random() < 0.03 else '',
+                rng.choice(['', '', '1', '2']),
+                rng.choice(['', '1', '1', '2']),
+                date.strftime(DATE_FORMAT)
+            ])
+
+def write_postgis_sql(network: SyntheticNetwork, path: str) -> None:
+    ''' writes SQL creating and loading the streetcenterlines and intersections tables '''
+    with open(path, 'w') as f:
+        f.write("""DROP TABLE IF EXISTS streetcenterlines;
+DROP TABLE IF EXISTS intersections;
+
+CREATE TABLE streetcenterlines (
+    id integer PRIMARY KEY,
+    intid integer,
+    frominteri integer,
+    tointerid integer,
+    fullname character varying(125),
+    streetclas character varying(10),
+    munileft character varying(10),
+    muniright character varying(10),
+    geom public.geometry(MultiLineString,2227)
+);
+
+CREATE TABLE intersections (
+    id integer PRIMARY KEY,
+    intnum integer,
+    intid integer,
+    geom public.geometry(Point,2227)
+);
+
+COPY streetcenterlines (id, intid, frominteri, tointerid, fullname, streetclas, munileft, muniright, geom) FROM stdin;
+""")
+        for segment in network.segments:
+            line = ','.join('{:.2f} {:.2f}'.format(x, y) for x, y in segment[8])
+            f.write('\t'.join(str(value) for value in segment[:8]))
+            f.write('\tSRID=2227;MULTILINESTRING(({}))\n'.format(line))
+        f.write("\\.\n\nCOPY intersections (id, intnum, intid, geom) FROM stdin;\n")
+        for intersection in network.intersections:
+            f.write('{}\t{}\t{}\tSRID=2227;POINT({:.2f} {:.2f})\n'.format(*intersection))
+        f.write("""\\.
+
+CREATE INDEX ON streetcenterlines (intid);
+CREATE INDEX ON streetcenterlines (frominteri);
+CREATE INDEX ON streetcenterlines (tointerid);
+CREATE INDEX ON intersections (intnum);
+CREATE INDEX ON intersections (intid);
+""")
+
+def synthetic_directory(scale: float) -> str:
+    ''' directory the synthetic data of a scale is written to '''
+    return '{}/{}x'.format(SYNTHETICDIR, scale)
+
+def generate(scale: float = 1, seed: int = 0) -> tuple:
+    ''' generates and writes the synthetic data of a scale, returns (network, raw crash csv path) '''
+    directory = synthetic_directory(scale)
+    os.makedirs(directory, exist_ok=True)
+    network = generate_network(scale, seed)
+    crash_csv = '{}/raw_crash.csv'.format(directory)
+    write_crash_csv(network, int(BASE_CRASHES * scale), crash_csv, seed)
+    write_postgis_sql(network, '{}/network.sql'.format(directory))
+    return network, crash_csv
+
+if __name__ == '__main__':
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if scale == int(scale):
+        scale = int(scale)
+    print("synthetic_data.py: Generating synthetic data at scale {}".format(scale))
+    network, crash_csv = generate(scale)
+    print("synthetic_data.py:\n\tIntersections = {}\n\tStreet segments = {}\n\tWritten to {}".format(len(network.intersections), len(network.segments), synthetic_directory(scale)))
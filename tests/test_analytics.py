@@ -0,0 +1,29 @@
+'''test_analytics.py: snapping crashes to their nearest street segments'''
+
+import numpy as np
+from analytics import snap_crashes
+from offline_locator import NetworkSnapshot
+
+def snapshot() -> NetworkSnapshot:
+    ''' intersection intnum 5 where an east-west segment (id 20) meets a north-south segment (id 10), intersection intnum 6 far away from both '''
+    vertices = np.array([ (-121.0, 37.0), (-121.0, 37.001), (-121.0, 37.0), (-120.999, 37.0) ])
+    return NetworkSnapshot(
+        np.array([1, 2]), np.array([5, 6]), np.array([7, 8]),
+        np.array([(0.0, 0.0), (0.0, 0.0)]), np.array([(-121.0, 37.0), (-120.9, 37.1)]),
+        np.array([10, 20]), np.array([7, 7]), np.array([9, 9]),
+        np.array([0, 2, 4]), vertices, vertices.copy()
+    )
+
+def crash(intnum: int, direction: str = None) -> dict:
+    return {'intersection_id': intnum, 'direction': direction}
+
+def test_located_crashes_snap_to_nearest_segment():
+    crash_data = {'east': crash(5, 'East')}
+    crash_locations = {'east': {'latitude': 37.00001, 'longitude': -120.9995}}
+    assert snap_crashes(crash_data, crash_locations, snapshot()) == {'east': [20]}
+
+def test_only_located_crashes_snap():
+    crash_data = {'east': crash(5, 'East'), 'no_direction': crash(5), 'far': crash(6), 'unknown': crash(99)}
+    crash_locations = {'east': {'latitude': 37.00001, 'longitude': -120.9995}, 'no_direction': {'latitude': None, 'longitude': None}}
+    assert snap_crashes(crash_data, crash_locations, snapshot()) == {'east': [20]}
+    assert snap_crashes(crash_data, dict(), snapshot()) == dict()
@@ -0,0 +1,83 @@
+'''test_connected_road_data.py: building roads from connected street segments'''
+
+import numpy as np
+import connected_road_data
+from road_stats import RoadStats, SegmentCrashes, road_lengths, road_statistics
+from crash_trends import TimeIndex, road_time_index
+from synthetic_data import generate_network, segment_table
+
+def shard_lengths(shard: list) -> list:
+    return [ (len(shard), item) for item in shard ]
+
+def synthetic_names() -> dict:
+    segments = segment_table(generate_network(1, 0))
+    adjacency = connected_road_data.segment_adjacency(segments)
+    return connected_road_data.names_from_connections(connected_road_data.connections_from_segments(segments, adjacency))
+
+def components(connections: dict) -> list:
+    ''' connected segments found by a plain graph search '''
+    neighbours = dict()
+    for intida, intidb in connections:
+        neighbours.setdefault(intida, set()).add(intidb)
+    seen = set()
+    found = list()
+    for start in neighbours:
+        if start in seen:
+            continue
+        stack = [start]
+        road = set()
+        while stack:
+            segment = stack.pop()
+            if segment in road:
+                continue
+            road.add(segment)
+            stack.extend(neighbours[segment] - road)
+        seen |= road
+        found.append(road)
+    return found
+
+def test_sharded_keeps_item_order():
+    items = list(range(10))
+    results = list(connected_road_data.sharded(shard_lengths, items, 3))
+    assert [ item for _, item in results ] == items
+    assert [ size for size, _ in results ] == [4] * 4 + [4] * 4 + [2] * 2
+
+def test_build_roads_keeps_name_order():
+    names = synthetic_names()
+    assert list(connected_road_data.build_roads(names)) == list(names)
+
+def test_build_roads_finds_connected_segments():
+    names = synthetic_names()
+    name_roads = connected_road_data.build_roads(names)
+    for key in names:
+        assert sorted(map(sorted, name_roads[key])) == sorted(map(sorted, components(names[key])))
+
+def test_build_roads_sharded_matches_serial():
+    segments = segment_table(generate_network(1, 0))
+    adjacency = connected_road_data.segment_adjacency(segments)
+    names = connected_road_data.names_from_connections(connected_road_data.connections_from_segments(segments, adjacency))
+    singles = [ int(street[0]) for street in connected_road_data.nonconnections_from_segments(segments, adjacency) ]
+    id_map = segments.id_map()
+    segment_lengths = segments.length_map()
+
+    # every third segment has a crash of its own, every crash c0, c1, ... is also on the next segment
+    records = dict()
+    for index, street in enumerate(sorted(id_map.values())):
+        if index % 3 == 0:
+            records.setdefault(street, list()).append((street, 'c{}'.format(index), index % 2, index % 5, '20{:02d}-06-01'.format(10 + index % 8)))
+        if index % 3 == 1:
+            records.setdefault(street, list()).append((street, 'c{}'.format(index - 1), (index - 1) % 2, (index - 1) % 5, '20{:02d}-06-01'.format(10 + (index - 1) % 8)))
+
+    name_roads = connected_road_data.build_roads(names)
+    roads = [ road for key in names for road in name_roads[key] ] + [ {single} for single in singles ]
+    stats = RoadStats([ [ id_map[segment] for segment in road ] for road in roads ], SegmentCrashes(record for street_records in records.values() for record in street_records))
+    lengths = road_lengths(roads, segment_lengths)
+
+    sharded_roads, statistics, sharded_lengths, trend_crashes = connected_road_data.build_roads_sharded(names, singles, records, segment_lengths, id_map, 2)
+    assert list(sharded_roads) == list(names) and sharded_roads == name_roads
+    assert statistics == road_statistics(stats, lengths)
+    assert np.array_equal(sharded_lengths, lengths)
+    serial_counts = road_time_index(stats).period_counts('year')
+    sharded_counts = TimeIndex(*trend_crashes).period_counts('year')
+    assert serial_counts[0] == sharded_counts[0]
+    assert all(np.array_equal(serial, sharded) for serial, sharded in zip(serial_counts[1:], sharded_counts[1:]))
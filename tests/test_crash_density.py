@@ -0,0 +1,21 @@
+'''test_crash_density.py: crash density rasters'''
+
+import numpy as np
+import pytest
+from crash_density import density_grid
+
+def test_density_grid_covers_padded_extent():
+    x = np.array([6100000.0, 6102000.0])
+    y = np.array([1900000.0, 1900500.0])
+    density, west, north = density_grid(x, y, np.ones((1, 2)), cell_size=100.0, bandwidth=100.0)
+    assert density.shape == (1, 14, 29)
+    assert (west, north) == (6099600.0, 1901000.0)
+    # the weight is kept, one crash per point, up to the ringing clipped at zero
+    assert density.sum() * (100.0 / 5280.0) ** 2 == pytest.approx(2.0, rel=1e-2)
+
+def test_density_grid_refuses_oversized_grid():
+    # a crash placed about 400 miles from the others
+    x = np.array([6100000.0, 6102000.0, 8200000.0])
+    y = np.array([1900000.0, 1900500.0, 1900000.0])
+    with pytest.raises(ValueError, match='MAX_GRID_CELLS'):
+        density_grid(x, y, np.ones((1, 3)), max_cells=4000)
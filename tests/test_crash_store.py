@@ -0,0 +1,51 @@
+'''test_crash_store.py: street network fingerprints'''
+
+import crash_store
+
+class Connection:
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+
+class FingerprintCursor:
+    ''' stands in for a psycopg2 cursor, counts the fingerprint queries it runs '''
+
+    def __init__(self, dsn: str, version: str) -> None:
+        self.connection = Connection(dsn)
+        self.version = version
+        self.queries = 0
+        self.last_query = None
+
+    def execute(self, query: str) -> None:
+        self.queries += 1
+        self.last_query = query
+
+    def fetchall(self) -> list:
+        return [(self.version,)]
+
+def test_network_fingerprint_read_once_per_database():
+    crash_store.network_versions.clear()
+    first = FingerprintCursor('dbname=first', 'a')
+    other_connection = FingerprintCursor('dbname=first', 'b')
+    second = FingerprintCursor('dbname=second', 'c')
+
+    assert crash_store.network_fingerprint(first) == 'a'
+    assert crash_store.network_fingerprint(first) == 'a'
+    assert crash_store.network_fingerprint(other_connection) == 'a'
+    assert crash_store.network_fingerprint(second) == 'c'
+    assert (first.queries, other_connection.queries, second.queries) == (1, 0, 1)
+
+    assert crash_store.network_fingerprint(other_connection, refresh=True) == 'b'
+    assert crash_store.network_fingerprint(first) == 'b'
+
+def test_network_fingerprint_hashes_geometries_only_when_deep():
+    crash_store.network_versions.clear()
+    cursor = FingerprintCursor('dbname=first', 'a')
+
+    assert crash_store.network_fingerprint(cursor) == 'a'
+    assert 'pg_stat_user_tables' in cursor.last_query and 'ST_AsBinary' not in cursor.last_query
+
+    cursor.version = 'deep'
+    assert crash_store.network_fingerprint(cursor, deep=True) == 'deep'
+    assert 'ST_AsBinary' in cursor.last_query
+    assert crash_store.network_fingerprint(cursor) == 'a'
+    assert cursor.queries == 2
@@ -0,0 +1,35 @@
+'''test_offline_locator.py: locating crashes on a network snapshot without the database'''
+
+import numpy as np
+from offline_locator import NetworkSnapshot, OfflineLocator, polyline_parts, wkt_parts, wkt_points
+
+def snapshot(wkt: str, intersection_xy: tuple) -> NetworkSnapshot:
+    ''' one intersection (id 1, intnum 5, intid 7) and one segment (id 9) running from it '''
+    xy = wkt_points(wkt)
+    return NetworkSnapshot(
+        np.array([1]), np.array([5]), np.array([7]),
+        np.array([intersection_xy], dtype=np.float64), np.array([(-121.0, 37.0)]),
+        np.array([9]), np.array([7]), np.array([8]),
+        np.array([0, len(xy)]), xy, xy.copy()
+    )
+
+def test_wkt_parts_splits_multilinestrings():
+    assert [ part.tolist() for part in wkt_parts('LINESTRING(0 0,10 0)') ] == [[[0.0, 0.0], [10.0, 0.0]]]
+    assert [ part.tolist() for part in wkt_parts('MULTILINESTRING((0 0,1 0),(2 0,3 0,4 0))') ] == [[[0.0, 0.0], [1.0, 0.0]], [[2.0, 0.0], [3.0, 0.0], [4.0, 0.0]]]
+
+def test_wkt_points_separates_parts():
+    points = wkt_points('MULTILINESTRING((0 0,1 0),(2 0,3 0,4 0))')
+    assert np.isnan(points[2]).all()
+    assert polyline_parts(points) == [(0, 2), (3, 6)]
+
+def test_locator_uses_part_touching_intersection():
+    # the part far from the intersection points east, the part leaving it points west
+    locator = OfflineLocator(snapshot('MULTILINESTRING((0 0,100 0),(200 0,300 0))', (300.0, 0.0)))
+    assert locator.street_list(5, 'West') == [9]
+    assert locator.street_list(5, 'East') == []
+    assert locator.crash_location(0, 'West', 50) == (0.0, 250.0)
+
+def test_locator_reverses_segments_drawn_toward_intersection():
+    locator = OfflineLocator(snapshot('LINESTRING(0 100,0 0)', (0.0, 0.0)))
+    assert locator.street_list(5, 'North') == [9]
+    assert locator.crash_location(0, 'North', 30) == (30.0, 0.0)
@@ -0,0 +1,65 @@
+'''test_pipeline.py: stage scheduling, connections and code fingerprints'''
+
+import threading
+import pipeline
+
+class Connection:
+    def __init__(self) -> None:
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def commit(self) -> None:
+        self.commits += 1
+
+    def rollback(self) -> None:
+        self.rollbacks += 1
+
+class Pool:
+    ''' stands in for a psycopg2 connection pool, hands out a new connection for every getconn '''
+
+    def __init__(self) -> None:
+        self.connections = list()
+        self.returned = list()
+
+    def getconn(self) -> Connection:
+        connection = Connection()
+        self.connections.append(connection)
+        return connection
+
+    def putconn(self, connection: Connection) -> None:
+        self.returned.append(connection)
+
+def test_local_imports_follow_imports_between_scripts():
+    code = pipeline.local_imports('connected_road_data.py')
+    for script in ('connected_road_data.py', 'utils.py', 'metrics.py', 'crash_store.py', 'road_store.py', 'road_stats.py', 'crash_trends.py', 'street_index.py'):
+        assert script in code
+    assert 'upload_roads.py' not in code
+
+def test_concurrent_stages_get_their_own_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'PIPELINESTATE', str(tmp_path / 'pipeline_state.json'))
+    monkeypatch.setattr(pipeline.METRICS, 'write', lambda *args, **kwargs: None)
+    monkeypatch.setattr(pipeline, 'FORCE', True)
+    used = dict()
+    both_running = threading.Barrier(2, timeout=10)
+
+    def record(name: str):
+        def function(run: pipeline.Pipeline, cursor, conn) -> None:
+            if name in ('first', 'second'):
+                both_running.wait()
+            used[name] = conn
+        return function
+
+    stages = [
+        pipeline.Stage('first', record('first'), [], [], [], [], False),
+        pipeline.Stage('second', record('second'), [], [], [], [], False),
+        pipeline.Stage('third', record('third'), [], [], [ 'first', 'second' ], [], False)
+    ]
+    pool = Pool()
+    pipeline.run(pipeline.Pipeline(None, None, pool), stages)
+
+    assert len({ id(conn) for conn in used.values() }) == 3
+    assert all(conn.commits == 1 and conn.rollbacks == 0 for conn in used.values())
+    assert sorted(map(id, pool.returned)) == sorted(map(id, pool.connections))
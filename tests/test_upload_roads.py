@@ -0,0 +1,67 @@
+'''test_upload_roads.py: streaming roads.csv rows into postgres with COPY FROM STDIN'''
+
+import io
+import csv
+import psycopg2
+import pytest
+import upload_roads
+
+HEADER = 'roadid,geom,name,street_classification,relevant_road,ksi,injured,crashes,ksi_mile,injured_mile,crashes_mile\n'
+GOOD_ROW = '1,,First St,Major,True,1,2,3,0.5,1.0,1.5\n'
+SHORT_ROW = '2,,Second St,Major\n'
+
+class CopyCursor:
+    ''' stands in for a psycopg2 cursor, copy_expert reports an exception raised by read() the way psycopg2 does '''
+
+    def __init__(self) -> None:
+        self.copied = ''
+        self.queries = list()
+
+    def execute(self, query: str, args=None) -> None:
+        self.queries.append(query)
+
+    def copy_expert(self, sql: str, file, size: int = 8192) -> None:
+        try:
+            while True:
+                text = file.read(size)
+                if not text:
+                    break
+                self.copied += text
+        except Exception as e:
+            raise psycopg2.extensions.QueryCanceledError('COPY from stdin failed: error in .read() call: {}'.format(e))
+
+    def fetchall(self) -> list:
+        return list()
+
+class Connection:
+    def __init__(self) -> None:
+        self.commits = 0
+
+    def commit(self) -> None:
+        self.commits += 1
+
+def rows(text: str):
+    return upload_roads.checked_rows(io.StringIO(text))
+
+def test_copy_rows_streams_every_row():
+    cursor = CopyCursor()
+    upload_roads.copy_rows(cursor, 'COPY', rows(HEADER + GOOD_ROW * 3))
+    assert list(csv.reader(io.StringIO(cursor.copied))) == list(csv.reader(io.StringIO(GOOD_ROW * 3)))
+
+def test_load_staging_raises_bad_row_error():
+    with pytest.raises(ValueError, match='Invalid number of columns'):
+        upload_roads.load_staging(CopyCursor(), rows(HEADER + GOOD_ROW + SHORT_ROW))
+
+def test_upsert_rows_raises_bad_row_error_before_commit():
+    conn = Connection()
+    with pytest.raises(ValueError, match='Invalid number of columns'):
+        upload_roads.upsert_rows(CopyCursor(), conn, rows(HEADER + SHORT_ROW))
+    assert conn.commits == 0
+
+def test_copy_rows_keeps_database_errors():
+    class FailingCursor(CopyCursor):
+        def copy_expert(self, sql: str, file, size: int = 8192) -> None:
+            raise psycopg2.DataError('invalid input syntax')
+
+    with pytest.raises(psycopg2.DataError):
+        upload_roads.copy_rows(FailingCursor(), 'COPY', rows(HEADER + GOOD_ROW))
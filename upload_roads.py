@@ -2,25 +2,36 @@
 
 '''
 upload_roads.py: upload the data in roads.csv to postgres with table name 'roads'
+
+Rows are streamed from roads.csv with COPY FROM STDIN into a staging table, which replaces roads in one short transaction
+once it is loaded and indexed, so roads can be queried throughout the upload.
+Once roads exists with stable road ids only the roads that were added, changed or removed are written.
 '''
 __author__ = "Jack Fox"
 __email__ = "jfox13@nd.edu"
 
+import io
 import sys
 import csv
 import psycopg2
 import pathlib
+from metrics import METRICS
 from utils import db_setup
 
 ROADS_COLUMNS = 11
+ROADS_COLUMN_NAMES = 'roadid, geom, name, street_classification, relevant_road, ksi, injured, crashes, ksi_mile, injured_mile, crashes_mile'
 
-def upload_data(cursor: psycopg2.extensions.cursor, csv_path: str) -> None:
-    ''' execute SQL to upload roads.csv to postgres '''
-    query = """
-DROP TABLE IF EXISTS roads;
+# Stream rows from this machine into a staging table and swap it in, False has the server read roads.csv itself and recreate roads in place
+STREAM_UPLOAD = True
 
-CREATE TABLE public.roads (
-    roadid integer PRIMARY KEY,
+# Table rows are loaded into before replacing roads
+STAGING_TABLE = 'roads_staging'
+
+# Only insert, update and delete the roads that changed since the last upload, requires STREAM_UPLOAD and an existing roads table with bigint road ids
+UPSERT = True
+
+ROADS_TABLE_COLUMNS = """
+    roadid bigint,
     geom public.geometry(MultiLineString,0),
     name character varying(125),
     street_classification character varying(125),
@@ -30,19 +41,145 @@ CREATE TABLE public.roads (
     crashes bigint,
     ksi_mile float8,
     injured_mile float8,
-    crashes_mile float8
+    crashes_mile float8"""
+
+ROADS_TABLE = """
+CREATE TABLE public.{table} ({columns},
+    CONSTRAINT {table}_pkey PRIMARY KEY (roadid)
 );
+"""
+
+class RowStream:
+    ''' read-only file-like view of an iterable of rows as CSV text, lets copy_expert pull rows as it needs them '''
+
+    def __init__(self, rows) -> None:
+        self.rows = iter(rows)
+        # psycopg2 reports an exception raised by read() as a failed COPY, the original is kept here
+        self.error = None
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
 
-COPY roads(roadid, geom, name, street_classification, relevant_road, ksi, injured, crashes, ksi_mile, injured_mile, crashes_mile) FROM '{}' DELIMITER ',' CSV HEADER;
+    def read(self, size: int = -1) -> str:
+        ''' at least size characters of CSV text unless the rows run out, everything left if size is negative '''
+        while size < 0 or self.buffer.tell() < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            except Exception as e:
+                self.error = e
+                raise
+            self.writer.writerow(row)
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+def checked_rows(csv_file) -> iter:
+    ''' rows of roads.csv after its header, raising ValueError at the first row without ROADS_COLUMNS columns '''
+    csv_reader = csv.reader(csv_file, delimiter=',')
+    header = next(csv_reader, None)
+    if header is None or len(header) != ROADS_COLUMNS:
+        raise ValueError("Invalid number of columns")
+    for row in csv_reader:
+        if len(row) != ROADS_COLUMNS:
+            raise ValueError("Invalid number of columns")
+        METRICS.add_rows('upload_roads', 1)
+        yield row
+
+def copy_rows(cursor: psycopg2.extensions.cursor, query: str, rows) -> None:
+    ''' runs a COPY FROM STDIN query fed from an iterable of rows, an error raised by the rows is raised again in place of the failed COPY '''
+    stream = RowStream(rows)
+    try:
+        cursor.copy_expert(query, stream)
+    except psycopg2.Error:
+        if stream.error is not None:
+            raise stream.error
+        raise
+
+def upload_data(cursor: psycopg2.extensions.cursor, csv_path: str) -> None:
+    ''' execute SQL to upload roads.csv to postgres '''
+    query = """
+DROP TABLE IF EXISTS roads;
+{}
+COPY roads({}) FROM '{}' DELIMITER ',' CSV HEADER;
 
 SELECT UpdateGeometrySRID('public', 'roads', 'geom', 2227);
 
-""".format(csv_path)
+""".format(ROADS_TABLE.format(table='roads', columns=ROADS_TABLE_COLUMNS), ROADS_COLUMN_NAMES, csv_path)
     cursor.execute(query)
 
-if __name__ == '__main__':
-    cursor, conn = db_setup()
+def load_staging(cursor: psycopg2.extensions.cursor, rows) -> None:
+    ''' streams an iterable of roads.csv rows (without header) into a freshly created and indexed staging table '''
+    cursor.execute("DROP TABLE IF EXISTS {table};\n{create}".format(table=STAGING_TABLE, create=ROADS_TABLE.format(table=STAGING_TABLE, columns=ROADS_TABLE_COLUMNS)))
+    copy_rows(cursor, "COPY {}({}) FROM STDIN WITH (FORMAT csv)".format(STAGING_TABLE, ROADS_COLUMN_NAMES), rows)
+    cursor.execute("""
+SELECT UpdateGeometrySRID('public', '{table}', 'geom', 2227);
+CREATE INDEX {table}_geom_idx ON {table} USING GIST (geom);
+CREATE INDEX {table}_name_idx ON {table} (name);
+ANALYZE {table};
+""".format(table=STAGING_TABLE))
+
+def swap_staging(cursor: psycopg2.extensions.cursor) -> None:
+    ''' replaces roads with the staging table, readers see either the old or the new table once this is committed '''
+    cursor.execute("""
+DROP TABLE IF EXISTS roads;
+ALTER TABLE {table} RENAME TO roads;
+ALTER TABLE roads RENAME CONSTRAINT {table}_pkey TO roads_pkey;
+ALTER INDEX {table}_geom_idx RENAME TO roads_geom_idx;
+ALTER INDEX {table}_name_idx RENAME TO roads_name_idx;
+""".format(table=STAGING_TABLE))
+
+def roads_upsertable(cursor: psycopg2.extensions.cursor) -> bool:
+    ''' whether a roads table with bigint road ids exists to apply changes to '''
+    cursor.execute("""
+SELECT data_type
+FROM information_schema.columns
+WHERE table_schema = 'public' AND table_name = 'roads' AND column_name = 'roadid';
+""")
+    record = cursor.fetchone()
+    return bool(record) and record[0] == 'bigint'
 
+def upsert_rows(cursor: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection, rows) -> tuple:
+    ''' applies an iterable of roads.csv rows (without header) to roads in one transaction, touching only roads that were added, changed or removed, returns (inserted, updated, deleted) '''
+    columns = [ column.strip() for column in ROADS_COLUMN_NAMES.split(',') ]
+    cursor.execute("CREATE TEMPORARY TABLE roads_upsert ({}) ON COMMIT DROP;".format(ROADS_TABLE_COLUMNS))
+    copy_rows(cursor, "COPY roads_upsert({}) FROM STDIN WITH (FORMAT csv)".format(ROADS_COLUMN_NAMES), rows)
+
+    cursor.execute("""
+DELETE FROM roads
+WHERE NOT EXISTS (SELECT 1 FROM roads_upsert WHERE roads_upsert.roadid = roads.roadid);
+""")
+    deleted = cursor.rowcount
+
+    # geometries are compared by their binary form so any change to a road's shape counts
+    cursor.execute("""
+INSERT INTO roads ({columns})
+SELECT {values} FROM roads_upsert
+ON CONFLICT (roadid) DO UPDATE SET {updates}
+WHERE ({current}) IS DISTINCT FROM ({excluded})
+RETURNING xmax = 0;
+""".format(
+        columns=ROADS_COLUMN_NAMES,
+        values=', '.join('ST_SetSRID(geom, 2227)' if column == 'geom' else column for column in columns),
+        updates=', '.join('{0} = EXCLUDED.{0}'.format(column) for column in columns[1:]),
+        current=', '.join('ST_AsBinary(roads.geom)' if column == 'geom' else 'roads.{}'.format(column) for column in columns[1:]),
+        excluded=', '.join('ST_AsBinary(EXCLUDED.geom)' if column == 'geom' else 'EXCLUDED.{}'.format(column) for column in columns[1:])
+    ))
+    changes = [ record[0] for record in cursor.fetchall() ]
+    conn.commit()
+    inserted = sum(changes)
+    return inserted, len(changes) - inserted, deleted
+
+def upload_rows(cursor: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection, rows) -> None:
+    ''' loads an iterable of roads.csv rows (without header) into roads, keeping the old table available until the new one is ready '''
+    load_staging(cursor, rows)
+    conn.commit()
+    swap_staging(cursor)
+    conn.commit()
+
+def main(cursor: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection) -> None:
+    ''' checks roads.csv and uploads it to postgres '''
     csv_path = '{}/data/roads.csv'.format(pathlib.Path(__file__).parent.absolute())
 
     try:
@@ -50,18 +187,34 @@ if __name__ == '__main__':
     except:
         print("Error: Could not open roads.csv",file=sys.stdout)
         sys.exit(1)
-    
-    try:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-    except:
-        print("Error: roads.csv improperly formatted",file=sys.stdout)
-        sys.exit(1)
 
-    for row in csv_reader:
-        if len(row) != ROADS_COLUMNS:
-            print("Error: roads.csv improperly formatted\n\tInvalid number of columns",file=sys.stdout)
+    if STREAM_UPLOAD:
+        # the file is checked as it is streamed, a bad row aborts the load before roads is touched
+        try:
+            with csv_file:
+                if UPSERT and roads_upsertable(cursor):
+                    print("upload_roads.py:\n\tRoads inserted = {}\n\tRoads updated = {}\n\tRoads deleted = {}".format(*upsert_rows(cursor, conn, checked_rows(csv_file))))
+                else:
+                    upload_rows(cursor, conn, checked_rows(csv_file))
+        except (ValueError, csv.Error) as e:
+            conn.rollback()
+            print("Error: roads.csv improperly formatted\n\t{}".format(e),file=sys.stdout)
             sys.exit(1)
+        return
+
+    try:
+        for row in checked_rows(csv_file):
+            pass
+    except (ValueError, csv.Error) as e:
+        print("Error: roads.csv improperly formatted\n\t{}".format(e),file=sys.stdout)
+        sys.exit(1)
     csv_file.close()
 
     upload_data(cursor,csv_path)
-    conn.commit()
\ No newline at end of file
+    conn.commit()
+
+if __name__ == '__main__':
+    cursor, conn = db_setup()
+    with METRICS.stage('upload_roads'):
+        main(cursor, conn)
+    METRICS.write()
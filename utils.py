@@ -4,11 +4,25 @@
 __author__ = "Jack Fox"
 __email__ = "jfox13@nd.edu"
 
+import os
 import json
 import sys
 import psycopg2
 import csv
 import datetime
+import shelve
+import math
+import re
+import gzip
+import io
+import threading
+import mmap
+import psycopg2.pool
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import OrderedDict
+from metrics import InstrumentedCursor, ProgressReporter
+from crash_store import network_fingerprint
 
 USERNAME = ""
 PASSWORD = ""
@@ -16,7 +30,31 @@ DBLOCALNAME = ""
 RAWCRASHCSV = ""
 
 FEETPERMILE = 5280.0
-PROGRESS_BAR_WIDTH = 40
+QUERY_CACHE_SIZE = 100000
+NULL_ID = -1
+
+# Format and compression of the large JSON outputs: OUTPUT_JSON_FORMAT is 'json' (indented, as always) or 'ndjson' (one record per line), OUTPUT_COMPRESSION is None, 'gzip' or 'zstd'
+OUTPUT_JSON_FORMAT = 'json'
+OUTPUT_COMPRESSION = None
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Directory the street segment snapshot is kept in between runs, reused for as long as the street network is unchanged
+SEGMENT_SNAPSHOT = 'data/segment_snapshot'
+# (SegmentTable attribute, array typecode) of every numeric snapshot column, classes and names are stored as utf-8 text
+SEGMENT_COLUMNS = (('ids', 'q'), ('intids', 'q'), ('from_inters', 'q'), ('to_inters', 'q'), ('in_sj', 'b'), ('lengths', 'd'))
+SEGMENT_TEXT_COLUMNS = ('classes', 'names')
+
+# (strptime format, fixed width fast path) for every date format accepted in the raw crash csv, in the order clean_date tries them
+CRASH_DATE_FORMATS = (
+    ('%Y-%m-%d %H:%M', re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})')),
+    ('%Y-%m-%d %H:%M:%S', re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})')),
+    ('%Y-%m-%d', re.compile(r'(\d{4})-(\d{2})-(\d{2})')),
+    ('%Y/%m/%d %H:%M', re.compile(r'(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2})')),
+    ('%Y/%m/%d %H:%M:%S', re.compile(r'(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2})')),
+    ('%Y/%m/%d', re.compile(r'(\d{4})/(\d{2})/(\d{2})'))
+)
+
+progress = threading.local()
 
 def db_setup() -> tuple:
     ''' connect to postgres database '''
@@ -25,13 +63,39 @@ def db_setup() -> tuple:
                                     password = PASSWORD,
                                     host = "127.0.0.1",
                                     port = "5432",
-                                    database = DBLOCALNAME)
+                                    database = DBLOCALNAME,
+                                    cursor_factory = InstrumentedCursor)
         cursor = connection.cursor()
         return cursor, connection
     except:
         print("Error: Could not connect to SQL database {} as {}".format(DBLOCALNAME,USERNAME),file=sys.stderr)
         return None
 
+def db_pool(workers: int) -> psycopg2.pool.ThreadedConnectionPool:
+    ''' pool of up to workers connections to the postgres database '''
+    return psycopg2.pool.ThreadedConnectionPool(1, workers,
+                                    user = USERNAME,
+                                    password = PASSWORD,
+                                    host = "127.0.0.1",
+                                    port = "5432",
+                                    database = DBLOCALNAME,
+                                    cursor_factory = InstrumentedCursor)
+
+def run_with_pool(pool: psycopg2.pool.ThreadedConnectionPool, workers: int, function, chunks: list) -> list:
+    ''' calls function(chunk, cursor) for every chunk on a pool of worker threads, each with its own pooled connection, and returns the results in chunk order '''
+    def run_chunk(chunk):
+        connection = pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                result = function(chunk, cursor)
+            connection.commit()
+            return result
+        finally:
+            pool.putconn(connection)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_chunk, chunks))
+
 with open(".personal_data", 'r') as f:
     personal_data = json.load(f)
     USERNAME = personal_data["postgres_username"]
@@ -39,23 +103,353 @@ with open(".personal_data", 'r') as f:
     DBLOCALNAME = personal_data["postgres_database_name"]
     RAWCRASHCSV = "data/{}".format(personal_data["raw_crash_csv"])
 
+class QueryCache:
+    ''' memoizes query results keyed on the query inputs, holds at most max_size results in memory and optionally persists every result to a shelve file at path '''
+    MISSING = object()
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, path: str = None) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.disk = shelve.open(path) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # the cache may be shared by the threads of run_with_pool
+        self.lock = threading.RLock()
+
+    def __contains__(self, key: tuple) -> bool:
+        with self.lock:
+            return key in self.entries or (self.disk is not None and repr(key) in self.disk)
+
+    def get(self, key: tuple, default=None):
+        ''' returns the cached result for key, or default if the query has not been run '''
+        with self.lock:
+            return self._get(key, default)
+
+    def _get(self, key: tuple, default):
+        ''' get without taking the lock '''
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.disk is not None and repr(key) in self.disk:
+            self.hits += 1
+            self.disk_hits += 1
+            value = self.disk[repr(key)]
+            self._remember(key, value)
+            return value
+        self.misses += 1
+        return default
+
+    def put(self, key: tuple, value) -> None:
+        ''' stores the result of a query '''
+        with self.lock:
+            self._remember(key, value)
+            if self.disk is not None:
+                self.disk[repr(key)] = value
+
+    def get_or_query(self, key: tuple, query_function):
+        ''' returns the cached result for key, running query_function() to produce it on a miss '''
+        value = self.get(key, self.MISSING)
+        if value is self.MISSING:
+            value = query_function()
+            self.put(key, value)
+        return value
+
+    def _remember(self, key: tuple, value) -> None:
+        ''' adds a result to the in memory tier, evicting the least recently used result if full '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        ''' hit/miss counters for this cache '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self.entries)
+        }
+
+    def clear(self) -> None:
+        ''' drops every cached result, including the on-disk tier '''
+        self.entries.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self) -> None:
+        ''' flushes and closes the on-disk tier '''
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+class SegmentTable:
+    ''' compact column snapshot of streetcenterlines (id, intid, frominteri, tointerid, streetclas, fullname, sj flag, length in feet), row i of each column describes the same segment '''
+
+    def __init__(self, ids, intids, from_inters, to_inters, classes, names, in_sj, lengths) -> None:
+        self.ids = ids
+        self.intids = intids
+        self.from_inters = from_inters
+        self.to_inters = to_inters
+        self.classes = classes
+        self.names = names
+        self.in_sj = in_sj
+        self.lengths = lengths
+        self._rows_by_id = None
+        self._rows_by_intid = None
+
+    QUERY ="""
+SELECT
+    id,
+    intid,
+    frominteri,
+    tointerid,
+    streetclas,
+    fullname,
+    (LOWER(munileft) = 'sj' OR LOWER(muniright) = 'sj') AS in_sj,
+    ST_Length(ST_AsText(ST_LineMerge(geom)))
+FROM streetcenterlines
+ORDER BY id
+"""
+
+    @classmethod
+    def from_rows(cls, rows) -> 'SegmentTable':
+        ''' builds the columns from (id, intid, frominteri, tointerid, streetclas, fullname, in_sj, length) rows '''
+        ids = array('q')
+        intids = array('q')
+        from_inters = array('q')
+        to_inters = array('q')
+        classes = list()
+        names = list()
+        in_sj = array('b')
+        lengths = array('d')
+        for row in rows:
+            ids.append(int(row[0]))
+            intids.append(int(row[1]) if row[1] is not None else NULL_ID)
+            from_inters.append(int(row[2]) if row[2] is not None else NULL_ID)
+            to_inters.append(int(row[3]) if row[3] is not None else NULL_ID)
+            classes.append(sys.intern(row[4]) if row[4] is not None else None)
+            names.append(sys.intern(row[5]) if row[5] is not None else None)
+            in_sj.append(1 if row[6] else 0)
+            lengths.append(float(row[7]) if row[7] is not None else math.nan)
+        return cls(ids, intids, from_inters, to_inters, classes, names, in_sj, lengths)
+
+    @classmethod
+    def load(cls, cursor: psycopg2.extensions.cursor) -> 'SegmentTable':
+        ''' snapshot every street segment with a single query '''
+        cursor.execute(cls.QUERY)
+        return cls.from_rows(cursor.fetchall())
+
+    @classmethod
+    def copy(cls, cursor: psycopg2.extensions.cursor) -> 'SegmentTable':
+        ''' snapshot every street segment with COPY TO STDOUT, which streams the rows as text instead of building a result set '''
+        buffer = io.StringIO()
+        cursor.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT csv, NULL '\\N')".format(cls.QUERY), buffer)
+        buffer.seek(0)
+        return cls.from_rows(
+            [ None if value == '\\N' else value for value in row[:6] ] + [ row[6] == 't', None if row[7] == '\\N' else row[7] ]
+            for row in csv.reader(buffer)
+        )
+
+    @staticmethod
+    def snapshot_version(directory: str = SEGMENT_SNAPSHOT) -> str:
+        ''' network version of the snapshot in a directory, None if there is no complete snapshot '''
+        try:
+            with open(os.path.join(directory, 'meta.json'), 'r') as f:
+                return json.load(f)['network_version']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self, directory: str = SEGMENT_SNAPSHOT, network_version: str = None) -> None:
+        ''' writes each column to its own raw binary file so it can be memory mapped, meta.json is written last and marks the snapshot complete '''
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        def write_file(name: str, data: bytes) -> None:
+            # each file is replaced rather than overwritten so processes mapping the previous snapshot are unaffected
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+
+        for column, typecode in SEGMENT_COLUMNS:
+            write_file(column + '.bin', array(typecode, getattr(self, column)).tobytes())
+        for column in SEGMENT_TEXT_COLUMNS:
+            values = getattr(self, column)
+            encoded = [ value.encode('utf-8') if value is not None else b'' for value in values ]
+            offsets = array('q', [0])
+            for value in encoded:
+                offsets.append(offsets[-1] + len(value))
+            write_file(column + '.bin', b''.join(encoded))
+            write_file(column + '.offsets.bin', offsets.tobytes())
+            write_file(column + '.null.bin', array('b', (value is None for value in values)).tobytes())
+
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({ 'network_version': network_version, 'rows': len(self) }, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    @classmethod
+    def read(cls, directory: str = SEGMENT_SNAPSHOT) -> 'SegmentTable':
+        ''' opens a snapshot written by write, numeric columns are memory mapped rather than read '''
+        def mapped(name: str, typecode: str):
+            with open(os.path.join(directory, name), 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return array(typecode)
+                # the view keeps the mapping open after the file is closed
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+        columns = { column: mapped(column + '.bin', typecode) for column, typecode in SEGMENT_COLUMNS }
+        for column in SEGMENT_TEXT_COLUMNS:
+            with open(os.path.join(directory, column + '.bin'), 'rb') as f:
+                text = f.read()
+            offsets = mapped(column + '.offsets.bin', 'q')
+            nulls = mapped(column + '.null.bin', 'b')
+            columns[column] = [ None if nulls[row] else sys.intern(text[offsets[row]:offsets[row + 1]].decode('utf-8')) for row in range(len(nulls)) ]
+        return cls(**columns)
+
+    @classmethod
+    def cached(cls, cursor: psycopg2.extensions.cursor, directory: str = SEGMENT_SNAPSHOT) -> 'SegmentTable':
+        ''' the snapshot on disk if it was taken of the current street network, otherwise a fresh snapshot which is saved for later runs, without a cursor the snapshot on disk is used as is '''
+        if cursor is None:
+            return cls.read(directory)
+        network_version = network_fingerprint(cursor)
+        if cls.snapshot_version(directory) == network_version:
+            return cls.read(directory)
+        table = cls.copy(cursor)
+        table.write(directory, network_version)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row_by_id(self, street_id: int) -> int:
+        ''' row holding the segment with a given id, None if there is no such segment '''
+        if self._rows_by_id is None:
+            self._rows_by_id = { street: row for row, street in enumerate(self.ids) }
+        return self._rows_by_id.get(street_id)
+
+    def row_by_intid(self, intid: int) -> int:
+        ''' row holding the segment with a given intid, None if there is no such segment '''
+        if self._rows_by_intid is None:
+            self._rows_by_intid = { segment: row for row, segment in enumerate(self.intids) }
+        return self._rows_by_intid.get(intid)
+
+    def length(self, street_id: int) -> float:
+        ''' street length in feet for a segment id, None if unknown '''
+        row = self.row_by_id(street_id)
+        if row is None or math.isnan(self.lengths[row]) or not self.lengths[row]:
+            return None
+        return self.lengths[row]
+
+    def road_length(self, segments: set) -> float:
+        ''' length in miles of a road given the intids of its segments '''
+        total_length = 0.0
+        for segment in segments:
+            row = self.row_by_intid(segment)
+            if row is not None and not math.isnan(self.lengths[row]):
+                total_length += self.lengths[row]
+        return total_length / FEETPERMILE
+
+    def intersection_map(self) -> dict:
+        ''' map of street segment intid to (frominteri, tointeri, streetclas) '''
+        return { self.intids[row]: (self.from_inters[row], self.to_inters[row], self.classes[row]) for row in range(len(self)) }
+
+    def length_map(self) -> dict:
+        ''' map of street segment intid to length in feet (nan if unknown) '''
+        return { self.intids[row]: self.lengths[row] for row in range(len(self)) }
+
+    def id_map(self) -> dict:
+        ''' map of street segment intid to id '''
+        return { self.intids[row]: self.ids[row] for row in range(len(self)) }
+
+def output_path(path: str, json_format: str = None, compression: str = None) -> str:
+    ''' the file name a JSON output is actually written to given its format and compression '''
+    json_format = json_format or OUTPUT_JSON_FORMAT
+    compression = compression if compression is not None else OUTPUT_COMPRESSION
+    if json_format == 'ndjson' and path.endswith('.json'):
+        path = '{}.ndjson'.format(path[:-len('.json')])
+    if compression == 'gzip':
+        path = '{}.gz'.format(path)
+    elif compression == 'zstd':
+        path = '{}.zst'.format(path)
+    return path
+
+def open_text(path: str, mode: str):
+    ''' opens a text file for reading or writing, compressing or decompressing it based on its suffix '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            print("Error: zstd compression requires the zstandard module",file=sys.stderr)
+            raise
+        if mode == 'w':
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), encoding='utf-8')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    return open(path, mode)
+
+def write_json_records(path: str, records, json_format: str = None, compression: str = None) -> str:
+    ''' writes an iterable of (key, value) records one at a time, in 'json' format the file is identical to json.dumps(dict(records), default=str, indent=4), returns the path written '''
+    json_format = json_format or OUTPUT_JSON_FORMAT
+    path = output_path(path, json_format, compression)
+
+    with open_text(path, 'w') as f:
+        if json_format == 'ndjson':
+            for key, value in records:
+                record = {'id': key}
+                record.update(value)
+                f.write(json.dumps(record, default=str))
+                f.write('\n')
+            return path
+
+        first = True
+        for key, value in records:
+            # json.dumps writes every key of a dictionary as a string
+            key = json.dumps({key: None})[1:-len(': null}')]
+            value = json.dumps(value, default=str, indent=4).replace('\n', '\n    ')
+            f.write('{}\n    {}: {}'.format('{' if first else ',', key, value))
+            first = False
+        f.write('{}' if first else '\n}')
+    return path
+
+def read_json_records(path: str):
+    ''' generator yielding (key, value) for each record of a file written by write_json_records, keys are strings as json.load would give '''
+    with open_text(path, 'r') as f:
+        if '.ndjson' in path:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    key = record.pop('id')
+                    yield str(key), record
+        else:
+            for key, value in json.load(f).items():
+                yield key, value
+
+def load_json_output(path: str) -> dict:
+    ''' loads a JSON output written with the configured format and compression into a dictionary '''
+    return dict(read_json_records(output_path(path)))
+
 def progress_bar_setup() -> None:
-    ''' setup for progress bar '''
-    sys.stdout.write("[%s]" % (" " * PROGRESS_BAR_WIDTH))
-    sys.stdout.flush()
-    sys.stdout.write("\b" * (PROGRESS_BAR_WIDTH+1)) # return to start of line, after '['
+    ''' setup for progress bar, each thread has its own progress reporter '''
+    progress.reporter = ProgressReporter()
+    progress.done = 0
+    progress.total = 0
 
 def progress_bar_increment(i: int, total: int) -> None:
-    ''' increment progress bar if needed given the total tasks that need to be done and the amount already completed '''
-    increment = total / PROGRESS_BAR_WIDTH
-    if i > 1 and int((i-1)/increment) < int((i)/increment):
-        sys.stdout.write("-")
-        sys.stdout.flush()
+    ''' update the progress reporter given the total tasks that need to be done and the amount already completed '''
+    progress.done = i
+    progress.total = total
+    progress.reporter.update(i, total)
 
 def progress_bar_finish() -> None:
     ''' end progress bar '''
-    sys.stdout.write("]\n")
-    sys.stdout.flush()
+    progress.reporter.finish(progress.done, progress.total)
 
 def clean_severity(n: str) -> int:
     ''' total severity calculator '''
@@ -63,53 +457,136 @@ def clean_severity(n: str) -> int:
         return 0
     return int(n)
 
-def read_crash_csv() -> dict:
-    '''Reads initial crash data csv into a dictionary, parsing out all the relevant information for each crash'''
-    crash_data = dict()
+class CrashRecord:
+    ''' a single parsed row of the raw crash csv '''
+    __slots__ = ('crash_id', 'intersection_id', 'direction', 'distance', 'ksi', 'injured', 'date')
 
-    with open(RAWCRASHCSV) as csv_file:
+    def __init__(self, crash_id: str, intersection_id: int, direction: str, distance: str, ksi: int, injured: int, date: datetime.datetime) -> None:
+        self.crash_id = crash_id
+        self.intersection_id = intersection_id
+        self.direction = direction
+        self.distance = distance
+        self.ksi = ksi
+        self.injured = injured
+        self.date = date
+
+    def as_dict(self) -> dict:
+        ''' the crash_data dictionary entry for this crash '''
+        return {
+            'intersection_id': self.intersection_id,
+            'direction': self.direction,
+            'distance': self.distance,
+            'ksi': self.ksi,
+            'injured': self.injured,
+            'date': self.date
+        }
+
+class DateParser:
+    ''' parses crash dates, detecting the date format once and only searching the other formats again when a date does not match it '''
+
+    def __init__(self) -> None:
+        self.date_format = None
+
+    def parse(self, date_str: str) -> datetime.datetime:
+        ''' cleans date string into proper datetime '''
+        if not date_str:
+            return None
+
+        if self.date_format:
+            date = self._parse_format(date_str, self.date_format)
+            if date:
+                return date
+
+        for date_format in CRASH_DATE_FORMATS:
+            date = self._parse_format(date_str, date_format)
+            if date:
+                self.date_format = date_format
+                return date
+
+        # no format matched, let clean_date raise the same error it always has
+        return clean_date(date_str)
+
+    @staticmethod
+    def _parse_format(date_str: str, date_format: tuple) -> datetime.datetime:
+        ''' parses a date with a (strptime format, fixed width pattern) pair, returns None if the date does not match '''
+        match = date_format[1].fullmatch(date_str)
+        try:
+            if match:
+                return datetime.datetime(*map(int, match.groups()))
+            return datetime.datetime.strptime(date_str, date_format[0])
+        except ValueError:
+            return None
+
+def clean_direction(direction: str, distance: str) -> tuple:
+    ''' normalizes a raw Vehicle_Dir and Distance into (direction, distance) '''
+    if distance and distance == '0':
+        direction = 'At'
+
+    if direction == 'At':
+        distance = '0'
+    elif direction == 'South Of':
+        direction = 'South'
+    elif direction == 'East Of':
+        direction = 'East'
+    elif direction == 'North Of':
+        direction = 'North'
+    elif direction == 'West Of':
+        direction = 'West'
+    else:
+        direction = None
+    return direction, distance
+
+def iter_crash_csv(path: str = None):
+    ''' generator yielding a CrashRecord for each crash in the raw crash csv, defaults to RAWCRASHCSV '''
+    date_parser = DateParser()
+
+    with open(path or RAWCRASHCSV) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
-        line = 0
+        next(csv_reader, None)
         for row in csv_reader:
-            if line == 0:
-                line += 1
-                continue
-            line += 1
-
-            crash_id = row[0]
-            intersection_id = int(row[1])
-            direction = row[2]
-            distance = row[3]
             fatal = clean_severity(row[4])
             major = clean_severity(row[5])
             moderate = clean_severity(row[6])
             minor = clean_severity(row[7])
-            date = clean_date(row[8])
-
-            if distance and distance == '0':
-                direction = 'At'
-
-            if direction == 'At':
-                distance = '0'
-            elif direction == 'South Of':
-                direction = 'South'
-            elif direction == 'East Of':
-                direction = 'East'
-            elif direction == 'North Of':
-                direction = 'North'
-            elif direction == 'West Of':
-                direction = 'West'
-            else:
-                direction = None
-
-            crash_data[crash_id] = dict()
-            crash_data[crash_id]['intersection_id'] = intersection_id
-            crash_data[crash_id]['direction'] = direction
-            crash_data[crash_id]['distance'] = distance
-            crash_data[crash_id]['ksi'] = calc_KSI(fatal, major)
-            crash_data[crash_id]['injured'] = calc_total_injured(fatal, major, moderate, minor)
-            crash_data[crash_id]['date'] = date
+            date = date_parser.parse(row[8])
+            direction, distance = clean_direction(row[2], row[3])
 
+            yield CrashRecord(
+                row[0],
+                int(row[1]),
+                direction,
+                distance,
+                calc_KSI(fatal, major),
+                calc_total_injured(fatal, major, moderate, minor),
+                date
+            )
+
+def read_crash_columns(path: str = None) -> dict:
+    ''' reads the raw crash csv into columns, numeric columns are typed arrays and dates are seconds since the epoch (nan when missing) '''
+    columns = {
+        'crash_id': list(),
+        'intersection_id': array('q'),
+        'direction': list(),
+        'distance': list(),
+        'ksi': array('l'),
+        'injured': array('l'),
+        'date': array('d')
+    }
+    for record in iter_crash_csv(path):
+        columns['crash_id'].append(record.crash_id)
+        columns['intersection_id'].append(record.intersection_id)
+        columns['direction'].append(record.direction)
+        columns['distance'].append(sys.intern(record.distance))
+        columns['ksi'].append(record.ksi)
+        columns['injured'].append(record.injured)
+        columns['date'].append((record.date - EPOCH).total_seconds() if record.date else math.nan)
+    return columns
+
+def read_crash_csv(path: str = None) -> dict:
+    '''Reads initial crash data csv into a dictionary, parsing out all the relevant information for each crash'''
+    crash_data = dict()
+    for record in iter_crash_csv(path):
+        crash_data[record.crash_id] = record.as_dict()
     return crash_data
 
 def clean_date(date_str: str) -> datetime.datetime: